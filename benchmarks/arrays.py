@@ -0,0 +1,81 @@
+"""
+Size, decode time and validation time of docs holding a vector as a
+list field against the same vector in an ArrayField. No database
+needed, the docs are decoded from BSON the way get() gets them.
+
+    python benchmarks/arrays.py [--dim 768] [--docs 2000]
+
+Prints one JSON object.
+"""
+# python core
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 3rd party
+import bson
+from bson.objectid import ObjectId
+
+# from this project
+from mongoschema import (
+    MongoSchema, MongoField as MF, ArrayField, set_index_mode,
+)
+
+set_index_mode('manual')
+
+
+def _schemas(dim):
+    as_list = type(MongoSchema)('AsList', (MongoSchema,), {
+        'schema': {'name': MF(str), 'vector': [MF(float)]},
+    })
+    as_array = type(MongoSchema)('AsArray', (MongoSchema,), {
+        'schema': {'name': MF(str),
+                   'vector': MF(ArrayField(dtype='float32', shape=dim))},
+    })
+    return as_list, as_array
+
+
+def _measure(ms, raws, docs):
+    started = time.perf_counter()
+    for raw in raws:
+        ms._fromdb(bson.decode(raw)).vector[0]
+    decode = time.perf_counter() - started
+    started = time.perf_counter()
+    for doc in docs:
+        ms._validate(doc)
+    validate = time.perf_counter() - started
+    return {
+        'bytes_per_doc': sum(len(x) for x in raws) // len(raws),
+        'decode_and_read_us': round(decode / len(raws) * 1e6, 2),
+        'validate_us': round(validate / len(docs) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--docs', type=int, default=2000)
+    args = parser.parse_args()
+    results = {}
+    for ms in _schemas(args.dim):
+        mf = ms.schema['vector']
+        raws, docs = [], []
+        for i in range(args.docs):
+            vector = [random.random() for _ in range(args.dim)]
+            if not isinstance(mf, list):
+                vector = mf.type.pack(vector)
+            doc = {'name': 'item%d' % i, 'vector': vector}
+            raws.append(bson.encode(dict(doc, _id=ObjectId())))
+            docs.append(dict(doc, id=ObjectId()))
+        results[ms.__name__] = _measure(ms, raws, docs)
+    print(json.dumps({'benchmark': 'arrays', 'dim': args.dim,
+                      'docs': args.docs, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+to_columns() against what reporting code does without it: list() the
+docs and pull each field out of every MongoDoc. Runs on the bundled
+in-memory collection.
+
+    python benchmarks/columns.py [--docs 20000] [--numpy]
+
+Prints one JSON object.
+"""
+# python core
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# from this project
+from mongoschema import MongoSchema, MongoField as MF, set_index_mode
+from mongoschema.memory import InMemoryCollection
+
+set_index_mode('manual')
+
+FIELDS = ['sensor', 'value', 'count', 'ok', 'at']
+
+
+class Reading(MongoSchema):
+    collection = InMemoryCollection('reading', 'bench')
+    schema = {
+        'sensor': MF(str),
+        'value': MF(float),
+        'count': MF(int),
+        'ok': MF(bool),
+        'at': MF(datetime.datetime),
+        'note': MF(str, required=False),
+        'history': [MF(dict)],
+    }
+
+
+def _fill(count):
+    at = datetime.datetime(2020, 1, 1)
+    Reading.collection.insert_many([{
+        'sensor': 's%d' % (i % 100),
+        'value': i / 7.0,
+        'count': i,
+        'ok': i % 2 == 0,
+        'at': at,
+        'note': 'reading number %d' % i,
+        'history': [{'v': j} for j in range(5)],
+    } for i in range(count)])
+
+
+def _by_hand():
+    Reading.clear_cache_and_init()
+    docs = Reading.list()
+    return {name: [getattr(x, name) for x in docs] for name in FIELDS}
+
+
+def _timed(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--numpy', action='store_true',
+                        help='numpy columns (numpy has to be installed)')
+    args = parser.parse_args()
+    _fill(args.docs)
+    by_hand = _timed(_by_hand)
+    columns = _timed(lambda: Reading.to_columns(
+        fields=FIELDS, use_numpy=args.numpy))
+    print(json.dumps({
+        'benchmark': 'columns',
+        'docs': args.docs,
+        'numpy': args.numpy,
+        'list_and_pivot_s': round(by_hand, 4),
+        'to_columns_s': round(columns, 4),
+        'speedup': round(by_hand / columns, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
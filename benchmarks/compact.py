@@ -0,0 +1,109 @@
+"""
+Memory per cached doc and attribute access speed of compact docs against
+regular MongoDocs. No database needed, the docs are built from raw docs
+the way get() builds them.
+
+    python benchmarks/compact.py [--docs 100000]
+
+Prints one JSON object.
+"""
+# python core
+import os
+import sys
+import json
+import timeit
+import argparse
+import datetime
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 3rd party
+import bson
+from bson.objectid import ObjectId
+
+# from this project
+from mongoschema import MongoSchema, MongoField as MF, set_index_mode
+
+set_index_mode('manual')
+
+SCHEMA = {
+    'username': MF(str),
+    'email': MF(str),
+    'age': MF(int),
+    'score': MF(float),
+    'created': MF(datetime.datetime),
+    'nickname': MF(str, required=False),
+    'settings': {
+        'theme': MF(str, default='dark'),
+    },
+    'tags': [MF(str)],
+}
+
+
+class Regular(MongoSchema):
+    schema = dict(SCHEMA)
+
+
+class Compact(MongoSchema):
+    schema = dict(SCHEMA)
+    compact = True
+
+
+def _raw(i):
+    """
+    A doc as it comes out of the db (decoded from BSON, so with its own
+    key strings)
+    """
+    return bson.decode(bson.encode({
+        '_id': ObjectId(),
+        'username': 'user%d' % i,
+        'email': 'user%d@example.com' % i,
+        'age': i % 90,
+        'score': i / 7.0,
+        'created': datetime.datetime(2020, 1, 1),
+        'settings': {'theme': 'light'},
+        'tags': ['a', 'b'],
+    }))
+
+
+def _bytes_per_doc(ms, count):
+    """
+    Memory held by count docs (values included) as the cache holds them
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    docs = [ms._fromdb(_raw(i)) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / float(len(docs)), docs
+
+
+def _access_ns(doc, key, number=200000):
+    timer = timeit.Timer('doc.%s' % key, globals={'doc': doc})
+    return min(timer.repeat(5, number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--docs', type=int, default=100000)
+    args = parser.parse_args()
+    results = {'benchmark': 'compact', 'docs': args.docs}
+    for name, ms in (('mongodoc', Regular), ('compact', Compact)):
+        per_doc, docs = _bytes_per_doc(ms, args.docs)
+        doc = docs[0]
+        results[name] = {
+            'bytes_per_doc': round(per_doc),
+            'getattr_ns': round(_access_ns(doc, 'username'), 1),
+            'getattr_missing_ns': round(_access_ns(doc, 'nickname'), 1),
+            'getitem_ns': round(_access_ns(doc, 'doc["username"]'), 1),
+            'fromdb_us': round(min(timeit.repeat(
+                lambda: ms._fromdb(_raw(0)), number=10000, repeat=3))
+                / 10000 * 1e6, 2),
+        }
+        del docs
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
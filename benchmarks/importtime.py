@@ -0,0 +1,85 @@
+"""
+Import time of mongoschema, measured with python -X importtime in fresh
+interpreters, plus the cost of defining schema classes.
+
+    python benchmarks/importtime.py [--runs 10] [--module mongoschema]
+
+Prints one JSON object: the best total import time of the module (in
+microseconds), the slowest modules it pulls in and whether flask got
+imported (it shouldn't until a route is registered).
+"""
+# python core
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFINE_SCHEMAS = """
+import time
+import mongoschema
+from mongoschema import MongoSchema, MongoField as MF, set_index_mode
+set_index_mode('manual')
+start = time.perf_counter()
+for i in range(%(count)d):
+    type(MongoSchema)('Schema%%d' %% i, (MongoSchema,), {
+        'schema': {'a': MF(str), 'b': MF(int), 'c': [MF(dict)]},
+        'indexes': ['a'],
+    })
+print(time.perf_counter() - start)
+"""
+
+
+def _importtime(module):
+    """
+    {module: (self us, cumulative us)} of one fresh import of module
+    """
+    code = 'import %s, sys; print("flask" in sys.modules)' % module
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+        capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative))
+    return times, proc.stdout.strip() == 'True'
+
+
+def _define_schemas(count):
+    proc = subprocess.run(
+        [sys.executable, '-c', DEFINE_SCHEMAS % {'count': count}], cwd=ROOT,
+        capture_output=True, text=True, check=True)
+    return float(proc.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--module', default='mongoschema')
+    parser.add_argument('--schemas', type=int, default=200)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    runs = [_importtime(args.module) for _ in range(args.runs)]
+    best, flask_imported = min(runs, key=lambda x: x[0][args.module][1])
+    slowest = sorted(best.items(), key=lambda x: -x[1][0])[:args.top]
+    define = min(_define_schemas(args.schemas) for _ in range(3))
+    print(json.dumps({
+        'benchmark': 'importtime',
+        'module': args.module,
+        'runs': args.runs,
+        'import_us': best[args.module][1],
+        'flask_imported': flask_imported,
+        'slowest_self_us': [
+            {'module': name, 'self_us': self_us, 'cumulative_us': cum}
+            for name, (self_us, cum) in slowest],
+        'define_schemas': args.schemas,
+        'define_schemas_us': round(define * 1e6),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+"""
+Benchmarks of the hot paths (create, get, find, save, _validate, _fromdb,
+to_dict, to_json and the flask routes) for a few doc shapes, against the
+bundled in-memory collection or a real server.
+
+    python benchmarks/suite.py                      # in-memory collection
+    python benchmarks/suite.py --backend mongodb --uri mongodb://localhost
+    python benchmarks/suite.py --shape flat --case get_cached --case find
+    python benchmarks/suite.py --output results.json
+
+Prints (or writes to --output) one JSON object: the environment and a
+result per (backend, shape, case) with ops/sec, p50/p99 latency in
+microseconds and the bytes allocated per op (peak, traced separately so
+tracing doesn't slow the timed run).
+"""
+# python core
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import datetime
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 3rd party
+import bson
+
+# from this project
+from mongoschema import (
+    MongoSchema, MongoField as MF, set_index_mode, to_json,
+    register_flask_app,
+)
+from mongoschema.memory import InMemoryCollection
+from mongoschema.sharedcache import SharedCache
+
+set_index_mode('manual')
+
+SHAPES = ('flat', 'nested', 'reflist')
+
+CASES = ('create', 'get_cached', 'get_uncached', 'get_snapshot', 'get_shared',
+         'find', 'save', 'validate', 'fromdb', 'to_dict', 'to_json',
+         'flask_get', 'flask_list')
+
+# docs returned by each find and flask_list op
+FIND_LIMIT = 20
+
+# ops run before the timed ones
+WARMUP_OPS = 10
+
+# references in each reflist doc
+REFLIST_LENGTH = 200
+
+
+def _flat_schema():
+    return {
+        'name': MF(str),
+        'email': MF(str),
+        'age': MF(int),
+        'score': MF(float),
+        'active': MF(bool),
+        'created': MF(datetime.datetime),
+        'nickname': MF(str, required=False),
+        'lang': MF(str, default='en'),
+    }
+
+
+def _flat_doc(i):
+    return {
+        'name': 'user%d' % i,
+        'email': 'user%d@example.com' % i,
+        'age': i % 90,
+        'score': i / 7.0,
+        'active': i % 2 == 0,
+        'created': datetime.datetime(2020, 1, 1),
+    }
+
+
+def _nested_schema():
+    return {
+        'name': MF(str),
+        'address': {
+            'street': MF(str),
+            'city': MF(str),
+            'geo': {
+                'lat': MF(float),
+                'lng': MF(float),
+            },
+        },
+        # keys with . and $ are escaped on the way to the db
+        'prices': MF(dict),
+        'history': [MF(dict)],
+    }
+
+
+def _nested_doc(i):
+    return {
+        'name': 'place%d' % i,
+        'address': {
+            'street': '%d main st.' % i,
+            'city': 'springfield',
+            'geo': {'lat': 1.5, 'lng': -2.5},
+        },
+        'prices': {'v1.2': {'$usd': i, 'eur.cents': i * 100}, 'v2': {}},
+        'history': [{'at.time': j, 'what': 'x'} for j in range(5)],
+    }
+
+
+def _define(backend_name, make_collection):
+    """
+    {shape: (schema class, make_doc(i))} for one backend
+    """
+    target = type(MongoSchema)('%sTarget' % backend_name, (MongoSchema,), {
+        'collection': make_collection('target'),
+        'schema': {'name': MF(str)},
+    })
+    flat = type(MongoSchema)('%sFlat' % backend_name, (MongoSchema,), {
+        'collection': make_collection('flat'),
+        'schema': _flat_schema(),
+    })
+    nested = type(MongoSchema)('%sNested' % backend_name, (MongoSchema,), {
+        'collection': make_collection('nested'),
+        'schema': _nested_schema(),
+    })
+    reflist = type(MongoSchema)('%sReflist' % backend_name, (MongoSchema,), {
+        'collection': make_collection('reflist'),
+        'schema': {'name': MF(str), 'targets': [MF(target)]},
+    })
+    targets = []
+
+    def reflist_doc(i):
+        if not targets:
+            targets.extend(target.create(name='t%d' % j)
+                           for j in range(REFLIST_LENGTH))
+        return {'name': 'list%d' % i, 'targets': list(targets)}
+    return {
+        'flat': (flat, _flat_doc),
+        'nested': (nested, _nested_doc),
+        'reflist': (reflist, reflist_doc),
+    }, [target, flat, nested, reflist]
+
+
+class Fixture(object):
+    """
+    A collection filled with docs of one shape, and whatever the cases
+    need prepared outside of the timed part
+    """
+
+    def __init__(self, ms, make_doc, docs, ops, client):
+        self.ms = ms
+        self.make_doc = make_doc
+        self.ops = ops
+        self.client = client
+        self.mdocs = [ms.create(**make_doc(i)) for i in range(docs)]
+        self.ids = [x.id for x in self.mdocs]
+        self.created = docs
+        self.tmpdir = tempfile.mkdtemp()
+
+    def close(self):
+        if self.ms.shared_cache is not None:
+            self.ms.shared_cache.close()
+            self.ms.shared_cache = None
+        self.ms._drop_snapshot()
+        shutil.rmtree(self.tmpdir)
+
+    def raw_docs(self, count):
+        """
+        Docs as find_one returns them, a fresh one per op
+        """
+        collection = self.ms.collection
+        raws = [collection.find_one({'_id': x}) for x in self.ids]
+        return [bson.decode(bson.encode(raws[i % len(raws)]))
+                for i in range(count)]
+
+
+def _case(name, fx):
+    """
+    The function running one op of case name (given the op's index). Its
+    prepare(i), if it has one, is run before each op without being timed.
+    """
+    ms, mdocs, ids = fx.ms, fx.mdocs, fx.ids
+    count = len(ids)
+    if name == 'create':
+        def op(i):
+            fx.created += 1
+            ms.create(**fx.make_doc(fx.created))
+    elif name == 'get_cached':
+        def op(i):
+            ms.get(id=ids[i % count])
+    elif name == 'get_uncached':
+        def op(i):
+            ms.cache.pop(ids[i % count], None)
+            ms.get(id=ids[i % count])
+    elif name == 'get_snapshot':
+        # the first get of each doc after a cold start from a snapshot
+        path = os.path.join(fx.tmpdir, 'snapshot')
+        ms.snapshot_cache(path)
+
+        def prepare(i):
+            if i % count == 0:
+                ms.clear_cache_and_init()
+                ms.load_cache_snapshot(path)
+
+        def op(i):
+            ms.get(id=ids[i % count])
+        op.prepare = prepare
+    elif name == 'get_shared':
+        # what another worker process finds in the shared cache
+        if ms.shared_cache is None:
+            ms.shared_cache = SharedCache(
+                os.path.join(fx.tmpdir, 'shared'), slots=4 * count,
+                slot_size=16384)
+            for _id in ids:
+                ms.cache.pop(_id, None)
+                ms.get(id=_id)
+
+        def op(i):
+            ms.cache.pop(ids[i % count], None)
+            ms.get(id=ids[i % count])
+    elif name == 'find':
+        def op(i):
+            for _ in ms.find(limit=FIND_LIMIT):
+                pass
+    elif name == 'save':
+        def op(i):
+            mdocs[i % count].save()
+    elif name == 'validate':
+        docs = [dict(x.doc) for x in mdocs]
+
+        def op(i):
+            ms._validate(docs[i % count])
+    elif name == 'fromdb':
+        # _fromdb changes the doc it's given, each op gets its own
+        raws = fx.raw_docs(fx.ops + WARMUP_OPS)
+
+        def op(i):
+            ms._fromdb(raws.pop())
+    elif name == 'to_dict':
+        def op(i):
+            mdocs[i % count].to_dict()
+    elif name == 'to_json':
+        def op(i):
+            to_json(mdocs[i % count])
+    elif name == 'flask_get':
+        paths = [ms.doc_path_for(oid=x) for x in ids]
+
+        def op(i):
+            resp = fx.client.get(paths[i % count])
+            assert resp.status_code == 200, resp.status_code
+    elif name == 'flask_list':
+        path = '%s?limit=%d' % (ms.path_for('list'), FIND_LIMIT)
+
+        def op(i):
+            resp = fx.client.get(path)
+            assert resp.status_code == 200, resp.status_code
+    return op
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _no_prepare(i):
+    pass
+
+
+def _run_case(name, fx, ops, alloc_ops):
+    op = _case(name, fx)
+    prepare = getattr(op, 'prepare', _no_prepare)
+    # warm up caches, lazy imports...
+    for i in range(min(ops, WARMUP_OPS)):
+        prepare(i)
+        op(i)
+    timings = []
+    clock = time.perf_counter_ns
+    for i in range(ops):
+        prepare(i)
+        before = clock()
+        op(i)
+        timings.append(clock() - before)
+    elapsed = sum(timings) / 1e9
+    timings.sort()
+    peak = 0
+    op = _case(name, fx)
+    prepare = getattr(op, 'prepare', _no_prepare)
+    tracemalloc.start()
+    for i in range(alloc_ops):
+        prepare(i)
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        op(i)
+        peak += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return {
+        'case': name,
+        'ops': ops,
+        'ops_per_sec': round(ops / elapsed, 1),
+        'p50_us': round(_percentile(timings, .5) / 1e3, 2),
+        'p99_us': round(_percentile(timings, .99) / 1e3, 2),
+        'alloc_bytes_per_op': round(peak / float(max(alloc_ops, 1))),
+    }
+
+
+def _flask_client(schemas):
+    try:
+        from flask import Flask
+    except ImportError:
+        return None
+    app = Flask('benchmarks')
+    register_flask_app(app, '/bench')
+    for ms in schemas:
+        ms.doc_route('get')
+        ms.static_route('list')
+    return app.test_client()
+
+
+def _backends(args):
+    if args.backend in ('memory', 'all'):
+        yield 'memory', lambda name: InMemoryCollection(name, 'bench')
+    if args.backend in ('mongodb', 'all'):
+        import pymongo
+        client = pymongo.MongoClient(args.uri)
+        db = client[args.db]
+        client.drop_database(args.db)
+        yield 'mongodb', lambda name: db[name]
+        client.drop_database(args.db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backend', default='memory',
+                        choices=('memory', 'mongodb', 'all'))
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--db', default='mongoschema_benchmarks')
+    parser.add_argument('--shape', action='append', choices=SHAPES)
+    parser.add_argument('--case', action='append', choices=CASES)
+    parser.add_argument('--docs', type=int, default=500,
+                        help='docs in the collection before each case')
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--alloc-ops', type=int, default=200)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+    results = []
+    for backend, make_collection in _backends(args):
+        shapes, schemas = _define(backend.capitalize(), make_collection)
+        client = _flask_client(schemas[1:])
+        for shape in args.shape or SHAPES:
+            ms, make_doc = shapes[shape]
+            for name in args.case or CASES:
+                if name.startswith('flask') and client is None:
+                    continue
+                for each in schemas:
+                    each.collection.delete_many({})
+                    each.clear_cache_and_init()
+                fx = Fixture(ms, make_doc, args.docs, args.ops, client)
+                try:
+                    result = _run_case(name, fx, args.ops, args.alloc_ops)
+                finally:
+                    fx.close()
+                result.update({'backend': backend, 'shape': shape})
+                results.append(result)
+                print('%-8s %-8s %-13s %10.1f ops/s  p50 %8.2fus  '
+                      'p99 %8.2fus' % (
+                          backend, shape, name, result['ops_per_sec'],
+                          result['p50_us'], result['p99_us']),
+                      file=sys.stderr)
+    output = {
+        'benchmark': 'suite',
+        'created': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'bson_c_extension': bson.has_c(),
+        'docs': args.docs,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
 from .base import (
     MongoField, MongoSchema, MongoDoc, ValidationError, flaskprep,
-    register_flask_app, set_api_prefix, AuthError,
+    register_flask_app, set_api_prefix, AuthError, monthly_partition,
+    hash_partition, to_json, register_batch_route, set_metrics_sink,
+    register_metrics_route, set_index_mode, set_cache_budget,
 )
+from .hooks import (
+    on_query, on_write, on_cache_hit, on_cache_miss, remove_listener,
+)
+from .arrays import ArrayField
+from .blobs import LargeBlob, FileStore, GridFSStore
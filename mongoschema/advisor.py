@@ -0,0 +1,228 @@
+# from this project
+from . import hooks
+
+# operators that make a field a range (not equality) condition
+EQUALITY_OPERATORS = ('$eq', '$in')
+
+# the filter of these operations is the doc's _id, always indexed
+_ID_OPERATIONS = ('insert', 'update', 'update_single_field', 'unset',
+                  'reload')
+
+
+def _query_fields(query):
+    """
+    (equality fields, range fields) of a query. The branches of an $or
+    are left out, they need an index each.
+    """
+    equality, ranges = set(), set()
+    for key, value in query.items():
+        if key == '$and':
+            for sub in value:
+                sub_equality, sub_ranges = _query_fields(sub)
+                equality |= sub_equality
+                ranges |= sub_ranges
+        elif key.startswith('$'):
+            continue
+        elif type(value) is dict and value and \
+                all(x.startswith('$') for x in value):
+            if all(x in EQUALITY_OPERATORS for x in value):
+                equality.add(key)
+            else:
+                ranges.add(key)
+        else:
+            equality.add(key)
+    return equality, ranges - equality
+
+
+def _sort_fields(sort):
+    if not sort:
+        return ()
+    if isinstance(sort[0], str):
+        return ((sort[0], sort[1] if len(sort) > 1 else 1),)
+    return tuple((key, direction) for key, direction in sort[0])
+
+
+def _index_fields(index):
+    """
+    The field names of an index as given in the indexes list
+    """
+    if isinstance(index, str):
+        return [index]
+    return [x[0] if isinstance(x, (list, tuple)) else x for x in index]
+
+
+def _suggested_index(shape):
+    """
+    An indexes entry for shape: equality fields, then the sort, then the
+    range fields
+    """
+    equality, sort, ranges = shape
+    keys = [(x, 1) for x in equality]
+    for key, direction in sort:
+        if key not in equality:
+            keys.append((key, direction))
+    sorted_keys = set(x for x, _ in keys)
+    keys += [(x, 1) for x in ranges if x not in sorted_keys]
+    if len(keys) == 1 and keys[0][1] == 1:
+        return keys[0][0]
+    return [tuple(keys), {}]
+
+
+def _plan_stages(plan):
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            for stage in _plan_stages(plan[key]):
+                yield stage
+    for sub in plan.get('inputStages', []):
+        for stage in _plan_stages(sub):
+            yield stage
+
+
+class QueryShape(object):
+    """
+    Everything the advisor knows about one shape of query on a schema
+    """
+
+    def __init__(self, equality, sort, ranges):
+        self.equality = equality
+        self.sort = sort
+        self.ranges = ranges
+        self.seen = 0
+        self.operations = set()
+        self.problem = None
+
+    @property
+    def key(self):
+        return (self.equality, self.sort, self.ranges)
+
+    def describe(self):
+        parts = []
+        if self.equality:
+            parts.append('equality on %s' % ', '.join(self.equality))
+        if self.ranges:
+            parts.append('range on %s' % ', '.join(self.ranges))
+        if self.sort:
+            parts.append('sort by %s' % ', '.join(
+                '%s %s' % x for x in self.sort))
+        return '; '.join(parts)
+
+
+class IndexAdvisor(object):
+    """
+    Opt-in listener recording the shape (equality fields, range fields
+    and sort) of every filter each schema sends, and checking it against
+    the schema's indexes:
+
+        advisor = IndexAdvisor(explain=True).listen()
+        ... exercise the app ...
+        print(advisor.report())
+
+    With explain=True (meant for development) the first query of every
+    shape is explained, flagging collection scans and plans examining
+    more than max_examined_ratio docs per doc returned.
+    """
+
+    def __init__(self, explain=False, max_examined_ratio=10):
+        self.explain = explain
+        self.max_examined_ratio = max_examined_ratio
+        self.shapes = {}
+
+    def listen(self):
+        hooks.on_query(self)
+        hooks.on_write(self)
+        return self
+
+    def stop(self):
+        hooks.remove_listener(self)
+
+    def __call__(self, event):
+        if event.operation in _ID_OPERATIONS or not event.query:
+            return
+        equality, ranges = _query_fields(event.query)
+        sort = _sort_fields(event.sort)
+        if not equality and not ranges and not sort:
+            return
+        key = (tuple(sorted(equality)), sort, tuple(sorted(ranges)))
+        shapes = self.shapes.setdefault(event.ms, {})
+        shape = shapes.get(key)
+        if shape is None:
+            shape = shapes[key] = QueryShape(*key)
+            if self.explain and event.collection is not None:
+                shape.problem = self._explain(event)
+        shape.seen += 1
+        shape.operations.add(event.operation)
+
+    def _explain(self, event):
+        cursor = event.collection.find(event.query)
+        if event.sort:
+            cursor.sort(list(_sort_fields(event.sort)))
+        explained = cursor.explain()
+        stages = set(_plan_stages(explained['queryPlanner']['winningPlan']))
+        if 'COLLSCAN' in stages:
+            return 'COLLSCAN'
+        stats = explained.get('executionStats', {})
+        examined = stats.get('totalDocsExamined', 0)
+        returned = stats.get('nReturned', 0)
+        if examined > self.max_examined_ratio * max(returned, 1):
+            return 'examined %s docs for %s' % (examined, returned)
+        if 'SORT' in stages:
+            return 'in memory sort'
+        return None
+
+    @staticmethod
+    def _is_indexed(ms, shape):
+        """
+        If one of the schema's indexes starts with all the equality
+        fields followed by the sort fields (or, with neither, with one of
+        the range fields)
+        """
+        wanted = set(shape.equality)
+        sort = [x for x, _ in shape.sort if x not in wanted]
+        indexes = [['_id']] + [_index_fields(index)
+                               for index, _ in ms._index_args()]
+        for fields in indexes:
+            if set(fields[:len(wanted)]) != wanted:
+                continue
+            if fields[len(wanted):len(wanted) + len(sort)] != sort:
+                continue
+            if wanted or sort or fields[0] in shape.ranges:
+                return True
+        return False
+
+    def suggestions(self):
+        """
+        {schema: [indexes entries]} for the shapes that aren't indexed
+        or had a bad plan
+        """
+        suggested = {}
+        for ms, shapes in self.shapes.items():
+            for shape in shapes.values():
+                if shape.problem or not self._is_indexed(ms, shape):
+                    index = _suggested_index(shape.key)
+                    entries = suggested.setdefault(ms, [])
+                    if index not in entries:
+                        entries.append(index)
+        return suggested
+
+    def report(self):
+        lines = []
+        suggested = self.suggestions()
+        for ms in sorted(self.shapes, key=lambda x: x.__name__):
+            lines.append('%s (%s)' % (ms.__name__, ms.collection.full_name))
+            for shape in sorted(self.shapes[ms].values(),
+                                key=lambda x: -x.seen):
+                if shape.problem:
+                    status = shape.problem
+                elif self._is_indexed(ms, shape):
+                    status = 'ok'
+                else:
+                    status = 'no index'
+                lines.append('  %s: %s x%s (%s)' % (
+                    status, shape.describe(), shape.seen,
+                    ', '.join(sorted(shape.operations))))
+            if ms in suggested:
+                lines.append('  suggested indexes:')
+                for index in suggested[ms]:
+                    lines.append('    %r,' % (index,))
+        return '\n'.join(lines)
@@ -0,0 +1,438 @@
+# python core
+import asyncio
+import functools
+
+# from this project
+from .base import (
+    MongoSchema, MongoDoc, MongoDocRefList, NoValue, LIST_TYPES,
+)
+from . import hooks, metrics
+
+
+_EXHAUSTED = object()
+
+
+def _blocking_only(name):
+    """
+    A classmethod of MongoSchema that needs a blocking collection, which
+    an AsyncMongoSchema doesn't have
+    """
+    def blocking_only(cls, *args, **kwargs):
+        raise TypeError('%s.%s() is not supported by AsyncMongoSchema, it '
+                        'needs a blocking collection' % (cls.__name__, name))
+    blocking_only.__name__ = name
+    return classmethod(blocking_only)
+
+
+class AsyncCursor(object):
+    """
+    Wraps a blocking cursor so it can be used with async for, like a
+    Motor cursor.
+    """
+
+    def __init__(self, cursor, run):
+        self.cursor = cursor
+        self._run = run
+
+    def sort(self, *args, **kwargs):
+        self.cursor.sort(*args, **kwargs)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # StopIteration can't travel through an executor future
+        doc = await self._run(next, self.cursor, _EXHAUSTED)
+        if doc is _EXHAUSTED:
+            raise StopAsyncIteration
+        return doc
+
+    async def to_list(self, length=None):
+        docs = []
+        async for doc in self:
+            docs.append(doc)
+            if length and len(docs) >= length:
+                break
+        return docs
+
+
+class AsyncCollection(object):
+    """
+    Gives a blocking pymongo style collection the same awaitable
+    interface as a Motor collection so it can be used as the collection
+    of an AsyncMongoSchema. With threaded=True every call is run in the
+    default executor, otherwise they are run inline, which is what you
+    want for an in-memory collection in tests.
+    """
+
+    def __init__(self, collection, threaded=False):
+        self.collection = collection
+        self.threaded = threaded
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    @property
+    def full_name(self):
+        return self.collection.full_name
+
+    @property
+    def database(self):
+        return self.collection.database
+
+    async def _run(self, func, *args, **kwargs):
+        if not self.threaded:
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(func, *args, **kwargs))
+
+    def find(self, *args, **kwargs):
+        return AsyncCursor(self.collection.find(*args, **kwargs), self._run)
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run(self.collection.find_one, *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run(self.collection.insert_one, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run(self.collection.update_one, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run(self.collection.delete_one, *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs):
+        return await self._run(
+            self.collection.count_documents, *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs):
+        return await self._run(self.collection.create_index, *args, **kwargs)
+
+
+class AsyncMongoDoc(MongoDoc):
+    """
+    The doc_class of AsyncMongoSchema. Everything that goes to the db is a
+    coroutine, and docs referenced through other AsyncMongoSchema classes
+    must be loaded with resolve() (or already be cached) before they can
+    be read as attributes.
+    """
+    _refs = None
+
+    def __init__(self, doc, ms):
+        super(AsyncMongoDoc, self).__init__(doc, ms)
+        object.__setattr__(self, '_refs', {})
+
+    def _ref_type(self, key):
+        """
+        (schema, is_list) if key references an AsyncMongoSchema
+        """
+        mf = self.ms.schema[key]
+        is_list = type(mf) in LIST_TYPES
+        if is_list:
+            mf = mf[0]
+        elif type(mf) is dict:
+            return None, False
+        if issubclass(mf.type, AsyncMongoSchema):
+            return mf.type, is_list
+        return None, False
+
+    def __getattr__(self, key):
+        ref_type, is_list = self._ref_type(key)
+        if ref_type is None:
+            return super(AsyncMongoDoc, self).__getattr__(key)
+        if key in self._refs:
+            return self._refs[key]
+        if key not in self.doc:
+            return NoValue()
+        if ref_type.cache_enabled:
+            if is_list and all(x in ref_type.cache for x in self.doc[key]):
+                return MongoDocRefList(
+                    [ref_type.cache[x] for x in self.doc[key]],
+                    self.doc[key])
+            elif not is_list and self.doc[key] in ref_type.cache:
+                return ref_type.cache[self.doc[key]]
+        raise ValueError(
+            '%s.%s is not loaded, use "await doc.resolve()" first' % (
+                self.ms.__name__, key))
+
+    def __setattr__(self, key, value):
+        if self._refs:
+            self._refs.pop(key, None)
+        super(AsyncMongoDoc, self).__setattr__(key, value)
+
+    def __delitem__(self, key):
+        raise TypeError('Use "await doc.unset(key)" instead')
+
+    async def resolve(self, *keys):
+        """
+        Load the docs referenced by keys (every reference by default)
+        concurrently so they can be used as attributes afterwards.
+        """
+        keys = keys or [x for x in self.ms.schema if self._ref_type(x)[0]]
+        loading, coros = [], []
+        for key in keys:
+            ref_type, is_list = self._ref_type(key)
+            if ref_type is None or key not in self.doc:
+                continue
+            if is_list:
+                coros.append(ref_type.get_many(self.doc[key]))
+            else:
+                coros.append(ref_type.get(id=self.doc[key]))
+            loading.append((key, is_list))
+        results = await asyncio.gather(*coros)
+        for (key, is_list), result in zip(loading, results):
+            if is_list:
+                result = MongoDocRefList(result, self.doc[key])
+            self._refs[key] = result
+        return self
+
+    async def save(self):
+        await self.ms._writedoc(self.doc, 'update')
+        return self
+
+    async def update(self, raw_dict=None, **kwargs):
+        if raw_dict is None:
+            raw_dict = kwargs
+        for key in raw_dict:
+            self.ms.schema[key]
+            if key == 'id' and str(raw_dict[key]) == str(self.id):
+                continue
+            self.__setattr__(key, raw_dict[key])
+        return await self.save()
+
+    async def remove(self):
+        await self.ms.remove(id=self.id)
+
+    async def unset(self, key):
+        del self.doc[key]
+        q, up = {'_id': self.id}, {'$unset': {key: True}}
+        collection = self.ms.collection
+        metrics.count_db_op()
+        started = hooks.start('write')
+        await collection.update_one(q, up)
+        hooks.done('write', started, self.ms, collection, 'unset', q,
+                   count=1)
+        self.ms._doc_changed(self.id)
+
+    async def reload(self):
+        collection = self.ms.collection
+        metrics.count_db_op()
+        started = hooks.start('query')
+        doc = await collection.find_one({'_id': self.id})
+        hooks.done('query', started, self.ms, collection, 'reload',
+                   {'_id': self.id}, [doc] if doc else ())
+        mdoc = self.ms._fromdb(doc)
+        self.doc = mdoc.doc
+        self._etag = None
+        self._refs.clear()
+
+    async def update_single_field(self, key, value):
+        self.__setattr__(key, value)
+        q = {'_id': self.id}
+        up = {'$set': {key: self.ms._compress_field(key, self.doc[key])}}
+        collection = self.ms.collection
+        metrics.count_db_op()
+        started = hooks.start('write')
+        await collection.update_one(q, up)
+        hooks.done('write', started, self.ms, collection,
+                   'update_single_field', q, [up])
+        self.ms._doc_changed(self.id)
+
+
+class AsyncMongoSchema(MongoSchema):
+    """
+    asyncio flavour of MongoSchema. Schemas, validation and conversion
+    to and from the db are exactly the same, only the collection must be
+    awaitable: a Motor collection, or any blocking one wrapped in
+    AsyncCollection.
+
+        class User(AsyncMongoSchema):
+            collection = motor_db.user
+            schema = {'username': MF(str)}
+
+        await User.ensure_indexes()
+        user = await User.create(username='sam')
+        async for user in User.find():
+            ...
+    """
+    abstract = True
+    doc_class = AsyncMongoDoc
+
+    # everything going through _find_raw, or flask calling the schema,
+    # is blocking
+    _find_raw = _blocking_only('_find_raw')
+    warm_cache = _blocking_only('warm_cache')
+    parallel_scan = _blocking_only('parallel_scan')
+    migrate = _blocking_only('migrate')
+    export = _blocking_only('export')
+    import_ = _blocking_only('import_')
+    to_columns = _blocking_only('to_columns')
+    doc_route = _blocking_only('doc_route')
+    static_route = _blocking_only('static_route')
+
+    @classmethod
+    def _blob_keys(cls):
+        keys = super(AsyncMongoSchema, cls)._blob_keys()
+        if keys:
+            # the blob stores, their uploads and cleanup are blocking
+            raise TypeError('AsyncMongoSchema does not support LargeBlob '
+                            'fields (%s.%s)' % (cls.__name__, keys[0]))
+        return keys
+
+    @classmethod
+    def _deref_if_needed(cls, mf, value):
+        # before anything gets uploaded
+        cls._blob_keys()
+        return super(AsyncMongoSchema, cls)._deref_if_needed(mf, value)
+
+    @classmethod
+    def _fromdb(cls, doc):
+        cls._blob_keys()
+        return super(AsyncMongoSchema, cls)._fromdb(doc)
+
+    @classmethod
+    def _index_collections(cls):
+        # nothing can be awaited while the class is being defined (or on
+        # first use), the indexes are created by ensure_indexes()
+        if cls.partition_by:
+            raise ValueError('AsyncMongoSchema does not support partition_by')
+        return []
+
+    @classmethod
+    async def ensure_indexes(cls):
+        await asyncio.gather(*[
+            cls.collection.create_index(index, **ikwargs)
+            for index, ikwargs in cls._index_args()])
+
+    @classmethod
+    async def _writedoc(cls, doc, insert_or_save):
+        cls._blob_keys()
+        doc = cls._prepwrite(doc)
+        collection = cls.collection
+        metrics.count_db_op()
+        started = hooks.start('write')
+        if insert_or_save == 'insert':
+            await collection.insert_one(doc)
+            hooks.done('write', started, cls, collection, 'insert', {},
+                       [doc])
+        elif insert_or_save == 'update':
+            docid = doc['_id']
+            del doc['_id']
+            await collection.update_one({'_id': docid}, {'$set': doc})
+            hooks.done('write', started, cls, collection, 'update',
+                       {'_id': docid}, [doc])
+            cls._doc_changed(docid)
+            doc['_id'] = docid
+        else:
+            raise ValueError('expected "insert" or "save"')
+        cls._fromdb(doc)
+        return doc
+
+    @classmethod
+    async def create(cls, **doc):
+        cls._fill_defaults(doc)
+        cls._basic_schema_validation(doc)
+        cls._fix_references(doc)
+        doc = await cls._writedoc(doc, 'insert')
+        mdoc = cls._new_doc(doc)
+        if cls.cache_enabled:
+            return cls.add_to_cache(mdoc)
+        else:
+            return mdoc
+
+    @classmethod
+    async def get(cls, **kwargs):
+        cls._mongodoc_to_id(kwargs)
+        mdoc = cls._get_cached(kwargs)
+        if mdoc is not None:
+            return mdoc
+        cls._fordb_fix_id(kwargs, forquery=True)
+        doc = cls._get_shared(kwargs)
+        if doc is None:
+            tokens = cls._shared_tokens(kwargs)
+            collection = cls.collection
+            metrics.count_db_op()
+            started = hooks.start('query')
+            doc = await collection.find_one(kwargs)
+            hooks.done('query', started, cls, collection, 'get', kwargs,
+                       [doc] if doc else ())
+            if doc:
+                cls._set_shared(doc, tokens)
+        if not doc:
+            return None
+        return cls._cache_fetched(doc)
+
+    @classmethod
+    async def get_many(cls, ids):
+        ids = [cls._db_id(_id) for _id in ids]
+        found, missing = cls._ids_for_get_many(ids)
+        if missing:
+            query = {'_id': {'$in': missing}}
+            tokens = cls._shared_tokens(query)
+            async for doc in cls._find_async(query, operation='get_many'):
+                cls._set_shared(doc, tokens)
+                _id = doc['_id']
+                found[_id] = cls._cache_fetched(doc)
+        return [found.get(_id) for _id in ids]
+
+    @classmethod
+    def _find_async(cls, query, sort=None, limit=0, operation='find',
+                    **kwargs):
+        """
+        The _find_raw of an AsyncMongoSchema, to iterate with async for
+        """
+        collection = cls.collection
+        metrics.count_db_op()
+        started = hooks.start('query')
+        docs = collection.find(query, limit=limit, **kwargs)
+        if sort:
+            docs.sort(*sort)
+        if started is not None:
+            docs = hooks.observe_async_cursor(
+                docs, started, cls, collection, operation, query, sort)
+        return docs
+
+    @classmethod
+    async def find(cls, sort=None, limit=0, **kwargs):
+        cls._mongodoc_to_id(kwargs)
+        async for doc in cls._find_async(kwargs, sort=sort, limit=limit):
+            yield cls._fromdb(doc)
+
+    @classmethod
+    async def count(cls, **kwargs):
+        cls._mongodoc_to_id(kwargs)
+        collection = cls.collection
+        metrics.count_db_op()
+        started = hooks.start('query')
+        count = await collection.count_documents(kwargs)
+        hooks.done('query', started, cls, collection, 'count', kwargs,
+                   count=count)
+        return count
+
+    @classmethod
+    async def list(cls, sort=None, **kwargs):
+        return [x async for x in cls.find(sort=sort, **kwargs)]
+
+    @classmethod
+    async def remove(cls, **kwargs):
+        cls._blob_keys()
+        if '_id' not in kwargs and 'id' in kwargs:
+            kwargs['_id'] = kwargs['id']
+            del kwargs['id']
+        collection = cls.collection
+        metrics.count_db_op()
+        started = hooks.start('write')
+        removed = 0
+        docs = collection.find(kwargs, projection={'_id': True})
+        async for doc in docs:
+            metrics.count_db_op()
+            await collection.delete_one(doc)
+            removed += 1
+            cls._doc_changed(doc['_id'])
+            if cls.cache_enabled:
+                cls._remove_from_cache(doc['_id'])
+        hooks.done('write', started, cls, collection, 'remove', kwargs,
+                   count=removed)
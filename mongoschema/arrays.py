@@ -0,0 +1,189 @@
+"""
+Fields of numeric arrays (embeddings, time series...) stored packed in a
+BSON Binary instead of as a list of numbers:
+
+    class Item(MongoSchema):
+        schema = {
+            'name': MF(str),
+            'embedding': MF(ArrayField(dtype='float32', shape=(768,))),
+        }
+
+An array is a few times smaller than the list, and nothing is decoded
+per element: reading item.embedding gives a memoryview over the bytes
+of the stored Binary, or a numpy array over them when numpy is
+installed, without copying. They are read-only, assign a new array to
+change one. Anything with the buffer protocol (numpy arrays,
+array.array, memoryviews) or a (nested) list can be assigned, and
+validation only checks the dtype and the shape. Values are little-endian
+whatever the machine.
+"""
+# python core
+import sys
+import array
+import struct
+import functools
+import operator
+
+# 3rd party
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+# from this project
+from . import base
+
+# the Binary subtype of packed arrays
+SUBTYPE = USER_DEFINED_SUBTYPE
+
+# struct/array/memoryview formats of the dtypes
+FORMATS = {
+    'int8': 'b', 'uint8': 'B', 'int16': 'h', 'uint16': 'H',
+    'int32': 'i', 'uint32': 'I', 'int64': 'q', 'uint64': 'Q',
+    'float32': 'f', 'float64': 'd',
+}
+
+LITTLE_ENDIAN = sys.byteorder == 'little'
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    # remembered, looking for a missing module again on every read is slow
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _flatten(value):
+    for x in value:
+        if isinstance(x, base.LIST_TYPES):
+            for y in _flatten(x):
+                yield y
+        else:
+            yield x
+
+
+def _list_shape(value):
+    """
+    The shape of a (nested) list, None if its rows aren't all the same
+    """
+    if not isinstance(value, base.LIST_TYPES):
+        return ()
+    shapes = set(_list_shape(x) for x in value)
+    if None in shapes or len(shapes) > 1:
+        return None
+    return (len(value),) + (shapes.pop() if shapes else ())
+
+
+class ArrayField(type):
+    """
+    ArrayField(dtype, shape) makes the type of a MongoField (it's a
+    metaclass). shape is a tuple of ints (or an int), the first one may
+    be None for any number of rows. Without a shape an array can have
+    any length and reads back flat. isinstance(value, array_field) is
+    what _validate checks: a packed Binary of a size that fits the shape.
+    """
+
+    def __new__(mcs, dtype='float64', shape=None):
+        if dtype not in FORMATS:
+            raise ValueError('dtype must be one of %s' % sorted(FORMATS))
+        if isinstance(shape, int):
+            shape = (shape,)
+        elif shape is not None:
+            shape = tuple(shape)
+        name = 'ArrayField(%s, %s)' % (dtype, shape)
+        return super(ArrayField, mcs).__new__(mcs, name, (object,), {
+            'dtype': dtype,
+            'shape': shape,
+            'format': FORMATS[dtype],
+            'itemsize': struct.calcsize(FORMATS[dtype]),
+        })
+
+    def __init__(cls, dtype='float64', shape=None):
+        super(ArrayField, cls).__init__(cls.__name__, (object,), {})
+
+    def _shape_for(cls, nbytes):
+        """
+        The shape of an array of nbytes bytes, or None if it can't have
+        that many
+        """
+        count, rest = divmod(nbytes, cls.itemsize)
+        if rest:
+            return None
+        if cls.shape is None:
+            return (count,)
+        fixed = functools.reduce(operator.mul,
+                                 [x for x in cls.shape if x is not None], 1)
+        if cls.shape[0] is None:
+            if not fixed or count % fixed:
+                return None
+            return (count // fixed,) + cls.shape[1:]
+        return cls.shape if count == fixed else None
+
+    def _check_list_shape(cls, value):
+        """
+        Lists have to be nested like the shape, as numpy arrays have to
+        have it
+        """
+        shape = _list_shape(value)
+        if shape is None or len(shape) != len(cls.shape) or any(
+                x is not None and x != y for x, y in zip(cls.shape, shape)):
+            raise base.ValidationError(
+                'expected %s, got a list of shape %s' % (cls.__name__, shape))
+
+    def __instancecheck__(cls, value):
+        return isinstance(value, Binary) and value.subtype == SUBTYPE and \
+            cls._shape_for(len(value)) is not None
+
+    def pack(cls, value, ms=None):
+        """
+        value as the Binary it's stored as
+        """
+        if isinstance(value, Binary):
+            packed = value
+        elif hasattr(value, '__array_interface__'):
+            # a numpy array (or something numpy can make one of)
+            numpy = _numpy()
+            value = numpy.ascontiguousarray(value, dtype='<' + cls.format)
+            packed = Binary(value.tobytes(), SUBTYPE)
+            if cls.shape is not None and \
+                    value.shape != cls._shape_for(len(packed)):
+                raise base.ValidationError('expected %s, got shape %s' % (
+                    cls.__name__, value.shape))
+        else:
+            try:
+                view = memoryview(value)
+            except TypeError:
+                view = None
+            if view is not None and view.format == cls.format:
+                data = array.array(cls.format)
+                data.frombytes(view.tobytes())
+            else:
+                if isinstance(value, base.LIST_TYPES) and \
+                        cls.shape is not None:
+                    cls._check_list_shape(value)
+                data = array.array(cls.format, _flatten(value))
+            if not LITTLE_ENDIAN:
+                data.byteswap()
+            packed = Binary(data.tobytes(), SUBTYPE)
+        if not isinstance(packed, cls):
+            raise base.ValidationError(
+                'expected %s, got %d bytes' % (cls.__name__, len(packed)))
+        return packed
+
+    def unpack(cls, value, ms=None):
+        """
+        A read-only view (numpy array or memoryview) of the stored value
+        """
+        shape = cls._shape_for(len(value))
+        numpy = _numpy()
+        if numpy is not None:
+            return numpy.frombuffer(
+                value, dtype='<' + cls.format).reshape(shape)
+        if not LITTLE_ENDIAN:
+            data = array.array(cls.format, value)
+            data.byteswap()
+            value = data.tobytes()
+        return memoryview(value).cast(cls.format, shape)
+
+    def jsonable(cls, value):
+        return cls.unpack(value).tolist()
@@ -1,29 +1,64 @@
 # python core
+import os
+import sys
 import datetime
+import re
 import time
 import json
+import zlib
+import heapq
+import itertools
 import copy
+import mmap
+import queue
+import hashlib
+import struct
+import threading
+import functools
+import importlib
 
 # 3rd party
 from bson.objectid import ObjectId
 import bson
 
-try:
-    from flask import request, Response, session
-except:
-    request = None
+# from this project
+from . import cachestats, compression, hooks, metrics
 
 LIST_TYPES = (list, tuple)
 
+# how many docs go in each chunk of a streamed JSON array
+STREAM_CHUNK_SIZE = 100
+
+# types json can encode without any help
+JSON_NATIVE_TYPES = (str, int, float, bool, type(None))
+
 DICT_KEY_REPLACEMENTS = (
     ('$', '&dollar;'),
     ('.', '&period;')
 )
 
+# where docs written by a schema with a schema_version record it
+SCHEMA_VERSION_KEY = '_sv'
+
+# the partitions of a schema are listed again after that many seconds,
+# to find the ones other processes created
+PARTITION_LIST_TTL = 60
+
+# the collection name suffixes a partition_by function without a pattern
+# attribute is assumed to give
+DEFAULT_PARTITION_PATTERN = r'[^.]+'
+
 
 FLASK_APP = None
 API_PREFIX = None
 RESPONSE_FUNC = None
+METRICS_SINK = None
+
+# when schemas create their indexes: 'eager' (when the class is defined),
+# 'lazy' (the first time the class goes to the db) or 'manual' (only with
+# MongoSchema.ensure_all_indexes())
+INDEX_MODES = ('eager', 'lazy', 'manual')
+INDEX_MODE = os.environ.get('MONGOSCHEMA_INDEX_MODE', 'eager')
 
 
 class AuthError(Exception):
@@ -47,6 +82,118 @@ def register_flask_app(app, prefix, response_func=None):
     set_api_prefix(prefix)
 
 
+def register_batch_route(path='/batch', **kwargs):
+    """
+    Opt-in route running several doc_route/static_route operations in one
+    request. It takes a POSTed JSON list of operations like
+
+        {"schema": "user", "oid": "...", "method": "get-username",
+         "params": {...}}
+
+    (no oid for a static route, "args" for the list route's url params)
+    and returns a list of {"status": ..., "body": ...} in the same order.
+    Only operations that have a route registered can be run, with that
+    route's auth and response functions. All the docs needed are fetched
+    with one get_many per schema.
+    """
+    if API_PREFIX:
+        path = API_PREFIX + path
+    flaskapi = _lazy('flaskapi')
+    FLASK_APP.add_url_rule(
+        path, 'mongoschema.batch',
+        flaskapi.timed_route('mongoschema.batch', flaskapi.batch_route),
+        methods=['POST'], **kwargs)
+
+
+def _lazy(name):
+    """
+    A module of the package only imported once it's needed: flaskapi (and
+    flask) once a route is registered, blobs, dump... by the schemas
+    using them
+    """
+    return importlib.import_module('.' + name, __package__)
+
+
+def set_metrics_sink(sink):
+    """
+    Time every phase (load, auth, handler, encode, total) of the generated
+    routes and count the database operations they issue, handing them to
+    sink.record() at the end of each request (a metrics.MemorySink or
+    anything with the same method). None turns it off.
+    """
+    global METRICS_SINK
+    METRICS_SINK = sink
+
+
+def register_metrics_route(path='/metrics', sink=None, **kwargs):
+    """
+    Serve the metrics of a MemorySink (the one given to set_metrics_sink
+    by default) in the Prometheus text format.
+    """
+    FLASK_APP.add_url_rule(path, 'mongoschema.metrics',
+                           _lazy('flaskapi').metrics_route(sink), **kwargs)
+
+
+def set_index_mode(mode):
+    """
+    The index_mode of the schemas defined from now on that don't set
+    their own
+    """
+    global INDEX_MODE
+    if mode not in INDEX_MODES:
+        raise ValueError('index mode must be one of %s' % (INDEX_MODES,))
+    INDEX_MODE = mode
+
+
+def set_cache_budget(max_bytes):
+    """
+    Cap the memory (BSON size) of the docs cached by all the schemas
+    together: going over it evicts the oldest docs of the schema that
+    was least recently hit. None removes the cap. Only the docs cached
+    after it's set are counted.
+    """
+    cachestats.set_budget(max_bytes)
+
+
+def _index_keys(index):
+    """
+    [(field, direction)] of an index as given in the indexes list
+    """
+    if isinstance(index, str):
+        return [(index, 1)]
+    return [tuple(x) if isinstance(x, LIST_TYPES) else (x, 1) for x in index]
+
+
+def _existing_index_keys(collection):
+    keys = []
+    for info in collection.index_information().values():
+        keys.append([(k, int(v) if type(v) is float else v)
+                     for k, v in info['key']])
+    return keys
+
+
+def _create_missing_indexes(collection, index_args):
+    """
+    Create the (index, kwargs) collection doesn't have yet with a single
+    create_indexes call. Returns the names of the new indexes.
+    """
+    index_args = list(index_args)
+    if not index_args:
+        return []
+    # pymongo is only imported by the (rare) calls that need it
+    from pymongo import IndexModel
+    existing = _existing_index_keys(collection)
+    models = []
+    for index, ikwargs in index_args:
+        keys = _index_keys(index)
+        if keys not in existing:
+            existing.append(keys)
+            models.append(IndexModel(keys, **ikwargs))
+    if not models:
+        return []
+    return collection.create_indexes(models)
+
+
 def set_api_prefix(prefix):
     global API_PREFIX
     API_PREFIX = prefix
@@ -65,8 +212,12 @@ def flaskprep(**prepargs):
     """
     def real_decorator(func):
         def wrapper(cls_or_self, **kwargs):
+            flask = sys.modules.get('flask')
+            if flask is None:
+                # flask was never imported so this can't be a request
+                return func(cls_or_self, **kwargs)
             try:
-                list(session.items())
+                list(flask.session.items())
             except RuntimeError:
                 # if we aren't in the context of a flask session,
                 # an exception will be thrown and we will end up here
@@ -78,20 +229,6 @@ def flaskprep(**prepargs):
     return real_decorator
 
 
-def _getparams():
-    """
-    This function must return a dictionary because all api calls to a
-    MongoDoc instance can only take **kwargs.
-    """
-    if request.method == 'GET':
-        params = {}
-        if request.args.get('json'):
-            params = json.loads(request.args['json'])
-    else:
-        params = request.get_json()
-    return params
-
-
 def _functionify(string):
     return string.replace('-', '_')
 
@@ -107,6 +244,58 @@ def _my_import(name):
     return mod
 
 
+def monthly_partition(value):
+    """
+    partition_by function putting docs in one collection per month of a
+    datetime field
+    """
+    return value.strftime('%Y%m')
+
+
+monthly_partition.pattern = r'\d{6}'
+
+
+def hash_partition(buckets):
+    """
+    Returns a partition_by function spreading docs over buckets
+    collections by a hash of the field (e.g. a tenant id)
+    """
+    def partition(value):
+        return str(zlib.crc32(str(value).encode()) % buckets)
+    partition.pattern = '|'.join(str(x) for x in range(buckets))
+    return partition
+
+
+def _sort_spec(sort):
+    """
+    The (key, direction) pairs of the sort args given to find()
+    """
+    if isinstance(sort[0], str):
+        return [(sort[0], sort[1] if len(sort) > 1 else 1)]
+    return list(sort[0])
+
+
+class _MergeKey(object):
+    """
+    Orders raw docs like a sort spec does, for merging sorted cursors
+    """
+
+    def __init__(self, spec, doc):
+        self.spec = spec
+        self.values = [doc.get(key) for key, _ in spec]
+
+    def __lt__(self, other):
+        for (_, direction), a, b in zip(self.spec, self.values, other.values):
+            if a == b:
+                continue
+            if a is None or b is None:
+                less = a is None
+            else:
+                less = a < b
+            return less if direction == 1 else not less
+        return False
+
+
 class MongoEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, ObjectId):
@@ -119,6 +308,153 @@ class MongoEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _put_until_stopped(q, msg, stop):
+    while not stop.is_set():
+        try:
+            q.put(msg, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _scan_partition(ms, partition, name, query, sort, fn, reduce, initial,
+                    results, progress, stop, progress_every, batch_size):
+    """
+    Runs one partition of MongoSchema.parallel_scan, in a thread or in
+    another process (which is why this isn't a classmethod and gets the
+    name of the collection rather than the collection itself).
+    """
+    count, acc = 0, initial
+    try:
+        collection = ms.collection.database[name]
+        docs = collection.find(query, batch_size=batch_size)
+        if sort:
+            docs.sort(sort, 1)
+        for doc in docs:
+            if stop.is_set():
+                return
+            value = ms._fromdb(doc)
+            if fn is not None:
+                value = fn(value)
+            if reduce is not None:
+                acc = reduce(acc, value)
+            else:
+                _put_until_stopped(results, ('result', partition, value), stop)
+            count += 1
+            if progress_every and count % progress_every == 0:
+                progress.put((partition, count, False))
+        progress.put((partition, count, True))
+        _put_until_stopped(results, ('done', partition, acc), stop)
+    except Exception as e:
+        _put_until_stopped(results, ('error', partition, e), stop)
+
+
+def _stream_json_array(items):
+    """
+    Yields the same JSON json.dumps(list(items)) would give, a few items
+    at a time, so a response can be streamed straight from a cursor.
+    """
+    yield '['
+    sep = ''
+    for chunk in iter(lambda: list(itertools.islice(items, STREAM_CHUNK_SIZE)),
+                      []):
+        yield sep + ', '.join(to_json(x) for x in chunk)
+        sep = ', '
+    yield ']'
+
+
+def _jsonable(obj):
+    """
+    obj with everything MongoEncoder would have converted already
+    converted, so it can go through json's C encoder without a default()
+    callback.
+    """
+    objtype = type(obj)
+    if objtype in JSON_NATIVE_TYPES:
+        return obj
+    elif objtype is dict:
+        return {k: _jsonable(v) for k, v in obj.items()}
+    elif objtype is list:
+        return [_jsonable(x) for x in obj]
+    elif objtype is ObjectId:
+        return str(obj)
+    elif isinstance(obj, MongoDoc):
+        return obj.ms._serialize(obj)
+    elif isinstance(obj, dict):
+        return {k: _jsonable(v) for k, v in obj.items()}
+    elif isinstance(obj, LIST_TYPES):
+        return [_jsonable(x) for x in obj]
+    elif isinstance(obj, ObjectId):
+        return str(obj)
+    elif isinstance(obj, datetime.datetime):
+        return time.mktime(obj.timetuple())
+    # anything else json can't handle raises in json.dumps, just like
+    # it does with MongoEncoder
+    return obj
+
+
+def to_json(obj):
+    """
+    Same output as json.dumps(obj, cls=MongoEncoder), only faster: every
+    MongoDoc is converted by a serializer compiled from its schema.
+    """
+    return json.dumps(_jsonable(obj))
+
+
+def _native_field(value):
+    if type(value) in JSON_NATIVE_TYPES:
+        return value
+    return _jsonable(value)
+
+
+def _objectid_field(value):
+    if type(value) is ObjectId:
+        return str(value)
+    return _jsonable(value)
+
+
+def _datetime_field(value):
+    if type(value) is datetime.datetime:
+        return time.mktime(value.timetuple())
+    return _jsonable(value)
+
+
+def _list_field(convert):
+    def convert_list(value):
+        if type(value) not in LIST_TYPES:
+            return _jsonable(value)
+        return [convert(x) for x in value]
+    return convert_list
+
+
+def _field_serializer(mf):
+    """
+    The function converting values of one schema entry for to_json
+    """
+    if type(mf) in LIST_TYPES:
+        return _list_field(_field_serializer(mf[0]))
+    elif not isinstance(mf, MongoField):
+        return _jsonable
+    elif mf.type is ObjectId or issubclass(mf.type, MongoSchema):
+        return _objectid_field
+    elif mf.type is datetime.datetime:
+        return _datetime_field
+    elif mf.type in JSON_NATIVE_TYPES:
+        return _native_field
+    elif mf.packed:
+        return mf.type.jsonable
+    return _jsonable
+
+
+def _compressed_field(convert):
+    def convert_compressed(value):
+        if compression.is_compressed(value):
+            value = MongoSchema._unfix_dict_keys(
+                compression.decompress(value))
+        return convert(value)
+    return convert_compressed
+
+
 class RequiredNotFoundException(Exception):
     pass
 
@@ -149,6 +485,57 @@ class NoValue(object):
     __nonzero__ = __bool__
 
 
+class _CacheSnapshot(object):
+    """
+    A memory-mapped cache snapshot written by MongoSchema.snapshot_cache.
+
+    The file is a BSON header document followed by the raw (as stored in
+    the db) BSON documents. The header holds the ids in file order so
+    nothing but the header has to be decoded when the snapshot is loaded,
+    the documents themselves are decoded on first access.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        self.header = self._decode_at(offset)
+        offset += self._length_at(offset)
+        self.offsets = {}
+        for _id in self.header['ids']:
+            self.offsets[_id] = offset
+            offset += self._length_at(offset)
+
+    def _length_at(self, offset):
+        return struct.unpack('<i', self._mmap[offset:offset + 4])[0]
+
+    def _decode_at(self, offset):
+        length = self._length_at(offset)
+        return bson.decode(self._mmap[offset:offset + length])
+
+    def __contains__(self, _id):
+        return _id in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def pop(self, _id):
+        """
+        Decode and forget a single raw doc. Returns None if it isn't here.
+        """
+        offset = self.offsets.pop(_id, None)
+        if offset is None:
+            return None
+        return self._decode_at(offset)
+
+    def discard(self, _id):
+        self.offsets.pop(_id, None)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
 class MongoDocRefList(list):
 
     def __init__(self, deref_list, reflist):
@@ -169,17 +556,21 @@ class MongoDocRefList(list):
 
 
 class MongoDoc(object):
-    doc = dict()
-    ms = None
+    # _etag is remembered by MongoSchema._doc_etag for cached docs
+    __slots__ = ('ms', 'doc', '_etag')
 
     def __init__(self, doc, ms):
         self.ms = ms
         self.doc = doc
+        self._etag = None
 
     def __getitem__(self, key):
         return self.__getattr__(key)
 
     def __getattr__(self, key):
+        if key in ('ms', 'doc', '_etag'):
+            # not set yet (copy, pickle...)
+            raise AttributeError(key)
         mf = self.ms.schema[key]
         if type(mf) in LIST_TYPES:
             if issubclass(mf[0].type, MongoSchema):
@@ -198,14 +589,32 @@ class MongoDoc(object):
                 return NoValue()
         elif not mf.required and key not in self.doc:
             return NoValue()
+        elif mf.packed:
+            return mf.type.unpack(self.doc[key], self.ms)
+        elif mf.compress:
+            return self._inflate(key)
         return self.doc[key]
 
+    def _inflate(self, key):
+        """
+        The value of a compressed field, decompressed (once) when it's
+        first needed
+        """
+        value = self.doc[key]
+        if compression.is_compressed(value):
+            value = self.ms._unfix_dict_keys(compression.decompress(value))
+            self.doc[key] = value
+        return value
+
     def __setattr__(self, key, value):
-        if key in ['ms', 'doc']:
+        if key in ['ms', 'doc', '_etag']:
             super(MongoDoc, self).__setattr__(key, value)
         elif key in self.ms.schema:
             mf = self.ms.schema[key]
-            self.doc[key] = MongoSchema._deref_if_needed(mf, value)
+            value = self.ms._deref_if_needed(mf, value)
+            self.ms._before_change(self.doc, key)
+            self.doc[key] = value
+            self._etag = None
         else:
             raise KeyError(key)
 
@@ -227,9 +636,20 @@ class MongoDoc(object):
         return self.id == other.id
 
     def __delitem__(self, key):
+        if self.ms.partition_by and key == self.ms.partition_by[0]:
+            raise ValidationError('%s.%s picks the partition, it can\'t be '
+                                  'unset' % (self.ms.__name__, key))
+        collection = self.ms._stored_collection(self.doc)
+        self.ms._before_change(self.doc, key)
         del self.doc[key]
         q, up = {'_id': self.id}, {'$unset': {key: True}}
-        self.ms.collection.update_one(q, up)
+        metrics.count_db_op()
+        started = hooks.start('write')
+        collection.update_one(q, up)
+        hooks.done('write', started, self.ms, collection, 'unset', q,
+                   count=1)
+        self.ms._doc_changed(self.id)
+        self.ms._drop_replaced_blobs(self.id)
 
     def save(self):
         self.ms._writedoc(self.doc, 'update')
@@ -238,9 +658,14 @@ class MongoDoc(object):
     def update(self, raw_dict=None, **kwargs):
         if raw_dict is None:
             raw_dict = kwargs
+        self.ms._check_blob_ids(raw_dict, self)
+        echoed = ['id'] + self.ms._blob_keys()
         for key in raw_dict:
             self.ms.schema[key]
-            self.doc[key] = raw_dict[key]
+            if key in echoed and str(raw_dict[key]) == str(self.doc.get(key)):
+                # echoed back from what the get route returned
+                continue
+            self.__setattr__(key, raw_dict[key])
         return self.save()
 
     def remove(self):
@@ -250,6 +675,9 @@ class MongoDoc(object):
         return str(self.__str__())
 
     def to_dict(self):
+        for key, _ in self.ms._compressed():
+            if key in self.doc:
+                self._inflate(key)
         if not self.ms.todict_follow_references:
             return copy.deepcopy(self.doc)
         else:
@@ -264,9 +692,22 @@ class MongoDoc(object):
         return copy_doc
 
     def reload(self):
-        doc = self.ms.collection.find_one({'_id': self.id})
+        collection = self.ms._stored_collection(self.doc)
+        metrics.count_db_op()
+        started = hooks.start('query')
+        doc = collection.find_one({'_id': self.id})
+        hooks.done('query', started, self.ms, collection, 'reload',
+                   {'_id': self.id}, [doc] if doc else ())
         mdoc = self.ms._fromdb(doc)
+        # blobs uploaded since the last save are dropped with the changes
+        unsaved = [self.doc[key] for key in self.ms._blob_keys()
+                   if self.doc.get(key) not in (None, mdoc.doc.get(key))]
         self.doc = mdoc.doc
+        self._etag = None
+        if self.ms.partition_by:
+            self.ms._moved_from.pop(self.id, None)
+        self.ms._replaced_blobs.pop(self.id, None)
+        self.ms._delete_blobs(unsaved)
 
     def update_single_field(self, key, value):
         """
@@ -274,9 +715,20 @@ class MongoDoc(object):
         have to call save() on the whole doc.
         """
         self.__setattr__(key, value)
+        if self.ms.partition_by and self.id in self.ms._moved_from:
+            # moving it to another partition takes the whole doc
+            self.save()
+            return
         q = {'_id': self.id}
-        up = {'$set': {key: value}}
-        self.ms.collection.update_one(q, up)
+        up = {'$set': {key: self.ms._compress_field(key, self.doc[key])}}
+        collection = self.ms._collection_for_doc(self.doc)
+        metrics.count_db_op()
+        started = hooks.start('write')
+        collection.update_one(q, up)
+        hooks.done('write', started, self.ms, collection,
+                   'update_single_field', q, [up])
+        self.ms._doc_changed(self.id)
+        self.ms._drop_replaced_blobs(self.id)
 
     @property
     def path_for(self):
@@ -287,7 +739,7 @@ class MongoField(object):
 
     def __init__(self, _type, default=NoDefault, default_func=None,
                  required=True, allowed_vals=None,
-                 validate_regexp=None):
+                 validate_regexp=None, compress=None, min_size=0):
         self._type = None
         if type(_type) is not str:
             self._type = _type
@@ -299,6 +751,14 @@ class MongoField(object):
         self.allowed_vals = allowed_vals
         self.validate_init()
         self.validate_regexp = validate_regexp
+        if compress is not None and compress not in compression.SUBTYPES:
+            raise ValueError('compress must be one of %s' % (
+                sorted(compression.SUBTYPES),))
+        # values are stored compressed (see compression.py), unless they
+        # are shorter than min_size bytes once BSON encoded
+        self.compress = compress
+        self.min_size = min_size
+        self._packed = None
 
     @property
     def type(self):
@@ -306,6 +766,18 @@ class MongoField(object):
             self._type = _my_import(self._import_string)
         return self._type
 
+    @property
+    def packed(self):
+        """
+        If values are stored in another form than they are read: types
+        like ArrayField have pack(value, ms) to turn what is assigned into
+        what is stored, unpack(stored, ms) for what __getattr__ returns and
+        jsonable(stored) for to_json
+        """
+        if self._packed is None:
+            self._packed = hasattr(self.type, 'unpack')
+        return self._packed
+
     def validate_init(self):
         allowed = self.allowed_vals
         if not allowed:
@@ -332,10 +804,20 @@ class MongoSchemaWatcher(type):
     a MongoSchema user, specifically for ensuring indexes and initializing
     the schema before anyone has a chance to use the class (was leading
     to strange errors)
+
+    Merging the superclass' schema (a deep copy) and indexes waits until
+    the class' schema or indexes are first used, so defining schemas that
+    a process never uses costs next to nothing.
     """
+    def __new__(mcs, name, bases, clsdict):
+        clsdict = dict(clsdict)
+        for attr in ('schema', 'indexes'):
+            if attr in clsdict:
+                clsdict['_declared_' + attr] = clsdict.pop(attr)
+        return super(MongoSchemaWatcher, mcs).__new__(
+            mcs, name, bases, clsdict)
+
     def __init__(cls, name, bases, clsdict):
-        # cls._ensureindexes()
-        # cls._initschema()
         if len(cls.__bases__) > 1:
             raise ValueError(
                 'MongoSchema does not support multiple inheritance yet')
@@ -344,12 +826,57 @@ class MongoSchemaWatcher(type):
             if superclass.abstract:
                 # Cant be abstract if your superclass is
                 cls.abstract = False
-            schema_copy = copy.deepcopy(superclass.schema)
-            cls.schema.update(schema_copy)
-            cls.indexes += superclass.indexes
         cls._init()
         super(MongoSchemaWatcher, cls).__init__(name, bases, clsdict)
 
+    def _prepare_schema(cls):
+        schema = cls.__dict__.get('_declared_schema')
+        indexes = cls.__dict__.get('_declared_indexes')
+        if cls.__name__ != 'MongoSchema':
+            superclass = cls.__bases__[0]
+            if schema is None:
+                schema = superclass.schema
+            else:
+                schema.update(copy.deepcopy(superclass.schema))
+            if indexes is None:
+                indexes = superclass.indexes
+            else:
+                indexes = indexes + superclass.indexes
+        cls._schema = schema
+        cls._indexes = indexes
+        if not cls.abstract:
+            cls._initschema()
+
+    @property
+    def schema(cls):
+        try:
+            return cls.__dict__['_schema']
+        except KeyError:
+            cls._prepare_schema()
+            return cls._schema
+
+    @schema.setter
+    def schema(cls, schema):
+        if '_schema' not in cls.__dict__:
+            cls._prepare_schema()
+        cls._schema = schema
+        if not cls.abstract:
+            cls._initschema()
+
+    @property
+    def indexes(cls):
+        try:
+            return cls.__dict__['_indexes']
+        except KeyError:
+            cls._prepare_schema()
+            return cls._indexes
+
+    @indexes.setter
+    def indexes(cls, indexes):
+        if '_indexes' not in cls.__dict__:
+            cls._prepare_schema()
+        cls._indexes = indexes
+
 
 class MongoSchema(object, metaclass=MongoSchemaWatcher):
 
@@ -365,8 +892,43 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     indexes = []
     cache = None
     doc_class = MongoDoc
+    # a slot per field instead of a dict per doc, see compact.py
+    compact = False
+    _compact_class = None
+    # (key, MongoField) of the fields with compress, see _compressed()
+    _compressed_fields = None
+    # where the LargeBlob fields are stored (see blobs.py), None for GridFS
+    blob_store = None
+    _blob_fields = None
+    # {_id: [blob ids]} the blobs replaced in a doc since it was saved
+    _replaced_blobs = None
     todict_follow_references = False
     cache_enabled = True
+    # record the size and age of every cached doc for cache_stats()
+    # (always on with set_cache_budget)
+    cache_accounting = False
+    _cache_stats = None
+    shared_cache = None
+    partition_by = None
+    _partitions = None
+    _partitions_listed = None
+    # {_id: the collection a doc is stored in} for the docs whose
+    # partition field was changed since they were last saved
+    _moved_from = None
+    _snapshot = None
+    _serializer = None
+    etag_field = None
+    cache_control = 'no-cache'
+    # the fields the auth functions read, fetched along with ?fields=
+    # (None fetches the whole doc when there is an auth function)
+    auth_fields = None
+    # None for the module's INDEX_MODE (see set_index_mode)
+    index_mode = None
+    _indexes_ensured = False
+    # bump it with every change of the schema: docs stored with the current
+    # one (written since, or by migrate()) skip the defaults and int fixes
+    # of _fromdb
+    schema_version = None
 
     def __init__(self):
         raise ValueError('Did you mean to use .create()?')
@@ -374,9 +936,25 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     @classmethod
     def _init(cls):
         if not cls.abstract:
-            cls._ensureindexes()
-            cls._initschema()
+            cls._partitions = {}
+            cls._partitions_listed = None
+            cls._moved_from = {}
+            cls._replaced_blobs = {}
+            mode = cls.index_mode or INDEX_MODE
+            if mode not in INDEX_MODES:
+                raise ValueError(
+                    'index_mode must be one of %s' % (INDEX_MODES,))
+            # lazy indexes get created by _lazy_indexes on first use
+            cls._indexes_ensured = mode != 'lazy'
+            if mode == 'eager':
+                cls._ensureindexes()
             cls.cache = {}
+            cls._cache_stats = cachestats.reset(cls)
+            cls._drop_snapshot()
+            cls._serializer = None
+            cls._compact_class = None
+            cls._compressed_fields = None
+            cls._blob_fields = None
 
     @classmethod
     def api_path_scheme(cls):
@@ -413,14 +991,208 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         return l
 
     @classmethod
-    def _ensureindexes(cls):
+    def _index_args(cls):
+        """
+        Yields (index, kwargs) for every entry in cls.indexes
+        """
         for index_kwargs in cls.indexes:
             if type(index_kwargs) == list:
                 index, ikwargs = index_kwargs
             else:
                 index = index_kwargs
                 ikwargs = {}
-            cls.collection.create_index(index, **ikwargs)
+            yield index, ikwargs
+
+    @classmethod
+    def _ensure_collection_indexes(cls, collection):
+        _create_missing_indexes(collection, cls._index_args())
+
+    @classmethod
+    def _index_collections(cls):
+        """
+        The collections cls.indexes have to be created in
+        """
+        if cls.partition_by:
+            return cls._all_partitions()
+        return [cls.collection]
+
+    @classmethod
+    def _ensureindexes(cls):
+        cls._indexes_ensured = True
+        for collection in cls._index_collections():
+            cls._ensure_collection_indexes(collection)
+
+    @classmethod
+    def _lazy_indexes(cls):
+        if not cls._indexes_ensured:
+            cls._ensureindexes()
+
+    @classmethod
+    def ensure_all_indexes(cls, background=False):
+        """
+        Create the indexes of every schema (cls and its subclasses) that
+        don't exist yet, with one create_indexes call per collection. With
+        background=True it runs in a thread, which is returned. Otherwise
+        returns {collection name: [names of the indexes created]}.
+        """
+        if background:
+            thread = threading.Thread(target=cls.ensure_all_indexes,
+                                      daemon=True)
+            thread.start()
+            return thread
+        wanted = {}
+        for schema in cls._get_all_classes():
+            if schema.abstract or not schema.indexes:
+                continue
+            schema._indexes_ensured = True
+            for collection in schema._index_collections():
+                name = collection.full_name
+                if name not in wanted:
+                    wanted[name] = (collection, [])
+                wanted[name][1].extend(schema._index_args())
+        return {name: _create_missing_indexes(collection, index_args)
+                for name, (collection, index_args) in wanted.items()}
+
+    ############################################################
+    # Partitioning
+    #
+    # With partition_by = [field, func] the docs are not stored in
+    # cls.collection itself but in its sub-collections (named like
+    # "events.202401"), the suffix being func(doc[field]).
+    ############################################################
+
+    @classmethod
+    def _partition_field(cls):
+        field = cls.partition_by[0]
+        return '_id' if field == 'id' else field
+
+    @classmethod
+    def _partition(cls, value):
+        """
+        The collection for a value of the partition field. Indexes are
+        created the first time a partition is used.
+        """
+        if isinstance(value, MongoDoc):
+            value = value.id
+        name = str(cls.partition_by[1](value))
+        if name not in cls._partitions:
+            collection = cls.collection[name]
+            if (cls.index_mode or INDEX_MODE) != 'manual':
+                cls._ensure_collection_indexes(collection)
+            cls._partitions[name] = collection
+        return cls._partitions[name]
+
+    @classmethod
+    def _all_partitions(cls):
+        """
+        The partitions this process used and the ones found in the db,
+        listed again every PARTITION_LIST_TTL seconds. Only the names the
+        partition_by function gives (its pattern attribute) are partitions,
+        not e.g. an event.archive collection.
+        """
+        now = time.monotonic()
+        if cls._partitions_listed is None or \
+                now - cls._partitions_listed > PARTITION_LIST_TTL:
+            prefix = cls.collection.name + '.'
+            pattern = getattr(cls.partition_by[1], 'pattern',
+                              DEFAULT_PARTITION_PATTERN)
+            names = cls.collection.database.list_collection_names(
+                filter={'name': {'$regex': '^%s(%s)$' % (
+                    re.escape(prefix), pattern)}})
+            for name in names:
+                suffix = name[len(prefix):]
+                if suffix not in cls._partitions:
+                    cls._partitions[suffix] = cls.collection[suffix]
+            cls._partitions_listed = now
+        return [cls._partitions[x] for x in sorted(cls._partitions)]
+
+    @classmethod
+    def _collections_for(cls, query):
+        """
+        The collections a query has to go to: just one unless the schema
+        is partitioned and the query doesn't pin the partition field.
+        """
+        if not cls._indexes_ensured:
+            cls._lazy_indexes()
+        if not cls.partition_by:
+            return [cls.collection]
+        field = cls._partition_field()
+        if field in query:
+            value = query[field]
+            if not (type(value) is dict and
+                    any(key.startswith('$') for key in value)):
+                return [cls._partition(value)]
+        return cls._all_partitions()
+
+    @classmethod
+    def _collection_for_doc(cls, doc):
+        """
+        The collection a doc (as stored in the db or as in MongoDoc.doc)
+        belongs to.
+        """
+        if not cls._indexes_ensured:
+            cls._lazy_indexes()
+        if not cls.partition_by:
+            return cls.collection
+        field = cls._partition_field()
+        if field == '_id' and '_id' not in doc:
+            field = 'id'
+        if field not in doc:
+            raise ValidationError('%s.%s is needed to pick a partition' % (
+                cls.__name__, field))
+        return cls._partition(doc[field])
+
+    @classmethod
+    def _stored_collection(cls, doc):
+        """
+        The collection the doc of a MongoDoc is stored in: the one of its
+        old partition until it's saved if its partition field changed
+        """
+        if cls.partition_by and doc['id'] in cls._moved_from:
+            return cls._moved_from[doc['id']]
+        return cls._collection_for_doc(doc)
+
+    @classmethod
+    def _before_change(cls, doc, key):
+        """
+        Called before a field of the doc of a MongoDoc is set
+        """
+        if cls.partition_by and key == cls.partition_by[0] and \
+                doc['id'] not in cls._moved_from:
+            # the doc moves to its new partition when it's saved
+            cls._moved_from[doc['id']] = cls._collection_for_doc(doc)
+        if doc.get(key) is not None and key in cls._blob_keys():
+            # deleted once the doc is saved without it
+            cls._replaced_blobs.setdefault(doc['id'], []).append(doc[key])
+
+    @classmethod
+    def _find_raw(cls, query, sort=None, limit=0, operation='find', **kwargs):
+        """
+        Iterates the raw docs matching query in every collection it has
+        to go to, merging them in sort order.
+        """
+        cursors = []
+        for collection in cls._collections_for(query):
+            metrics.count_db_op()
+            started = hooks.start('query')
+            docs = collection.find(query, limit=limit, **kwargs)
+            if sort:
+                docs.sort(*sort)
+            if started is not None:
+                docs = hooks.observe_cursor(
+                    docs, started, cls, collection, operation, query, sort)
+            cursors.append(docs)
+        if len(cursors) == 1:
+            return cursors[0]
+        if sort:
+            spec = _sort_spec(sort)
+            merged = heapq.merge(
+                *cursors, key=functools.partial(_MergeKey, spec))
+        else:
+            merged = itertools.chain(*cursors)
+        if limit:
+            merged = itertools.islice(merged, limit)
+        return merged
 
     @classmethod
     def _initschema(cls):
@@ -471,18 +1243,25 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
             # it's not required and it's not there. fuck it!
             return
 
+        value = doc[key]
+        if mf.compress and compression.is_compressed(value):
+            if type(value) is compression.Stored:
+                return
+            # given already compressed, what's inside must still fit
+            value = cls._unfix_dict_keys(compression.decompress(value))
+
         if key not in doc and mf.default:
             doc[key] = mf.filldefault()
             return
 
-        cls._check_entry_type(key, doc[key], mf)
+        cls._check_entry_type(key, value, mf)
 
         if mf.validate_regexp:
             regexp = mf.validate_regexp
-            if not regexp.match(doc[key]):
+            if not regexp.match(value):
                 raise ValidationError(
                     '"%s" does not match pattern: %s for key %s' % (
-                        doc[key], regexp.pattern, key))
+                        value, regexp.pattern, key))
 
     @classmethod
     def _basic_schema_validation(cls, doc):
@@ -516,17 +1295,47 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         return MongoDoc(doc, cls)
 
     @classmethod
-    def _writedoc(cls, doc, insert_or_save):
+    def _prepwrite(cls, doc):
+        """
+        A validated copy of doc ready to be written to the db
+        """
         doc = copy.deepcopy(doc)
         cls._validate(doc)
         cls._fordb(doc)
+        return doc
+
+    @classmethod
+    def _writedoc(cls, doc, insert_or_save):
+        doc = cls._prepwrite(doc)
+        collection = cls._collection_for_doc(doc)
+        metrics.count_db_op()
+        started = hooks.start('write')
         if insert_or_save == 'insert':
-            cls.collection.insert_one(doc)
+            collection.insert_one(doc)
+            hooks.done('write', started, cls, collection, 'insert', {},
+                       [doc])
         elif insert_or_save == 'update':
             docid = doc['_id']
-            del doc['_id']
-            cls.collection.update_one({'_id': docid}, {'$set': doc})
-            doc['_id'] = docid
+            moved_from = cls._moved_from.get(docid) \
+                if cls.partition_by else None
+            if moved_from is not None and \
+                    moved_from.full_name != collection.full_name:
+                # its partition field changed
+                collection.insert_one(doc)
+                metrics.count_db_op()
+                moved_from.delete_one({'_id': docid})
+                hooks.done('write', started, cls, collection, 'move',
+                           {'_id': docid}, [doc])
+            else:
+                del doc['_id']
+                collection.update_one({'_id': docid}, {'$set': doc})
+                hooks.done('write', started, cls, collection, 'update',
+                           {'_id': docid}, [doc])
+                doc['_id'] = docid
+            if moved_from is not None:
+                del cls._moved_from[docid]
+            cls._doc_changed(docid)
+            cls._drop_replaced_blobs(docid)
         else:
             raise ValueError('expected "insert" or "save"')
         cls._fromdb(doc)
@@ -537,13 +1346,131 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         if not cls.cache_enabled:
             raise ValueError('Cannot cache when disabled')
         cls.cache[mdoc.id] = mdoc
+        if cls._cache_accounting():
+            cachestats.added(cls, mdoc)
         return mdoc
 
+    @classmethod
+    def _cache_accounting(cls):
+        return cls.cache_accounting or cachestats.BUDGET is not None
+
+    @classmethod
+    def cache_stats(cls):
+        """
+        Entries, bytes, hits, misses, evictions and (with accounting) the
+        age distribution of the cache. On an abstract class (MongoSchema
+        itself for everything) the totals of every schema under it along
+        with each one's stats in 'schemas'.
+        """
+        if not cls.abstract and cls is not MongoSchema:
+            return cachestats.schema_stats(cls, cls._cache_accounting())
+        return cachestats.aggregate({
+            ms.__name__: ms.cache_stats()
+            for ms in cls._get_all_classes()
+            if not ms.abstract and ms is not MongoSchema})
+
+    @classmethod
+    def warm_cache(cls, query=None, limit=0, batch_size=1000):
+        """
+        Preload the cache with the docs matching query (everything by
+        default) so a freshly started process doesn't go to the db for
+        every doc it touches. Returns the number of docs added.
+        """
+        if not cls.cache_enabled:
+            raise ValueError('Cannot warm the cache when disabled')
+        query = dict(query or {})
+        cls._mongodoc_to_id(query)
+        docs = cls._find_raw(query, limit=limit, batch_size=batch_size)
+        added = 0
+        for doc in docs:
+            if doc['_id'] in cls.cache:
+                continue
+            cls.add_to_cache(cls._fromdb(doc))
+            added += 1
+        return added
+
+    @classmethod
+    def _schema_fields(cls):
+        return sorted(cls.schema.keys())
+
+    @classmethod
+    def snapshot_cache(cls, path):
+        """
+        Write everything currently in the cache to path as raw BSON so
+        another process can pick it up with load_cache_snapshot.
+        Returns the number of docs written.
+        """
+        encoded = []
+        ids = []
+        for mdoc in list(cls.cache.values()):
+            doc = copy.deepcopy(mdoc.doc)
+            cls._fordb(doc)
+            ids.append(doc['_id'])
+            encoded.append(bson.encode(doc))
+        header = {
+            'schema': cls.__name__,
+            'fields': cls._schema_fields(),
+            'created': time.time(),
+            'ids': ids,
+        }
+        with open(path, 'wb') as f:
+            f.write(bson.encode(header))
+            for raw in encoded:
+                f.write(raw)
+        return len(ids)
+
+    @classmethod
+    def load_cache_snapshot(cls, path, max_age=None):
+        """
+        Make the docs in a snapshot written by snapshot_cache available to
+        get(id=...). The file is memory-mapped and each doc is only
+        decoded and validated the first time it is asked for.
+
+        Snapshots older than max_age seconds are ignored. Returns the
+        number of docs made available.
+        """
+        if not cls.cache_enabled:
+            raise ValueError('Cannot load a snapshot when cache is disabled')
+        snapshot = _CacheSnapshot(path)
+        header = snapshot.header
+        if header['schema'] != cls.__name__ or \
+                header['fields'] != cls._schema_fields():
+            snapshot.close()
+            raise ValidationError(
+                'Snapshot %s does not match the schema for %s' % (
+                    path, cls.__name__))
+        if max_age is not None and time.time() - header['created'] > max_age:
+            snapshot.close()
+            return 0
+        cls._drop_snapshot()
+        cls._snapshot = snapshot
+        return len(snapshot)
+
+    @classmethod
+    def _drop_snapshot(cls):
+        # look in __dict__ so a subclass never closes its parent's snapshot
+        snapshot = cls.__dict__.get('_snapshot')
+        if snapshot is not None:
+            snapshot.close()
+        cls._snapshot = None
+
+    @classmethod
+    def _get_from_snapshot(cls, _id):
+        doc = cls._snapshot.pop(_id)
+        if doc is None:
+            return None
+        mdoc = cls._fromdb(doc)
+        try:
+            cls._validate(copy.deepcopy(mdoc.doc))
+        except (ValidationError, RequiredNotFoundException):
+            return None
+        return cls.add_to_cache(mdoc)
+
     @classmethod
     def _deref_if_needed(cls, mf, value):
         if type(mf) in LIST_TYPES and issubclass(mf[0].type, MongoSchema):
             # so the user can pass in an actual instance
-            value = [x.id for x in value]
+            value = [x.id if isinstance(x, MongoDoc) else x for x in value]
         elif type(mf) in LIST_TYPES:
             # it's just a list with regular types
             pass
@@ -554,7 +1481,10 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
             if value is None:
                 raise ValueError(
                     'Expected instance of %s, instead got None' % str(mf.type))
-            value = value.id
+            if isinstance(value, MongoDoc):
+                value = value.id
+        elif mf.packed and value is not None:
+            value = mf.type.pack(value, cls)
         return value
 
     @classmethod
@@ -568,14 +1498,41 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     def create(cls, **doc):
         cls._fill_defaults(doc)
         cls._basic_schema_validation(doc)
+        uploads = {}
+        for key in cls._blob_keys():
+            if cls.schema[key].type.uploads(doc.get(key)):
+                # streamed once the rest of the doc is known to be valid
+                uploads[key] = doc[key]
+                doc[key] = ObjectId()
         cls._fix_references(doc)
-        doc = cls._writedoc(doc, 'insert')
-        mdoc = cls.doc_class(doc, cls)
+        if uploads:
+            cls._validate(copy.deepcopy(doc))
+            doc = cls._insert_with_blobs(doc, uploads)
+        else:
+            doc = cls._writedoc(doc, 'insert')
+        mdoc = cls._new_doc(doc)
         if cls.cache_enabled:
             return cls.add_to_cache(mdoc)
         else:
             return mdoc
 
+    @classmethod
+    def _insert_with_blobs(cls, doc, uploads):
+        """
+        Streams the content of the LargeBlob fields to the store and
+        inserts the doc, deleting the blobs again if the insert fails
+        """
+        uploaded = []
+        try:
+            for key, value in uploads.items():
+                doc[key] = cls._deref_if_needed(cls.schema[key], value)
+                uploaded.append(doc[key])
+            return cls._writedoc(doc, 'insert')
+        except Exception:
+            if uploaded:
+                _lazy('blobs').store_for(cls).delete_many(uploaded)
+            raise
+
     @classmethod
     def _fromdb_fix_id(cls, doc):
         doc['id'] = doc['_id']
@@ -597,7 +1554,7 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         Look for all instances of __dict__: ... and turn it back into a dict
         """
         if type(doc) is dict:
-            for key in doc:
+            for key in list(doc):
                 old_key = key
                 key = cls._fix_single_dict_key(key, fordb=False)
                 if old_key != key:
@@ -630,7 +1587,7 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         but python does so we need to convert to a list before we save
         """
         if type(doc) is dict:
-            for key in doc:
+            for key in list(doc):
                 old_key = key
                 key = cls._fix_single_dict_key(key, fordb=True)
                 if old_key != key:
@@ -650,6 +1607,12 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     def _fordb(cls, doc):
         cls._fordb_fix_id(doc)
         cls._fix_dict_keys(doc)
+        for key, mf in cls._compressed():
+            if key in doc:
+                doc[key] = compression.compress(
+                    doc[key], mf.compress, mf.min_size)
+        if cls.schema_version is not None:
+            doc[SCHEMA_VERSION_KEY] = cls.schema_version
 
     @classmethod
     def _fix_int_float(cls, doc):
@@ -664,21 +1627,130 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     @classmethod
     def _fromdb(cls, doc):
         cls._fromdb_fix_id(doc)
-        cls._fill_defaults(doc)
-        cls._fix_int_float(doc)
+        version = doc.pop(SCHEMA_VERSION_KEY, None)
+        if version is None or version != cls.schema_version:
+            cls._fill_defaults(doc)
+            cls._fix_int_float(doc)
         cls._unfix_dict_keys(doc)
-        return cls.doc_class(doc, cls)
+        for key, _ in cls._compressed():
+            value = doc.get(key)
+            if compression.is_compressed(value):
+                # so saving it again doesn't decompress it to validate it
+                doc[key] = compression.Stored(value, value.subtype)
+        return cls._new_doc(doc)
 
     @classmethod
-    def get(cls, **kwargs):
-        cls._mongodoc_to_id(kwargs)
-        if cls.cache_enabled:
-            if 'id' in kwargs and kwargs['id'] in cls.cache:
+    def _compressed(cls):
+        """
+        (key, MongoField) of the fields with compress, worked out on first
+        use like _blob_keys
+        """
+        if cls._compressed_fields is None:
+            cls._compressed_fields = [
+                (key, mf) for key, mf in cls.schema.items()
+                if isinstance(mf, MongoField) and mf.compress]
+        return cls._compressed_fields
+
+    @classmethod
+    def _compress_field(cls, key, value):
+        """
+        value as it's stored in field key
+        """
+        mf = cls.schema[key]
+        if isinstance(mf, MongoField) and mf.compress:
+            value = compression.compress(
+                cls._fix_dict_keys(copy.deepcopy(value)), mf.compress,
+                mf.min_size)
+        return value
+
+    @staticmethod
+    def _plain_field(mf):
+        """
+        If the values of mf are returned as they are stored by __getattr__
+        """
+        if isinstance(mf, MongoField):
+            return not issubclass(mf.type, MongoSchema) and \
+                not mf.packed and not mf.compress
+        elif type(mf) in LIST_TYPES:
+            return not issubclass(mf[0].type, MongoSchema)
+        return True
+
+    @classmethod
+    def _new_doc(cls, doc):
+        if not cls.compact:
+            return cls.doc_class(doc, cls)
+        if cls.__dict__.get('_compact_class') is None:
+            cls._compact_class = _lazy('compact').compact_doc_class(
+                cls, cls._plain_field)
+        return cls._compact_class(doc, cls)
+
+    @classmethod
+    def _get_cached(cls, kwargs):
+        """
+        The doc get(**kwargs) is asking for if the process already has it
+        """
+        if cls.cache_enabled and 'id' in kwargs:
+            if kwargs['id'] in cls.cache:
+                cls._cache_stats.hit()
+                hooks.cache(True, cls, kwargs, 'local')
                 return cls.cache[kwargs['id']]
-        cls._fordb_fix_id(kwargs, forquery=True)
-        doc = cls.collection.find_one(kwargs)
-        if not doc:
-            return None
+            if cls._snapshot is not None and kwargs['id'] in cls._snapshot:
+                # None if it's no longer valid, then it's a miss
+                mdoc = cls._get_from_snapshot(kwargs['id'])
+                if mdoc is not None:
+                    cls._cache_stats.hit()
+                    hooks.cache(True, cls, kwargs, 'local')
+                    return mdoc
+            cls._cache_stats.miss()
+            hooks.cache(False, cls, kwargs, 'local')
+        return None
+
+    @classmethod
+    def _get_shared(cls, query):
+        """
+        The raw doc for a query on _id alone if the shared cache has it
+        """
+        if cls.shared_cache is not None and list(query) == ['_id']:
+            doc = cls.shared_cache.get(cls.collection.full_name, query['_id'])
+            hooks.cache(doc is not None, cls, query, 'shared')
+            return doc
+        return None
+
+    @classmethod
+    def _shared_tokens(cls, query):
+        """
+        {_id: fill token} of the shared cache for the docs of a query on
+        _id alone (an id or $in), taken before they are read from the db
+        """
+        if cls.shared_cache is None or list(query) != ['_id']:
+            return {}
+        ids = query['_id']
+        if type(ids) is dict:
+            if list(ids) != ['$in']:
+                return {}
+            ids = ids['$in']
+        else:
+            ids = [ids]
+        name = cls.collection.full_name
+        return {_id: cls.shared_cache.fill_token(name, _id) for _id in ids}
+
+    @classmethod
+    def _set_shared(cls, doc, tokens):
+        """
+        Put a doc just read from the db in the shared cache, unless it
+        was invalidated since its token was taken (it may be stale)
+        """
+        token = tokens.get(doc['_id'])
+        if token is not None:
+            cls.shared_cache.set(
+                cls.collection.full_name, doc['_id'], doc, token=token)
+
+    @classmethod
+    def _cache_fetched(cls, doc):
+        """
+        Turn a raw doc fetched for get() into a MongoDoc, going through the
+        cache so there is only ever one MongoDoc per id.
+        """
         if cls.cache_enabled:
             if doc['_id'] in cls.cache:
                 mdoc = cls.cache[doc['_id']]
@@ -689,6 +1761,77 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
             mdoc = cls._fromdb(doc)
         return mdoc
 
+    @classmethod
+    def get(cls, **kwargs):
+        cls._mongodoc_to_id(kwargs)
+        mdoc = cls._get_cached(kwargs)
+        if mdoc is not None:
+            return mdoc
+        cls._fordb_fix_id(kwargs, forquery=True)
+        doc = cls._get_shared(kwargs)
+        if doc is None:
+            tokens = cls._shared_tokens(kwargs)
+            for collection in cls._collections_for(kwargs):
+                metrics.count_db_op()
+                started = hooks.start('query')
+                doc = collection.find_one(kwargs)
+                hooks.done('query', started, cls, collection, 'get', kwargs,
+                           [doc] if doc else ())
+                if doc:
+                    cls._set_shared(doc, tokens)
+                    break
+        if not doc:
+            return None
+        return cls._cache_fetched(doc)
+
+    @classmethod
+    def _db_id(cls, _id):
+        """
+        Turns an id (or a MongoDoc) into the _id it is stored with
+        """
+        if isinstance(_id, MongoDoc):
+            return _id.id
+        query = {'id': _id}
+        cls._fordb_fix_id(query, forquery=True)
+        return query['_id']
+
+    @classmethod
+    def _ids_for_get_many(cls, ids):
+        """
+        Splits ids (already as stored in the db) into the docs that are
+        already cached and the ids that still have to be fetched.
+        """
+        found, missing = {}, []
+        for _id in ids:
+            mdoc = cls._get_cached({'id': _id})
+            if mdoc is None:
+                doc = cls._get_shared({'_id': _id})
+                if doc is not None:
+                    mdoc = cls._cache_fetched(doc)
+            if mdoc is not None:
+                found[_id] = mdoc
+            else:
+                missing.append(_id)
+        return found, missing
+
+    @classmethod
+    def get_many(cls, ids):
+        """
+        Like get(id=...) for every id in ids but with a single query for
+        all of the ones that aren't cached. Returns a list in the same
+        order as ids with None for the ones that don't exist.
+        """
+        ids = [cls._db_id(_id) for _id in ids]
+        found, missing = cls._ids_for_get_many(ids)
+        if missing:
+            query = {'_id': {'$in': missing}}
+            tokens = cls._shared_tokens(query)
+            for doc in cls._find_raw(query, operation='get_many'):
+                cls._set_shared(doc, tokens)
+                _id = doc['_id']
+                found[_id] = cls._cache_fetched(doc)
+        return [found.get(_id) for _id in ids]
+
     @classmethod
     def _mongodoc_to_id(cls, query):
         for key in query:
@@ -700,17 +1843,294 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     def find(cls, sort=None, limit=0, **kwargs):
         # re-reference it for the id
         cls._mongodoc_to_id(kwargs)
-        docs = cls.collection.find(kwargs, limit=limit)
-        if sort:
-            docs.sort(*sort)
-        for doc in docs:
+        for doc in cls._find_raw(kwargs, sort=sort, limit=limit):
             yield cls._fromdb(doc)
 
     @classmethod
     def count(cls, **kwargs):
         # re-reference it for the id
         cls._mongodoc_to_id(kwargs)
-        return cls.collection.find(kwargs).count()
+        total = 0
+        for collection in cls._collections_for(kwargs):
+            metrics.count_db_op()
+            started = hooks.start('query')
+            count = collection.count_documents(kwargs)
+            hooks.done('query', started, cls, collection, 'count', kwargs,
+                       count=count)
+            total += count
+        return total
+
+    @classmethod
+    def _split_points(cls, query, field, partitions, oversample=20):
+        """
+        Values of field that split the docs matching query into partitions
+        ranges of roughly the same size, guessed from a random sample.
+        """
+        pipeline = [
+            {'$match': query},
+            {'$sample': {'size': partitions * oversample}},
+            {'$project': {field: True}},
+        ]
+        values = sorted(
+            doc[field] for doc in cls.collection.aggregate(pipeline)
+            if doc.get(field) is not None)
+        points = []
+        for i in range(1, partitions):
+            if not values:
+                break
+            point = values[len(values) * i // partitions]
+            if not points or point > points[-1]:
+                points.append(point)
+        return points
+
+    @classmethod
+    def _scan_queries(cls, query, field, partitions):
+        """
+        One query per partition for parallel_scan. The first range is
+        negated so docs without field (or with a value of another type)
+        are not lost.
+        """
+        points = cls._split_points(query, field, partitions)
+        if not points:
+            return [query]
+        ranges = [{'$not': {'$gte': points[0]}}]
+        for lo, hi in zip(points, points[1:]):
+            ranges.append({'$gte': lo, '$lt': hi})
+        ranges.append({'$gte': points[-1]})
+        if query:
+            return [{'$and': [query, {field: x}]} for x in ranges]
+        return [{field: x} for x in ranges]
+
+    @classmethod
+    def _scan_units(cls, query, field, workers):
+        """
+        (collection name, query) for every partition of a parallel_scan.
+        A partitioned schema is scanned one collection per partition.
+        """
+        if cls.partition_by:
+            return [(x.name, query) for x in cls._collections_for(query)]
+        name = cls.collection.name
+        return [(name, x) for x in cls._scan_queries(query, field, workers)]
+
+    @classmethod
+    def _run_scan(cls, units, sort, fn, reduce, initial, ordered, executor,
+                  max_inflight, progress, progress_every, batch_size):
+        """
+        Yields the ('result' | 'done', value) messages of every partition
+        of a parallel_scan, partition by partition if ordered.
+        """
+        # only imported when a scan runs, they are slow to import
+        import multiprocessing
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        n = len(units)
+        manager = None
+        if executor == 'process':
+            manager = multiprocessing.Manager()
+            pool = ProcessPoolExecutor(n)
+            make_queue, stop = manager.Queue, manager.Event()
+        elif executor == 'thread':
+            pool = ThreadPoolExecutor(n)
+            make_queue, stop = queue.Queue, threading.Event()
+        else:
+            raise ValueError('expected "thread" or "process"')
+        progress_queue = make_queue()
+        if ordered:
+            results = [make_queue(max_inflight) for _ in range(n)]
+        else:
+            results = [make_queue(max_inflight)] * n
+
+        def report_progress():
+            while True:
+                try:
+                    msg = progress_queue.get_nowait()
+                except queue.Empty:
+                    return
+                if progress:
+                    progress(*msg)
+
+        def next_msg(q):
+            while True:
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    # a partition that never got to run (e.g. pickling
+                    # failed) has nothing to put in the queue
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+
+        futures = [
+            pool.submit(
+                _scan_partition, cls, i, name, query, sort, fn, reduce,
+                initial, results[i], progress_queue, stop, progress_every,
+                batch_size)
+            for i, (name, query) in enumerate(units)]
+        try:
+            pending, current = n, 0
+            while pending:
+                kind, partition, value = next_msg(results[current])
+                report_progress()
+                if kind == 'error':
+                    raise value
+                if kind == 'done':
+                    pending -= 1
+                    if ordered:
+                        current += 1
+                yield kind, value
+        finally:
+            stop.set()
+            pool.shutdown(wait=True)
+            report_progress()
+            if manager is not None:
+                manager.shutdown()
+
+    @classmethod
+    def parallel_scan(cls, query=None, workers=4, fn=None, field='_id',
+                      ordered=False, reduce=None, initial=None, combine=None,
+                      executor='thread', max_inflight=1000, progress=None,
+                      progress_every=1000, batch_size=1000):
+        """
+        Process every doc matching query with fn, splitting the docs into
+        workers ranges of field (which should be indexed) and running each
+        range on its own cursor in a thread or process pool. Decoding and
+        fn both happen in the workers.
+
+        Without reduce, returns a generator of the fn results (the docs if
+        fn is None). They come in any order, or partition by partition
+        sorted by field if ordered. At most max_inflight results are held
+        per queue, so the workers wait for a slow consumer.
+
+        With reduce, every worker folds its results with
+        reduce(acc, result) starting from initial, and the partial results
+        are folded together with combine (reduce by default) and returned.
+
+        progress(partition, count, done) is called with the number of docs
+        each partition has processed every progress_every docs.
+
+        A schema with partition_by is scanned one physical collection per
+        partition, so ordered only orders the docs within each of them.
+
+        With executor='process' fn, reduce and combine must be picklable
+        and fn must be given (MongoDocs can't be sent between processes).
+        """
+        if executor == 'process' and fn is None:
+            raise ValueError('fn is required with executor="process"')
+        query = dict(query or {})
+        cls._mongodoc_to_id(query)
+        units = cls._scan_units(query, field, workers)
+        scan = cls._run_scan(
+            units, field if ordered else None, fn, reduce, initial, ordered,
+            executor, max_inflight, progress, progress_every, batch_size)
+        if reduce is None:
+            return (value for kind, value in scan if kind == 'result')
+        partials = [value for kind, value in scan if kind == 'done']
+        return functools.reduce(combine or reduce, partials)
+
+    @classmethod
+    def migrate(cls, batch_size=1000, throttle=0, renames=None,
+                checkpoint=None, progress=None):
+        """
+        Bring the stored docs up to date with the schema: write the
+        defaults, int coercions and renames ({old name: new name}) _fromdb
+        would otherwise apply on every read, a batch of docs (in _id
+        order) at a time, sleeping throttle seconds between batches.
+        With a checkpoint path, an interrupted migration picks up after
+        the last batch written. progress(stats) is called after every
+        batch. Returns the final stats (scanned, modified...).
+        """
+        return _lazy('migrate').migrate(
+            cls, batch_size, throttle, renames or {}, checkpoint, progress)
+
+    @classmethod
+    def export(cls, path, format='bson', query=None, compress=None,
+               batch_size=1000, checkpoint=None, progress=None):
+        """
+        Write the docs matching query, as they are stored, to the file at
+        path: 'bson' (like mongodump) or 'ndjson' (extended JSON),
+        compress='gzip' to gzip it. The docs are streamed in _id order a
+        batch at a time. With a checkpoint path an interrupted export
+        picks up after the last batch written. progress(stats) is called
+        after every batch. Returns the final stats (docs, bytes,
+        docs_per_sec...).
+        """
+        query = dict(query or {})
+        cls._mongodoc_to_id(query)
+        return _lazy('dump').export(cls, path, format, query, compress,
+                                    batch_size, checkpoint, progress)
+
+    @classmethod
+    def import_(cls, path, format=None, validate=True, workers=0,
+                batch_size=1000, checkpoint=None, progress=None):
+        """
+        Insert the docs of a file written by export() (gzipped or not, the
+        format guessed from the extension unless given). Each batch is
+        validated against the schema, in a pool of workers processes if
+        workers isn't 0, then inserted with insert_many. Docs already in
+        the collection are counted as existing, and with a checkpoint path
+        an interrupted import skips what it already did. Raises a
+        ValidationError for the first invalid doc. Returns the final
+        stats (docs, inserted, existing, docs_per_sec...).
+        """
+        return _lazy('dump').import_(cls, path, format, validate, workers,
+                                     batch_size, checkpoint, progress)
+
+    @classmethod
+    def to_columns(cls, fields=None, query=None, batch_size=1000,
+                   use_numpy=None):
+        """
+        {field: column} for the docs matching query, read with a
+        projection on fields (dotted paths are fine, every schema field by
+        default) without building MongoDocs. int, float and bool fields
+        give typed columns: numpy arrays if numpy is installed (unless
+        use_numpy is False), array.arrays otherwise. Missing values are
+        filled in with the field's default if it has one. Otherwise they
+        are NaN in float columns, and masked in int and bool ones (a
+        numpy.ma array, or a list with None in it without numpy).
+        Datetimes are datetime64[ms] with numpy. Every other field gives
+        a column of python objects.
+        """
+        query = dict(query or {})
+        cls._mongodoc_to_id(query)
+        fields = list(fields or cls._schema_fields())
+        return _lazy('columns').to_columns(cls, fields, query, batch_size,
+                                           use_numpy)
+
+    @classmethod
+    def _get_serializer(cls):
+        """
+        {key: function converting the value for to_json}, compiled from
+        the schema the first time it's needed (so referenced schemas given
+        as strings are imported by then).
+        """
+        if cls._serializer is None:
+            cls._serializer = {}
+            for key, mf in cls.schema.items():
+                convert = _field_serializer(mf)
+                if isinstance(mf, MongoField) and mf.compress:
+                    convert = _compressed_field(convert)
+                cls._serializer[key] = convert
+        return cls._serializer
+
+    @classmethod
+    def _serialize(cls, mdoc):
+        """
+        What mdoc.to_dict() would give after going through MongoEncoder,
+        without copying the doc first.
+        """
+        if type(mdoc).to_dict is not MongoDoc.to_dict:
+            return _jsonable(mdoc.to_dict())
+        serializer = cls._get_serializer()
+        if not cls.todict_follow_references:
+            return {key: serializer.get(key, _jsonable)(value)
+                    for key, value in mdoc.doc.items()}
+        converted = {}
+        for key, value in mdoc.doc.items():
+            mf = cls.schema[key]
+            if isinstance(mf, MongoField) and issubclass(mf.type, MongoSchema):
+                converted[key] = _jsonable(getattr(mdoc, key))
+            else:
+                converted[key] = serializer.get(key, _jsonable)(value)
+        return converted
 
     @classmethod
     def list(cls, sort=None, **kwargs):
@@ -720,16 +2140,109 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
     def _remove_from_cache(cls, _id):
         if _id in cls.cache:
             del cls.cache[_id]
+            cachestats.removed(cls, _id)
+        if cls._snapshot is not None:
+            cls._snapshot.discard(_id)
+
+    @classmethod
+    def _doc_changed(cls, _id):
+        """
+        Forget everything derived from the stored version of a doc
+        """
+        if cls.cache_enabled and _id in cls.cache:
+            cls.cache[_id]._etag = None
+        if cls.shared_cache is not None:
+            cls.shared_cache.invalidate(cls.collection.full_name, _id)
 
     @classmethod
     def remove(cls, **kwargs):
         if '_id' not in kwargs and 'id' in kwargs:
             kwargs['_id'] = kwargs['id']
             del kwargs['id']
-        for doc in cls.collection.find(kwargs, projection={'_id': True}):
-            cls.collection.delete_one(doc)
+        for collection in cls._collections_for(kwargs):
+            cls._remove_from(collection, kwargs)
+
+    @classmethod
+    def _blob_keys(cls):
+        """
+        The keys of the LargeBlob fields (worked out on first use, the
+        types of the fields may not be importable yet in _init)
+        """
+        if cls._blob_fields is None:
+            cls._blob_fields = [
+                key for key, mf in cls.schema.items()
+                if isinstance(mf, MongoField) and mf.packed and
+                getattr(mf.type, 'streamed', False)]
+        return cls._blob_fields
+
+    @classmethod
+    def _delete_blobs(cls, ids):
+        """
+        Deletes the blobs with these ids that no doc holds anymore (docs
+        can share a blob by giving its id)
+        """
+        unused = set(ids)
+        for key in cls._blob_keys():
+            if not unused:
+                break
+            query = {key: {'$in': list(unused)}}
+            for doc in cls._find_raw(query, projection={key: True},
+                                     operation='blobs'):
+                unused.discard(doc[key])
+        if unused:
+            _lazy('blobs').store_for(cls).delete_many(unused)
+
+    @classmethod
+    def _check_blob_ids(cls, values, md=None):
+        """
+        What update() and the create route are given can't point a
+        LargeBlob field at a blob by id (any blob could be read that
+        way), only keep the one md holds. Sharing a blob is done by
+        assigning its id.
+        """
+        for key in cls._blob_keys():
+            value = values.get(key)
+            if value is None or cls.schema[key].type.uploads(value):
+                continue
+            if md is None or str(value) != str(md.doc.get(key)):
+                raise ValidationError(
+                    '%s.%s takes new content, not the id of another blob' % (
+                        cls.__name__, key))
+
+    @classmethod
+    def _drop_replaced_blobs(cls, _id):
+        """
+        Called once a doc is saved, its replaced blobs can go
+        """
+        replaced = cls._replaced_blobs.pop(_id, None)
+        if replaced:
+            cls._delete_blobs(replaced)
+
+    @classmethod
+    def _remove_from(cls, collection, kwargs):
+        metrics.count_db_op()
+        started = hooks.start('write')
+        removed = 0
+        blob_keys = cls._blob_keys()
+        projection = {'_id': True}
+        projection.update((key, True) for key in blob_keys)
+        blobs = []
+        for doc in collection.find(kwargs, projection=projection):
+            metrics.count_db_op()
+            collection.delete_one({'_id': doc['_id']})
+            removed += 1
+            blobs.extend(doc[key] for key in blob_keys
+                         if doc.get(key) is not None)
+            blobs.extend(cls._replaced_blobs.pop(doc['_id'], ()))
+            cls._doc_changed(doc['_id'])
+            if cls.partition_by:
+                cls._moved_from.pop(doc['_id'], None)
             if cls.cache_enabled:
                 cls._remove_from_cache(doc['_id'])
+        # the blobs of all the removed docs go at once
+        cls._delete_blobs(blobs)
+        hooks.done('write', started, cls, collection, 'remove', kwargs,
+                   count=removed)
 
     ############################################################
     # Flask stuff
@@ -744,13 +2257,7 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
 
     @classmethod
     def _default_response(cls, retval):
-        if request.method == 'POST':
-            status = 201
-        elif request.method in ('GET', 'DELETE', 'PUT', 'PATCH'):
-            status = 200
-        json_str = json.dumps(retval, cls=MongoEncoder)
-        resp = Response(json_str, mimetype='application/json', status=status)
-        return resp
+        return _lazy('flaskapi').default_response(retval)
 
     @classmethod
     def _get_doc_auth_func(cls):
@@ -763,40 +2270,152 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
             return cls._static_auth_func
 
     @classmethod
-    def _doc_route(cls, name=None, custom_response=None, auth=None):
+    def _doc_etag(cls, md):
+        """
+        The ETag of the version of a doc md holds: its etag_field if the
+        schema has one (and the doc has it), a hash of the encoded doc
+        otherwise. Remembered on the doc while it's the cached one, until
+        it changes.
+        """
+        if md._etag is not None:
+            return md._etag
+        if cls.etag_field and md.doc.get(cls.etag_field) is not None:
+            etag = str(md.doc[cls.etag_field])
+        else:
+            doc = md.doc
+            if cls._compressed():
+                # as stored, whether they were decompressed yet or not
+                doc = dict(doc)
+                for key, _ in cls._compressed():
+                    if key in doc:
+                        doc[key] = cls._compress_field(key, doc[key])
+            etag = hashlib.blake2b(
+                bson.encode(doc), digest_size=16).hexdigest()
+        if cls.cache_enabled and cls.cache.get(md.id) is md:
+            md._etag = etag
+        return etag
+
+    @classmethod
+    def _cached_etag(cls, _id):
+        """
+        The ETag remembered for the cached doc with this _id, if any
+        """
+        if not cls.cache_enabled:
+            return None
+        md = cls.cache.get(_id)
+        return md._etag if md is not None else None
+
+    @classmethod
+    def _route_fields(cls, args):
+        """
+        The schema keys asked for with the comma separated fields url
+        param, or None
+        """
+        fields = args.get('fields')
+        if not fields:
+            return None
+        keys = [x.strip() for x in fields.split(',') if x.strip()]
+        for key in keys:
+            if key not in cls.schema:
+                raise ValidationError(
+                    '%s has no field %s' % (cls.__name__, key))
+        return keys
+
+    @classmethod
+    def _route_limit(cls, args):
+        """
+        The limit url param of the list route, 0 (no limit) if not given
+        """
+        limit = args.get('limit', 0)
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            limit = -1
+        if limit < 0:
+            raise ValidationError(
+                'limit must be an integer >= 0, got %r' % (
+                    args.get('limit'),))
+        return limit
+
+    @classmethod
+    def _projection(cls, keys):
+        projection = {'_id': True}
+        for key in keys:
+            if key != 'id':
+                projection[cls._fix_single_dict_key(key, fordb=True)] = True
+        return projection
+
+    @classmethod
+    def _pick_fields(cls, doc, keys):
+        """
+        The id and keys of a doc (python side), converted for to_json
+        """
+        serializer = cls._get_serializer()
+        picked = {'id': serializer['id'](doc['id'])}
+        for key in keys:
+            if key in doc:
+                picked[key] = serializer[key](doc[key])
+        return picked
+
+    @classmethod
+    def _projected_doc(cls, doc):
+        """
+        The python side of a raw doc fetched with a projection, without
+        the defaults _fromdb would fill in for everything left out
+        """
+        cls._fromdb_fix_id(doc)
+        doc.pop(SCHEMA_VERSION_KEY, None)
+        cls._fix_int_float(doc)
+        cls._unfix_dict_keys(doc)
+        return doc
+
+    @classmethod
+    def _get_fields(cls, oid, keys, authfunc):
+        """
+        What doc_route('get') returns for ?fields=: just those fields,
+        fetched with a projection unless the doc is cached. The auth
+        function gets a doc holding only them and auth_fields.
+        """
+        _id = cls._db_id(oid)
+        md = cls._get_cached({'id': _id})
+        if md is None:
+            if authfunc and cls.auth_fields is None:
+                md = cls.get(id=_id)
+            else:
+                fetch = keys + list(cls.auth_fields or []) if authfunc \
+                    else keys
+                docs = cls._find_raw(
+                    {'_id': _id}, limit=1, operation='get',
+                    projection=cls._projection(fetch))
+                for doc in docs:
+                    md = cls.doc_class(cls._projected_doc(doc), cls)
+        if md is None:
+            return None
+        if authfunc:
+            authfunc(md)
+        return cls._pick_fields(md.doc, keys)
+
+    @classmethod
+    def _doc_route(cls, name=None, custom_response=None, auth=None,
+                   cache_control=None, etag_precheck=False):
         """
         Generates the function that will be registered with flask.
         """
-        def real_route(oid):
-            """
-            This is the actual function that will be executed by flask when
-            the route corresponding to the doc_route is matched..
-            """
-            try:
-                md = cls.get(id=oid)
-                if md is None:
-                    return Response(
-                        '%s<%s> not found' % (cls.__name__, oid), status=404)
-                authfunc = auth or cls._get_doc_auth_func()
-                if authfunc:
-                    authfunc(md)
-                response_func = custom_response or cls._flask_response
-                if name == 'get':
-                    retval = md
-                elif name == 'remove':
-                    md.remove()
-                    retval = oid
-                elif name == 'update':
-                    retval = md.update(_getparams())
-                elif name is not None:
-                    params = _getparams()
-                    retval = getattr(md, name)(**params)
-                return response_func(retval)
-            except AuthError as e:
-                return Response(e.msg, status=e.status)
-            except bson.errors.InvalidId as e:
-                return Response(str(e), status=404)
-        return real_route
+        return _lazy('flaskapi').doc_route(
+            cls, name, custom_response=custom_response, auth=auth,
+            cache_control=cache_control, etag_precheck=etag_precheck)
+
+    @classmethod
+    def _call_doc_func(cls, md, name, oid, params):
+        """
+        Runs what a doc_route other than get does with the doc
+        """
+        if name == 'remove':
+            md.remove()
+            return oid
+        elif name == 'update':
+            return md.update(params)
+        return getattr(md, name)(**params)
 
     @classmethod
     def doc_path_for(cls, name=None, oid=None):
@@ -809,7 +2428,20 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
 
     @classmethod
     def doc_route(cls, name, func=None, custom_response=None, auth=None,
-                  **kwargs):
+                  cache_control=None, etag_precheck=False, **kwargs):
+        """
+        Register a flask route calling the doc method name (or func).
+
+        The 'get' route sends an ETag and answers a matching If-None-Match
+        with a 304. It also sends cache_control (cls.cache_control by
+        default) as the Cache-Control header. With etag_precheck, and no
+        auth function, the 304 is sent straight from the ETag remembered
+        for the cached doc, without looking the doc up. Only use it if
+        nothing else writes to the collection, and with the cache enabled.
+        """
+        if etag_precheck and not cls.cache_enabled:
+            raise ValueError('etag_precheck answers from the cached docs, '
+                             '%s has its cache disabled' % cls.__name__)
         clsname = cls.__name__
         path = cls.doc_path_for(name=name)
         if func:
@@ -817,31 +2449,63 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         else:
             funcname = _functionify(name)
         routename = '%s.doc.%s' % (clsname, funcname)
-        routefunc = cls._doc_route(
-            funcname, custom_response=custom_response, auth=auth)
+        routefunc = _lazy('flaskapi').timed_route(routename, cls._doc_route(
+            funcname, custom_response=custom_response, auth=auth,
+            cache_control=cache_control, etag_precheck=etag_precheck))
+        cls._register_route('doc', name, funcname, custom_response, auth,
+                            kwargs.get('methods'))
         FLASK_APP.add_url_rule(path, routename, routefunc, **kwargs)
 
+    @classmethod
+    def _route_list(cls, params, args):
+        """
+        What the list route returns: a generator straight from the cursor
+        so the default response can stream it. The limit and after (an
+        id) url params page through the docs in id order, fields only
+        fetches (and returns) those fields.
+        """
+        query = dict(params or {})
+        limit = cls._route_limit(args)
+        after = args.get('after')
+        keys = cls._route_fields(args)
+        sort = None
+        if after:
+            query['_id'] = {'$gt': cls._db_id(after)}
+        if after or limit:
+            sort = ('_id', 1)
+        if keys is None:
+            return cls.find(sort=sort, limit=limit, **query)
+        cls._mongodoc_to_id(query)
+        docs = cls._find_raw(query, sort=sort, limit=limit,
+                             projection=cls._projection(keys))
+        return (cls._pick_fields(cls._projected_doc(doc), keys)
+                for doc in docs)
+
     @classmethod
     def _static_route(cls, name=None, custom_response=None, auth=None):
-        def real_route():
-            try:
-                authfunc = auth or cls._get_static_auth_func()
-                if authfunc:
-                    authfunc()
-                if name is None:
-                    retval = cls.list()
-                else:
-                    params = _getparams()
-                    tocall = getattr(cls, name)
-                    if params is None:
-                        retval = tocall()
-                    else:
-                        retval = tocall(**params)
-                response_func = custom_response or cls._flask_response
-                return response_func(retval)
-            except AuthError as e:
-                return Response(e.msg, status=e.status)
-        return real_route
+        return _lazy('flaskapi').static_route(
+            cls, name, custom_response=custom_response, auth=auth)
+
+    @classmethod
+    def _call_static_func(cls, name, params, args, custom_response):
+        """
+        Runs what a static_route does
+        """
+        is_list = name is None or (
+            name == 'list' and
+            cls.list.__func__ is MongoSchema.list.__func__)
+        if is_list:
+            retval = cls._route_list(params, args)
+            if custom_response or RESPONSE_FUNC:
+                # custom response functions have always been given a list
+                retval = list(retval)
+            return retval
+        if name == 'create' and params:
+            cls._check_blob_ids(params)
+        tocall = getattr(cls, name)
+        if params is None:
+            return tocall()
+        return tocall(**params)
 
     @classmethod
     def path_for(cls, name=None):
@@ -856,11 +2520,26 @@ class MongoSchema(object, metaclass=MongoSchemaWatcher):
         clsname = cls.__name__
         funcname = _functionify(func or name)
         path = cls.path_for(name=name)
-        route = cls._static_route(
-            funcname, custom_response=custom_response, auth=auth)
-        FLASK_APP.add_url_rule(path, '%s.%s' % (clsname, funcname), route,
+        routename = '%s.%s' % (clsname, funcname)
+        route = _lazy('flaskapi').timed_route(routename, cls._static_route(
+            funcname, custom_response=custom_response, auth=auth))
+        cls._register_route('static', name, funcname, custom_response, auth,
+                            kwargs.get('methods'))
+        FLASK_APP.add_url_rule(path, routename, route,
                                **kwargs)
 
+    @classmethod
+    def _register_route(cls, kind, name, funcname, custom_response, auth,
+                        methods):
+        """
+        Remember what every route does so the batch route can do the same
+        (and nothing else).
+        """
+        if '_routes' not in cls.__dict__:
+            cls._routes = {}
+        cls._routes[(kind, name or 'list')] = (
+            funcname, custom_response, auth, methods)
+
     @classmethod
     def set_auth(cls, doc=None, static=None):
         cls._doc_auth_func = doc
@@ -0,0 +1,169 @@
+"""
+Large blobs kept out of the docs (MF(LargeBlob)): the content goes to a
+blob store, GridFS by default or a directory with FileStore, and the doc
+only holds its id. Reading the field opens a streaming reader, so a doc
+in the cache never holds more than the id.
+
+    class Upload(MongoSchema):
+        schema = {'name': MF(str), 'content': MF(LargeBlob)}
+        # optional, GridFS in the collection's database otherwise
+        blob_store = FileStore('/var/lib/uploads')
+
+    with open('video.mp4', 'rb') as f:
+        upload = Upload.create(name='video', content=f)
+    with upload.content as reader:
+        first = reader.read(1024)
+
+The content is streamed to the store, a chunk at a time, as soon as it
+is assigned (once the rest of the doc is validated by create). Docs can
+share a blob by id, so a blob is only deleted, when its doc is removed
+or it's replaced, if no other doc holds its id.
+"""
+# python core
+import io
+import os
+
+# 3rd party
+from bson.objectid import ObjectId
+
+# from this project
+from . import base
+
+# bytes read from a source (and GridFS chunk size) at a time
+CHUNK_SIZE = 255 * 1024
+
+
+def store_for(ms):
+    """
+    The blob store of a schema, GridFS in its collection's database
+    (bucket named after the collection) unless it has a blob_store
+    """
+    if ms.blob_store is None:
+        database = getattr(ms.collection, 'database', None)
+        if not hasattr(database, 'get_collection'):
+            raise ValueError('%s needs a blob_store for its LargeBlob '
+                             'fields' % ms.__name__)
+        ms.blob_store = GridFSStore(database, ms.collection.name + '_blobs')
+    return ms.blob_store
+
+
+class GridFSStore(object):
+
+    def __init__(self, database, bucket='fs', chunk_size=CHUNK_SIZE):
+        # only imported by the schemas using it
+        import gridfs
+        self.database = database
+        self.bucket_name = bucket
+        self.bucket = gridfs.GridFSBucket(
+            database, bucket, chunk_size_bytes=chunk_size)
+
+    def put(self, source):
+        return self.bucket.upload_from_stream('', source)
+
+    def open(self, blob_id):
+        return self.bucket.open_download_stream(blob_id)
+
+    def delete_many(self, ids):
+        """
+        Delete the files and chunks of every blob with one query each
+        """
+        ids = list(ids)
+        self.database[self.bucket_name + '.files'].delete_many(
+            {'_id': {'$in': ids}})
+        self.database[self.bucket_name + '.chunks'].delete_many(
+            {'files_id': {'$in': ids}})
+
+
+class FileStore(object):
+    """
+    Blobs as files in a directory, named after their ids
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def _path(self, blob_id):
+        return os.path.join(self.path, str(blob_id))
+
+    def put(self, source):
+        blob_id = ObjectId()
+        path = self._path(blob_id)
+        # written under another name first, a blob is there whole or not
+        # at all
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                while True:
+                    chunk = source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    f.write(chunk)
+        except BaseException:
+            self.delete_many([str(blob_id) + '.tmp'])
+            raise
+        os.replace(path + '.tmp', path)
+        return blob_id
+
+    def open(self, blob_id):
+        return open(self._path(blob_id), 'rb')
+
+    def delete_many(self, ids):
+        for blob_id in ids:
+            try:
+                os.remove(self._path(blob_id))
+            except FileNotFoundError:
+                pass
+
+
+class _LargeBlobType(type):
+
+    def __instancecheck__(cls, value):
+        # what the docs hold is the id of the blob
+        return type(value) is ObjectId
+
+
+class LargeBlob(object, metaclass=_LargeBlobType):
+    """
+    The type of MongoFields whose content lives in the schema's blob
+    store. It can be given a file-like object (read a chunk at a time),
+    bytes or the id of a blob already in the store, as an ObjectId or
+    the str to_json gives. Reading the field gives a file-like reader,
+    to close once done.
+    """
+    # to_columns gives the ids rather than opening every blob
+    streamed = True
+
+    @classmethod
+    def uploads(cls, value):
+        """
+        Whether packing value streams new content to the store
+        """
+        return value is not None and not isinstance(value, (ObjectId, str))
+
+    @classmethod
+    def pack(cls, value, ms=None):
+        if type(value) is ObjectId:
+            return value
+        if isinstance(value, str):
+            # what the routes return, given back by the client
+            if not ObjectId.is_valid(value):
+                raise base.ValidationError('invalid blob id %r' % value)
+            return ObjectId(value)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            value = io.BytesIO(value)
+        if not hasattr(value, 'read'):
+            raise base.ValidationError(
+                'expected a file-like object, bytes or a blob id, got %s' %
+                type(value))
+        return store_for(ms).put(value)
+
+    @classmethod
+    def unpack(cls, value, ms=None):
+        return store_for(ms).open(value)
+
+    @classmethod
+    def jsonable(cls, value):
+        return str(value)
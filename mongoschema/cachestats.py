@@ -0,0 +1,204 @@
+"""
+Accounting of the per-schema caches (MongoSchema.cache). Hits, misses
+and evictions are always counted. The size and age of every entry are
+only recorded with accounting on: cache_accounting = True on a schema,
+or a memory budget for all of them set with set_cache_budget().
+"""
+# python core
+import sys
+import time
+import threading
+
+# 3rd party
+import bson
+
+# upper bounds (in seconds) of the age buckets of cache_stats()
+AGE_BUCKETS = (60, 600, 3600, 86400)
+
+# docs encoded to estimate the size of a cache without accounting
+SAMPLE_SIZE = 100
+
+BUDGET = None
+
+_lock = threading.RLock()
+_stats = {}
+_total = 0
+
+
+class CacheStats(object):
+    """
+    The counters of one schema's cache. entries is {_id: (time added,
+    bytes)} for the docs added with accounting on, oldest first.
+    """
+
+    def __init__(self, ms):
+        self.ms = ms
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.entries = {}
+        self.last_used = time.monotonic()
+
+    def hit(self):
+        self.hits += 1
+        self.last_used = time.monotonic()
+
+    def miss(self):
+        self.misses += 1
+
+
+def reset(ms):
+    """
+    New stats for ms (its cache was just emptied)
+    """
+    global _total
+    with _lock:
+        old = _stats.get(ms)
+        if old is not None:
+            _total -= old.bytes
+        stats = _stats[ms] = CacheStats(ms)
+    return stats
+
+
+def set_budget(max_bytes):
+    global BUDGET
+    BUDGET = max_bytes
+    if max_bytes is not None:
+        with _lock:
+            _enforce(None)
+
+
+def total_bytes():
+    return _total
+
+
+def _sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k) + _sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(x) for x in obj)
+    return size
+
+
+def doc_size(mdoc):
+    """
+    The BSON size of a cached doc, or a recursive estimate of its size in
+    memory when it can't be encoded
+    """
+    try:
+        return len(bson.encode(mdoc.doc))
+    except (bson.errors.InvalidDocument, TypeError):
+        return _sizeof(dict(mdoc.doc))
+
+
+def added(ms, mdoc):
+    """
+    Account for mdoc just put in ms.cache, evicting from the coldest
+    schemas if that goes over the budget
+    """
+    global _total
+    nbytes = doc_size(mdoc)
+    with _lock:
+        stats = ms._cache_stats
+        old = stats.entries.pop(mdoc.id, None)
+        if old is not None:
+            stats.bytes -= old[1]
+            _total -= old[1]
+        stats.entries[mdoc.id] = (time.monotonic(), nbytes)
+        stats.bytes += nbytes
+        _total += nbytes
+        stats.last_used = time.monotonic()
+        if BUDGET is not None and _total > BUDGET:
+            _enforce(mdoc.id)
+
+
+def removed(ms, _id):
+    global _total
+    with _lock:
+        stats = ms._cache_stats
+        entry = stats.entries.pop(_id, None)
+        if entry is not None:
+            stats.bytes -= entry[1]
+            _total -= entry[1]
+
+
+def _enforce(keep):
+    """
+    Evict the oldest entries of the coldest schema (the one least
+    recently hit) until the total is back under the budget, never the
+    doc with the _id keep.
+    """
+    global _total
+    while _total > BUDGET:
+        candidates = [x for x in _stats.values()
+                      if len(x.entries) > (1 if keep in x.entries else 0)]
+        if not candidates:
+            return
+        stats = min(candidates, key=lambda x: x.last_used)
+        for _id in list(stats.entries):
+            if _total <= BUDGET:
+                break
+            if _id == keep:
+                continue
+            nbytes = stats.entries.pop(_id)[1]
+            stats.bytes -= nbytes
+            _total -= nbytes
+            stats.ms.cache.pop(_id, None)
+            stats.evictions += 1
+
+
+def _ages(entries, now):
+    ages = dict.fromkeys(['<%ss' % x for x in AGE_BUCKETS], 0)
+    ages['older'] = 0
+    for added_at, _ in entries.values():
+        age = now - added_at
+        for bound in AGE_BUCKETS:
+            if age < bound:
+                ages['<%ss' % bound] += 1
+                break
+        else:
+            ages['older'] += 1
+    return ages
+
+
+def schema_stats(ms, accounting):
+    stats = ms._cache_stats
+    with _lock:
+        entries = len(ms.cache)
+        if accounting:
+            nbytes, estimated = stats.bytes, False
+            ages = _ages(stats.entries, time.monotonic())
+        else:
+            sample = list(ms.cache.values())[:SAMPLE_SIZE]
+            nbytes = sum(doc_size(x) for x in sample)
+            nbytes = nbytes * entries // len(sample) if sample else 0
+            estimated, ages = True, None
+    asked = stats.hits + stats.misses
+    return {
+        'entries': entries,
+        'bytes': nbytes,
+        'bytes_estimated': estimated,
+        'hits': stats.hits,
+        'misses': stats.misses,
+        'hit_ratio': stats.hits / float(asked) if asked else None,
+        'evictions': stats.evictions,
+        'ages': ages,
+    }
+
+
+def aggregate(per_schema):
+    """
+    The totals of {schema name: schema_stats()} along with it
+    """
+    total = {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0,
+             'evictions': 0}
+    for stats in per_schema.values():
+        for key in total:
+            total[key] += stats[key]
+    asked = total['hits'] + total['misses']
+    total['hit_ratio'] = total['hits'] / float(asked) if asked else None
+    total['budget'] = BUDGET
+    total['schemas'] = per_schema
+    return total
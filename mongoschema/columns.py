@@ -0,0 +1,152 @@
+"""
+Columnar reads for MongoSchema.to_columns: the raw docs of a projected
+find go straight into one column per field, no MongoDocs built. Columns
+of int, float and bool fields are typed arrays (numpy ones when numpy is
+installed, array.array otherwise), datetimes are datetime64[ms] with
+numpy, and everything else is a column of python objects.
+"""
+# python core
+import array
+import datetime
+import itertools
+
+# from this project
+from . import base, compression
+
+# array.array typecodes of the MongoField types with one
+TYPECODES = {int: 'q', float: 'd', bool: 'b'}
+
+# numpy dtypes of the MongoField types with one
+DTYPES = {int: 'int64', float: 'float64', bool: 'bool',
+          datetime.datetime: 'datetime64[ms]'}
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _decompress(value):
+    if compression.is_compressed(value):
+        return compression.decompress(value)
+    return value
+
+
+def _schema_entry(ms, name):
+    """
+    What the schema of ms has at the dotted path name
+    """
+    entry = ms.schema
+    for part in name.split('.'):
+        if not isinstance(entry, dict) or part not in entry:
+            raise base.ValidationError(
+                '%s has no field %s' % (ms.__name__, name))
+        entry = entry[part]
+    return entry
+
+
+class _Column(object):
+    """
+    The values of one field as they are read, None where it's missing
+    """
+    __slots__ = ('name', 'key', 'path', 'type', 'default', 'unpack',
+                 'values')
+
+    def __init__(self, ms, name):
+        entry = _schema_entry(ms, name)
+        self.name = name
+        self.path = ['_id'] if name == 'id' else name.split('.')
+        self.key = self.path[0] if len(self.path) == 1 else None
+        self.type = object
+        self.default = self.unpack = None
+        if isinstance(entry, base.MongoField):
+            # LargeBlob columns are the ids, not a reader per blob
+            if entry.packed and not getattr(entry.type, 'streamed', False):
+                self.unpack = entry.type.unpack
+            elif entry.compress:
+                self.unpack = _decompress
+            if not issubclass(entry.type, base.MongoSchema):
+                self.type = entry.type
+            # what _fromdb would fill in for docs stored without it
+            if entry.has_default() and name != 'id':
+                self.default = entry.filldefault
+        self.values = []
+
+    def _get(self, doc):
+        value = doc
+        for part in self.path:
+            if type(value) is not dict:
+                return None
+            value = value.get(part)
+        return value
+
+    def add(self, docs):
+        if self.key is not None:
+            key = self.key
+            values = [doc.get(key) for doc in docs]
+        else:
+            values = [self._get(doc) for doc in docs]
+        if self.default is not None and None in values:
+            values = [self.default() if x is None else x for x in values]
+        self.values.extend(values)
+
+    def _typed(self, values, numpy):
+        if self.type is float:
+            values = [float('nan') if x is None else x for x in values]
+            if numpy is not None:
+                return numpy.array(values, dtype=DTYPES[float])
+            return array.array(TYPECODES[float], values)
+        # floats in int fields are turned into ints, like _fromdb does
+        filled = [0 if x is None else int(x) for x in values]
+        missing = [x is None for x in values]
+        if numpy is not None:
+            column = numpy.array(filled, dtype=DTYPES[self.type])
+            if any(missing):
+                column = numpy.ma.masked_array(column, mask=missing)
+            return column
+        if any(missing):
+            return [None if x is None else y
+                    for x, y in zip(values, filled)]
+        return array.array(TYPECODES[self.type], filled)
+
+    def finish(self, ms, numpy):
+        values = self.values
+        if self.unpack is not None:
+            values = [None if x is None else self.unpack(x) for x in values]
+        if self.type in TYPECODES:
+            try:
+                return self._typed(values, numpy)
+            except (TypeError, ValueError) as e:
+                raise base.ValidationError('%s.%s: %s' % (
+                    ms.__name__, self.name, e))
+        if self.type is object or self.type is dict:
+            values = [ms._unfix_dict_keys(x) for x in values]
+        if numpy is None:
+            return values
+        if self.type is datetime.datetime:
+            return numpy.array(values, dtype=DTYPES[self.type])
+        column = numpy.empty(len(values), dtype=object)
+        # one by one so lists stay lists instead of becoming a 2d array
+        for i, value in enumerate(values):
+            column[i] = value
+        return column
+
+
+def to_columns(ms, fields, query, batch_size, use_numpy):
+    numpy = _numpy() if use_numpy is not False else None
+    if use_numpy and numpy is None:
+        raise ImportError('use_numpy=True needs numpy installed')
+    columns = [_Column(ms, name) for name in fields]
+    projection = {'_id': True}
+    for name in fields:
+        if name != 'id':
+            projection[name] = True
+    docs = iter(ms._find_raw(query, projection=projection,
+                             batch_size=batch_size))
+    for batch in iter(lambda: list(itertools.islice(docs, batch_size)), []):
+        for column in columns:
+            column.add(batch)
+    return {x.name: x.finish(ms, numpy) for x in columns}
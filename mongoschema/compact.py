@@ -0,0 +1,160 @@
+"""
+Compact docs for schemas with compact = True: instead of a dict per doc,
+the MongoDoc class of the schema gets a slot per schema field. The keys
+live once in the class, not in every doc, and there is no __dict__ per
+instance. doc is a mapping view over the slots so everything that reads
+or writes MongoDoc.doc keeps working.
+"""
+# python core
+import sys
+import copy
+import json
+from collections.abc import MutableMapping
+
+# from this project
+from . import base
+
+
+class CompactDocView(MutableMapping):
+    """
+    The doc attribute of a compact doc, a dict-like view over its slots
+    (an unset slot is a missing field). Keys that aren't in the schema
+    (fields since removed from it) go to the _extra slot.
+    """
+    __slots__ = ('_record',)
+
+    def __init__(self, record):
+        self._record = record
+
+    def __getitem__(self, key):
+        slot = self._record._slots.get(key)
+        if slot is None:
+            extra = self._record._extra
+            if extra is None:
+                raise KeyError(key)
+            return extra[key]
+        try:
+            return slot.__get__(self._record)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = self._record._slots.get(key)
+        if slot is None:
+            if self._record._extra is None:
+                object.__setattr__(self._record, '_extra', {})
+            self._record._extra[key] = value
+        else:
+            slot.__set__(self._record, value)
+
+    def __delitem__(self, key):
+        slot = self._record._slots.get(key)
+        if slot is None:
+            extra = self._record._extra
+            if extra is None:
+                raise KeyError(key)
+            del extra[key]
+        else:
+            try:
+                slot.__delete__(self._record)
+            except AttributeError:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        slot = self._record._slots.get(key)
+        if slot is None:
+            extra = self._record._extra
+            return extra is not None and key in extra
+        return _has(slot, self._record)
+
+    def __iter__(self):
+        record = self._record
+        for key, slot in record._slots.items():
+            if _has(slot, record):
+                yield key
+        if record._extra:
+            for key in list(record._extra):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        return dict(self) == other
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return dict(self)
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+
+def _has(slot, record):
+    try:
+        slot.__get__(record)
+    except AttributeError:
+        return False
+    return True
+
+
+def _get_doc(self):
+    return CompactDocView(self)
+
+
+def _set_doc(self, doc):
+    slots = self._slots
+    if _has(type(self)._extra_slot, self):
+        # replacing the doc (reload), not setting a new one's
+        for slot in slots.values():
+            if _has(slot, self):
+                slot.__delete__(self)
+    extra = None
+    for key, value in doc.items():
+        slot = slots.get(key)
+        if slot is None:
+            if extra is None:
+                extra = {}
+            extra[key] = value
+        else:
+            slot.__set__(self, value)
+    object.__setattr__(self, '_extra', extra)
+
+
+def _str(self):
+    return json.dumps(dict(self.doc), sort_keys=True, indent=4,
+                      separators=(',', ': '), cls=base.MongoEncoder)
+
+
+def compact_doc_class(ms, plain_field):
+    """
+    The compact version of ms.doc_class. The slots of the fields whose
+    values __getattr__ returns as they are (plain_field(mf)) are named
+    after them, so reading them is a plain attribute lookup. The others
+    (references...), and the names the doc class already uses, get a
+    private slot and still go through __getattr__.
+    """
+    doc_class = ms.doc_class
+    keys = [sys.intern(key) for key in ms.schema]
+    slot_names = []
+    for i, key in enumerate(keys):
+        if key.isidentifier() and not key.startswith('_') and \
+                not hasattr(doc_class, key) and plain_field(ms.schema[key]):
+            slot_names.append(key)
+        else:
+            slot_names.append('_f%d' % i)
+    cls = type(doc_class)('Compact' + doc_class.__name__, (doc_class,), {
+        '__slots__': tuple(slot_names) + ('_extra',),
+        '__module__': doc_class.__module__,
+        'doc': property(_get_doc, _set_doc),
+        '__str__': _str,
+    })
+    cls._slots = {key: cls.__dict__[name]
+                  for key, name in zip(keys, slot_names)}
+    cls._extra_slot = cls.__dict__['_extra']
+    return cls
@@ -0,0 +1,68 @@
+"""
+Compressed fields (MongoField(..., compress='zlib' | 'lzma',
+min_size=N)). The value is BSON encoded, so any type comes back as it
+was, compressed, and stored as a Binary whose subtype says how. Values
+smaller than min_size (encoded) are stored as they are, and so are the
+ones compression doesn't make smaller.
+"""
+# python core
+import zlib
+
+# 3rd party
+import bson
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+
+# Binary subtypes of the compressed values (USER_DEFINED_SUBTYPE itself
+# is the one of ArrayField)
+SUBTYPES = {
+    'zlib': USER_DEFINED_SUBTYPE + 1,
+    'lzma': USER_DEFINED_SUBTYPE + 2,
+}
+
+METHODS = {v: k for k, v in SUBTYPES.items()}
+
+ZLIB_LEVEL = 6
+
+
+def _lzma():
+    # only imported by the schemas using it
+    import lzma
+    return lzma
+
+
+class Stored(Binary):
+    """
+    A compressed value as it was read from the db, validated when it was
+    written
+    """
+
+
+def is_compressed(value):
+    return isinstance(value, Binary) and value.subtype in METHODS
+
+
+def compress(value, method, min_size=0):
+    """
+    The Binary value is stored as, or value itself if it isn't worth
+    compressing (or already is compressed)
+    """
+    if value is None or is_compressed(value):
+        return value
+    encoded = bson.encode({'v': value})
+    if len(encoded) < min_size:
+        return value
+    if method == 'zlib':
+        data = zlib.compress(encoded, ZLIB_LEVEL)
+    else:
+        data = _lzma().compress(encoded)
+    if len(data) >= len(encoded):
+        return value
+    return Binary(data, SUBTYPES[method])
+
+
+def decompress(value):
+    if METHODS[value.subtype] == 'zlib':
+        encoded = zlib.decompress(value)
+    else:
+        encoded = _lzma().decompress(value)
+    return bson.decode(encoded)['v']
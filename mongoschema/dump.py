@@ -0,0 +1,278 @@
+"""
+Streaming export and import of a schema's docs (see MongoSchema.export
+and MongoSchema.import_), as they are stored, to and from files:
+
+- 'bson': the docs one after the other, like mongodump's .bson files.
+- 'ndjson': one extended JSON doc per line (bson.json_util), so the BSON
+  types (ObjectId, datetime...) come back as they were.
+
+Either can be gzipped, one gzip member per batch, which any gzip reader
+sees as a single stream. Docs go through in batches, so memory stays
+the same whatever the size of the collection. With a checkpoint file
+both pick up where an interrupted run stopped.
+"""
+# python core
+import os
+import gzip
+import time
+import struct
+import itertools
+import collections
+
+# 3rd party
+import bson
+from bson import json_util
+from pymongo.errors import BulkWriteError
+
+# from this project
+from . import base
+
+FORMATS = ('bson', 'ndjson')
+
+COMPRESSIONS = (None, 'gzip')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# batches being validated at once by each worker process
+BATCHES_PER_WORKER = 2
+
+DUPLICATE_KEY = 11000
+
+
+def _encode_ndjson(doc):
+    return json_util.dumps(
+        doc, json_options=json_util.RELAXED_JSON_OPTIONS).encode() + b'\n'
+
+
+_ENCODERS = {'bson': bson.encode, 'ndjson': _encode_ndjson}
+
+
+def _decode(format, raw):
+    if format == 'bson':
+        return bson.decode(raw)
+    return json_util.loads(raw)
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return bson.decode(f.read())
+
+
+def _save_checkpoint(path, state):
+    if path is None:
+        return
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(bson.encode(state))
+    os.replace(tmp, path)
+
+
+def _done(checkpoint):
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+
+class _Stats(object):
+    """
+    The counters of an export or import, handed to progress(stats)
+    after every batch
+    """
+
+    def __init__(self, progress, **extra):
+        self.progress = progress
+        self.started = time.monotonic()
+        self.stats = dict(docs=0, bytes=0, seconds=0.0, docs_per_sec=None,
+                          **extra)
+
+    def batch(self, docs, nbytes, **counts):
+        stats = self.stats
+        stats['docs'] += docs
+        stats['bytes'] += nbytes
+        for key, count in counts.items():
+            stats[key] += count
+        stats['seconds'] = time.monotonic() - self.started
+        if stats['seconds']:
+            stats['docs_per_sec'] = stats['docs'] / stats['seconds']
+        if self.progress is not None:
+            self.progress(dict(stats))
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, size)), [])
+
+
+def export(ms, path, format, query, compress, batch_size, checkpoint,
+           progress):
+    if format not in FORMATS:
+        raise ValueError('format must be one of %s' % (FORMATS,))
+    if compress not in COMPRESSIONS:
+        raise ValueError('compress must be one of %s' % (COMPRESSIONS,))
+    encode = _ENCODERS[format]
+    state = _load_checkpoint(checkpoint) or {
+        'collection': 0, 'last': None, 'size': 0}
+    stats = _Stats(progress)
+    with open(path, 'r+b' if state['size'] else 'wb') as f:
+        # drop whatever was written after the last batch checkpointed
+        f.truncate(state['size'])
+        f.seek(state['size'])
+        collections_ = ms._collections_for(query)
+        for i, collection in enumerate(collections_):
+            if i < state['collection']:
+                continue
+            last = state['last'] if i == state['collection'] else None
+            ranged = query
+            if last is not None:
+                ranged = {'$and': [query, {'_id': {'$gt': last}}]}
+            docs = collection.find(ranged, sort=[('_id', 1)],
+                                   batch_size=batch_size)
+            for batch in _chunks(docs, batch_size):
+                chunk = b''.join(encode(doc) for doc in batch)
+                if compress == 'gzip':
+                    chunk = gzip.compress(chunk, compresslevel=6)
+                f.write(chunk)
+                f.flush()
+                state = {'collection': i, 'last': batch[-1]['_id'],
+                         'size': f.tell()}
+                _save_checkpoint(checkpoint, state)
+                stats.batch(len(batch), len(chunk))
+            state = {'collection': i + 1, 'last': None, 'size': f.tell()}
+            _save_checkpoint(checkpoint, state)
+    _done(checkpoint)
+    return stats.stats
+
+
+def _open_input(path):
+    """
+    path opened for reading, through gzip if it's gzipped
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _records(f, format):
+    """
+    The raw docs (encoded as in the file) read from f
+    """
+    if format == 'ndjson':
+        blank = b''
+        for line in f:
+            if line.strip():
+                # blank lines go along with the next doc so the lengths
+                # add up to the offset in the file
+                yield blank + line
+                blank = b''
+            else:
+                blank += line
+        return
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise base.ValidationError('truncated BSON file')
+        size, = struct.unpack('<i', header)
+        body = f.read(size - 4)
+        if len(body) < size - 4:
+            raise base.ValidationError('truncated BSON file')
+        yield header + body
+
+
+def _check_batch(ms, format, raws):
+    """
+    (index, error) for the docs of a batch that don't validate against
+    the schema of ms. Runs in the worker processes.
+    """
+    errors = []
+    for i, raw in enumerate(raws):
+        try:
+            ms._validate(dict(ms._fromdb(_decode(format, raw)).doc))
+        except (base.ValidationError, base.RequiredNotFoundException,
+                KeyError) as e:
+            errors.append((i, '%s: %s' % (type(e).__name__, e)))
+    return errors
+
+
+def _checked(ms, format, batches, validate, workers):
+    """
+    (raws, errors) for every batch, validated in order in this process
+    or (with workers) in a pool, a few batches ahead
+    """
+    if not validate:
+        for raws in batches:
+            yield raws, []
+        return
+    if not workers:
+        for raws in batches:
+            yield raws, _check_batch(ms, format, raws)
+        return
+    # only imported when there is a pool to run, they are slow to import
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for raws in batches:
+            pending.append((raws, pool.submit(
+                _check_batch, ms, format, raws)))
+            if len(pending) >= workers * BATCHES_PER_WORKER:
+                raws, future = pending.popleft()
+                yield raws, future.result()
+        while pending:
+            raws, future = pending.popleft()
+            yield raws, future.result()
+
+
+def _insert(ms, docs):
+    """
+    Insert docs in the collections they belong to. Returns how many were
+    inserted and how many were already there (from an earlier run).
+    """
+    groups = collections.defaultdict(list)
+    for doc in docs:
+        groups[ms._collection_for_doc(doc).full_name].append(doc)
+    inserted = existing = 0
+    for group in groups.values():
+        collection = ms._collection_for_doc(group[0])
+        try:
+            inserted += len(collection.insert_many(
+                group, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details['writeErrors']
+            if any(x['code'] != DUPLICATE_KEY for x in errors):
+                raise
+            inserted += e.details['nInserted']
+            existing += len(errors)
+    return inserted, existing
+
+
+def import_(ms, path, format, validate, workers, batch_size, checkpoint,
+            progress):
+    if format is None:
+        name = path[:-3] if path.endswith('.gz') else path
+        format = 'ndjson' if name.endswith(('.ndjson', '.json')) else 'bson'
+    if format not in FORMATS:
+        raise ValueError('format must be one of %s' % (FORMATS,))
+    state = _load_checkpoint(checkpoint) or {'offset': 0, 'docs': 0}
+    stats = _Stats(progress, inserted=0, existing=0)
+    with _open_input(path) as f:
+        f.seek(state['offset'])
+        batches = _chunks(_records(f, format), batch_size)
+        for raws, errors in _checked(ms, format, batches, validate, workers):
+            if errors:
+                i, error = errors[0]
+                raise base.ValidationError('doc %d of %s: %s' % (
+                    state['docs'] + i, path, error))
+            inserted, existing = _insert(
+                ms, [_decode(format, raw) for raw in raws])
+            nbytes = sum(len(raw) for raw in raws)
+            state = {'offset': state['offset'] + nbytes,
+                     'docs': state['docs'] + len(raws)}
+            _save_checkpoint(checkpoint, state)
+            stats.batch(len(raws), nbytes, inserted=inserted,
+                        existing=existing)
+    _done(checkpoint)
+    return stats.stats
@@ -2,8 +2,12 @@
 from flask import Flask, request
 
 # from this project
-from test import User, EmailEntry
-from base import register_flask_app, AuthError
+from test import User, EmailEntry, Embedding
+from mongoschema.base import (
+    register_flask_app, register_batch_route, AuthError, set_metrics_sink,
+    register_metrics_route,
+)
+from mongoschema.metrics import MemorySink
 
 app = Flask(__name__)
 
@@ -29,6 +33,9 @@ User.doc_route('get-with-params')
 User.doc_route('set-username', methods=['PATCH'])
 User.doc_route('useless-function', custom_response=custom_response)
 
+Embedding.doc_route('get')
+Embedding.doc_route('update', methods=['PUT'])
+
 
 def default_auth(*args):
     if not request.args.get('authparam') == 'supersecret':
@@ -60,6 +67,11 @@ EmailEntry.static_route('custom_static', auth=custom_static, methods=['POST'])
 EmailEntry.static_route('create', methods=['POST'])
 EmailEntry.doc_route('update', methods=['PATCH'], auth=custom_auth)
 
+register_batch_route()
+
+set_metrics_sink(MemorySink())
+register_metrics_route()
+
 print((app.url_map))
 
 if __name__ == '__main__':
@@ -0,0 +1,294 @@
+"""
+The flask side of doc_route/static_route and friends. base.py only
+imports this module (and so flask) once a route is registered.
+"""
+# python core
+import json
+import types
+import functools
+
+# 3rd party
+import bson
+from flask import request, Response, make_response, current_app
+
+# from this project
+from . import base, metrics
+
+
+def getparams():
+    """
+    This function must return a dictionary because all api calls to a
+    MongoDoc instance can only take **kwargs.
+    """
+    if request.method == 'GET':
+        params = {}
+        if request.args.get('json'):
+            params = json.loads(request.args['json'])
+    else:
+        params = request.get_json()
+    return params
+
+
+def default_response(retval):
+    if request.method == 'POST':
+        status = 201
+    elif request.method in ('GET', 'DELETE', 'PUT', 'PATCH'):
+        status = 200
+    if isinstance(retval, types.GeneratorType):
+        return Response(base._stream_json_array(retval),
+                        mimetype='application/json', status=status)
+    json_str = base.to_json(retval)
+    resp = Response(json_str, mimetype='application/json', status=status)
+    return resp
+
+
+def timed_route(routename, func):
+    """
+    Wraps a generated route so it is measured while a sink is set
+    """
+    @functools.wraps(func)
+    def timed_route(*args, **kwargs):
+        sink = base.METRICS_SINK
+        if sink is None:
+            return func(*args, **kwargs)
+        with metrics.RouteTimer(routename, sink) as timer:
+            resp = func(*args, **kwargs)
+            timer.status = getattr(resp, 'status_code', 200)
+            if getattr(resp, 'is_streamed', False):
+                # the docs of a streamed list are loaded as it's sent
+                resp.response = timer.stream(resp.response)
+        return resp
+    return timed_route
+
+
+def not_modified(etag, cache_control):
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    if cache_control:
+        resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+def get_route_response(ms, md, response_func, cache_control):
+    """
+    The response of a doc_route('get'): a 304 if the client's
+    If-None-Match has the current ETag, so the doc isn't serialized.
+    """
+    etag = ms._doc_etag(md)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag, cache_control)
+    resp = make_response(response_func(md))
+    resp.set_etag(etag)
+    if cache_control:
+        resp.headers['Cache-Control'] = cache_control
+    return resp
+
+
+def doc_route(ms, name=None, custom_response=None, auth=None,
+              cache_control=None, etag_precheck=False):
+    """
+    Generates the function that will be registered with flask.
+    """
+    cache_control = cache_control or ms.cache_control
+
+    def real_route(oid):
+        """
+        This is the actual function that will be executed by flask when
+        the route corresponding to the doc_route is matched..
+        """
+        try:
+            authfunc = auth or ms._get_doc_auth_func()
+            if name == 'get' and etag_precheck and not authfunc:
+                # answer from the ETag remembered for the doc without
+                # even looking it up
+                etag = ms._cached_etag(ms._db_id(oid))
+                if etag and request.if_none_match.contains(etag):
+                    return not_modified(etag, cache_control)
+            response_func = custom_response or ms._flask_response
+            keys = ms._route_fields(request.args) if name == 'get' else None
+            if keys is not None:
+                # the auth function runs inside, on the projected doc
+                with metrics.phase('load'):
+                    picked = ms._get_fields(oid, keys, authfunc)
+                if picked is None:
+                    return Response('%s<%s> not found' % (
+                        ms.__name__, oid), status=404)
+                with metrics.phase('encode'):
+                    return response_func(picked)
+            with metrics.phase('load'):
+                md = ms.get(id=oid)
+            if md is None:
+                return Response(
+                    '%s<%s> not found' % (ms.__name__, oid), status=404)
+            if authfunc:
+                with metrics.phase('auth'):
+                    authfunc(md)
+            if name == 'get':
+                with metrics.phase('encode'):
+                    return get_route_response(
+                        ms, md, response_func, cache_control)
+            params = None if name == 'remove' else getparams()
+            with metrics.phase('handler'):
+                retval = ms._call_doc_func(md, name, oid, params)
+            with metrics.phase('encode'):
+                return response_func(retval)
+        except base.AuthError as e:
+            return Response(e.msg, status=e.status)
+        except bson.errors.InvalidId as e:
+            return Response(str(e), status=404)
+        except base.ValidationError as e:
+            return Response(str(e), status=400)
+    return real_route
+
+
+def static_route(ms, name=None, custom_response=None, auth=None):
+    def real_route():
+        try:
+            authfunc = auth or ms._get_static_auth_func()
+            if authfunc:
+                with metrics.phase('auth'):
+                    authfunc()
+            response_func = custom_response or ms._flask_response
+            params = getparams() if name is not None else None
+            with metrics.phase('handler'):
+                retval = ms._call_static_func(
+                    name, params, request.args, custom_response)
+            # a streamed list is mostly encoded after this returns
+            with metrics.phase('encode'):
+                return response_func(retval)
+        except base.AuthError as e:
+            return Response(e.msg, status=e.status)
+        except (bson.errors.InvalidId, base.ValidationError) as e:
+            return Response(str(e), status=400)
+    return real_route
+
+
+def batch_response(ms, custom_response, retval, methods):
+    """
+    (status, body) of one operation of a batch. Custom response
+    functions are run and their json decoded, the default one is
+    skipped since the whole batch is serialized at once.
+    """
+    if not custom_response and not base.RESPONSE_FUNC:
+        status = 201 if methods and 'POST' in methods else 200
+        if isinstance(retval, types.GeneratorType):
+            retval = list(retval)
+        return status, retval
+    resp = make_response((custom_response or ms._flask_response)(retval))
+    body = resp.get_data(as_text=True)
+    try:
+        # custom response functions usually return json without
+        # setting the mimetype
+        body = json.loads(body)
+    except ValueError:
+        pass
+    return resp.status_code, body
+
+
+def op_request(op, methods):
+    """
+    A request context for one operation of a batch, where request.args
+    are the operation's args, its params are the json body and the
+    method is its route's. The auth and response functions see what
+    they would on the route itself, and the headers (cookies, tokens...)
+    are the batch request's.
+    """
+    headers = [(k, v) for k, v in request.headers.items()
+               if k.lower() not in ('content-type', 'content-length')]
+    return current_app.test_request_context(
+        request.path, method=methods[0] if methods else 'GET',
+        query_string=op.get('args') or {}, json=op.get('params'),
+        headers=headers)
+
+
+def run_batch_op(ms, op, docs):
+    """
+    Runs one operation of a batch exactly like its route would, with
+    the doc from docs (filled by a single get_many per schema).
+    """
+    oid = op.get('oid')
+    kind = 'static' if oid is None else 'doc'
+    name = op.get('method') or ('list' if oid is None else 'get')
+    route = ms.__dict__.get('_routes', {}).get((kind, name))
+    if route is None:
+        return 404, 'No %s route %s for %s' % (kind, name, ms.__name__)
+    with op_request(op, route[3]):
+        return _run_batch_op(ms, op, docs, route)
+
+
+def _run_batch_op(ms, op, docs, route):
+    oid = op.get('oid')
+    params = op.get('params')
+    funcname, custom_response, auth, methods = route
+    if oid is not None:
+        key = (ms, ms._db_id(oid))
+        if key not in docs:
+            # changed by an earlier operation of the batch
+            docs[key] = ms.get(id=oid)
+        md = docs[key]
+        if md is None:
+            return 404, '%s<%s> not found' % (ms.__name__, oid)
+        authfunc = auth or ms._get_doc_auth_func()
+        if authfunc:
+            authfunc(md)
+        keys = ms._route_fields(op.get('args') or {})
+        if funcname == 'get' and keys is not None:
+            retval = ms._pick_fields(md.doc, keys)
+        elif funcname == 'get':
+            retval = md
+        else:
+            # may change or remove it, later operations fetch it again
+            docs.pop(key)
+            retval = ms._call_doc_func(md, funcname, oid, params or {})
+    else:
+        authfunc = auth or ms._get_static_auth_func()
+        if authfunc:
+            authfunc()
+        retval = ms._call_static_func(
+            funcname, params, op.get('args') or {}, custom_response)
+    return batch_response(ms, custom_response, retval, methods)
+
+
+def batch_route():
+    ops = request.get_json()
+    if type(ops) is not list or not all(type(op) is dict for op in ops):
+        return Response('Expected a list of operations', status=400)
+    schemas = {}
+    for ms in base.MongoSchema._get_all_classes():
+        if ms.__dict__.get('_routes'):
+            schemas[ms.__name__.lower()] = ms
+    wanted = {}
+    for op in ops:
+        ms = schemas.get(op.get('schema'))
+        if ms is not None and op.get('oid') is not None:
+            try:
+                wanted.setdefault(ms, []).append(ms._db_id(op['oid']))
+            except bson.errors.InvalidId:
+                pass
+    docs = {}
+    for ms, ids in wanted.items():
+        for _id, md in zip(ids, ms.get_many(ids)):
+            docs[(ms, _id)] = md
+    results = []
+    for op in ops:
+        ms = schemas.get(op.get('schema'))
+        try:
+            if ms is None:
+                status, body = 404, 'Unknown schema %s' % op.get('schema')
+            else:
+                status, body = run_batch_op(ms, op, docs)
+        except base.AuthError as e:
+            status, body = e.status, e.msg
+        except bson.errors.InvalidId as e:
+            status, body = 404, str(e)
+        except base.ValidationError as e:
+            status, body = 400, str(e)
+        results.append({'status': status, 'body': body})
+    return Response(base.to_json(results), mimetype='application/json')
+
+
+def metrics_route(sink):
+    def metrics_route():
+        return Response((sink or base.METRICS_SINK).prometheus(),
+                        mimetype='text/plain; version=0.0.4')
+    return metrics_route
@@ -0,0 +1,246 @@
+# python core
+import time
+import random
+import logging
+import threading
+
+# 3rd party
+import bson
+
+KINDS = ('query', 'write', 'cache_hit', 'cache_miss')
+
+_listeners = {kind: [] for kind in KINDS}
+
+
+class DbEvent(object):
+    """
+    What listeners are called with. shape is the query with every value
+    replaced by '?', count the number of docs read or written, bytes
+    their BSON size and cache, for cache events, the tier that was asked
+    ('local' or 'shared'). ms is the schema class, collection the one the
+    operation went to and query and sort what was sent.
+    """
+    __slots__ = ('kind', 'schema', 'operation', 'shape', 'duration', 'count',
+                 'bytes', 'cache', 'ms', 'collection', 'query', 'sort')
+
+    def __init__(self, kind, ms, operation, query, duration=0, count=0,
+                 bytes=0, cache=None, collection=None, sort=None):
+        self.kind = kind
+        self.ms = ms
+        self.schema = ms.__name__
+        self.operation = operation
+        self.query = query
+        self.shape = query_shape(query)
+        self.duration = duration
+        self.count = count
+        self.bytes = bytes
+        self.cache = cache
+        self.collection = collection
+        self.sort = sort
+
+    def __repr__(self):
+        return '<DbEvent %s %s.%s %s %.2fms count=%s bytes=%s%s>' % (
+            self.kind, self.schema, self.operation, self.shape,
+            self.duration * 1000, self.count, self.bytes,
+            ' cache=%s' % self.cache if self.cache else '')
+
+
+def _add(kind, listener):
+    _listeners[kind].append(listener)
+    return listener
+
+
+def on_query(listener):
+    """
+    Call listener(event) after every read (get, get_many, find, count,
+    reload). Can be used as a decorator.
+    """
+    return _add('query', listener)
+
+
+def on_write(listener):
+    """
+    Call listener(event) after every write (insert, update, remove,
+    update_single_field, unset).
+    """
+    return _add('write', listener)
+
+
+def on_cache_hit(listener):
+    return _add('cache_hit', listener)
+
+
+def on_cache_miss(listener):
+    return _add('cache_miss', listener)
+
+
+def remove_listener(listener):
+    for listeners in _listeners.values():
+        while listener in listeners:
+            listeners.remove(listener)
+
+
+def query_shape(query):
+    """
+    query with the values replaced by '?' so queries differing only by
+    their values look the same
+    """
+    if type(query) is dict:
+        return {key: query_shape(value) for key, value in query.items()}
+    elif type(query) in (list, tuple) and query and \
+            all(type(x) is dict for x in query):
+        # $and, $or, ...
+        return [query_shape(x) for x in query]
+    return '?'
+
+
+def start(kind):
+    """
+    The time a database operation starts at if anybody listens to kind,
+    None otherwise (so it costs next to nothing).
+    """
+    if _listeners[kind]:
+        return time.perf_counter()
+    return None
+
+
+def done(kind, started, ms, collection, operation, query, docs=(),
+         count=None):
+    """
+    Tell the kind listeners about an operation that was start()ed
+    """
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+    nbytes = sum(len(bson.encode(doc)) for doc in docs)
+    event = DbEvent(kind, ms, operation, query, duration,
+                    len(docs) if count is None else count, nbytes,
+                    collection=collection)
+    for listener in _listeners[kind]:
+        listener(event)
+
+
+def observe_cursor(cursor, started, ms, collection, operation, query,
+                   sort=None):
+    """
+    Iterates cursor and tells the query listeners about it once it's
+    exhausted, closed early (break, islice...) or failed, only counting
+    the time spent fetching and the docs fetched so far.
+    """
+    elapsed = time.perf_counter() - started
+    count, nbytes = 0, 0
+    docs = iter(cursor)
+    try:
+        while True:
+            before = time.perf_counter()
+            try:
+                doc = next(docs)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - before
+            count += 1
+            nbytes += len(bson.encode(doc))
+            yield doc
+    finally:
+        _query_done(ms, collection, operation, query, sort, elapsed, count,
+                    nbytes)
+
+
+def _query_done(ms, collection, operation, query, sort, elapsed, count,
+                nbytes):
+    event = DbEvent('query', ms, operation, query, elapsed, count, nbytes,
+                    collection=collection, sort=sort)
+    for listener in _listeners['query']:
+        listener(event)
+
+
+async def observe_async_cursor(cursor, started, ms, collection, operation,
+                               query, sort=None):
+    """
+    observe_cursor for a cursor iterated with async for
+    """
+    elapsed = time.perf_counter() - started
+    count, nbytes = 0, 0
+    docs = cursor.__aiter__()
+    try:
+        while True:
+            before = time.perf_counter()
+            try:
+                doc = await docs.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - before
+            count += 1
+            nbytes += len(bson.encode(doc))
+            yield doc
+    finally:
+        _query_done(ms, collection, operation, query, sort, elapsed, count,
+                    nbytes)
+
+
+def cache(hit, ms, query, tier):
+    kind = 'cache_hit' if hit else 'cache_miss'
+    if not _listeners[kind]:
+        return
+    event = DbEvent(kind, ms, 'get', query, count=1 if hit else 0,
+                    cache=tier)
+    for listener in _listeners[kind]:
+        listener(event)
+
+
+class SlowOpLog(object):
+    """
+    Listener logging operations slower than threshold seconds, only a
+    sample_rate fraction of them:
+
+        hooks.on_query(hooks.SlowOpLog(threshold=0.05, sample_rate=0.1))
+    """
+
+    def __init__(self, threshold=0.1, sample_rate=1.0, logger=None):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.logger = logger or logging.getLogger('mongoschema')
+
+    def __call__(self, event):
+        if event.duration < self.threshold:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        self.logger.warning(
+            'slow %s %s.%s %s took %.1fms (%s docs, %s bytes)',
+            event.kind, event.schema, event.operation, event.shape,
+            event.duration * 1000, event.count, event.bytes)
+
+
+class SchemaCounters(object):
+    """
+    Listener adding up, per (schema, operation) and kind: the number of
+    operations, docs, bytes and seconds.
+
+        counters = hooks.SchemaCounters().listen()
+        counters.counts[('User', 'get')]['query']['ops']
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def listen(self):
+        for kind in KINDS:
+            _add(kind, self)
+        return self
+
+    def __call__(self, event):
+        key = (event.schema, event.operation)
+        with self._lock:
+            kinds = self.counts.setdefault(key, {})
+            if event.kind not in kinds:
+                kinds[event.kind] = {'ops': 0, 'docs': 0, 'bytes': 0,
+                                     'seconds': 0}
+            counts = kinds[event.kind]
+            counts['ops'] += 1
+            counts['docs'] += event.count
+            counts['bytes'] += event.bytes
+            counts['seconds'] += event.duration
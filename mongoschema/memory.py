@@ -0,0 +1,836 @@
+"""
+A collection kept in memory, standing in for a pymongo one where no
+server is wanted (tests, benchmarks, ephemeral data):
+
+    class Session(MongoSchema):
+        collection = InMemoryCollection('session')
+        indexes = ['user', [(('expires', 1),), {}]]
+
+Collections belong to an InMemoryDatabase (one is made for the database
+name given, 'memory' by default), which gives the sub-collections
+(collection['202401']) and list_collection_names that partition_by and
+parallel_scan use.
+
+It implements the part of pymongo's Collection mongoschema uses: find
+and find_one with the common query operators, sort, skip, limit and
+projection, insert_one/insert_many, update_one/update_many with $set,
+$unset, $inc and $push, delete_one/delete_many, bulk_write,
+count_documents, a small aggregate ($match, $sample, $project, $sort,
+$limit) and create_index.
+
+Docs are kept BSON encoded, like a server keeps them, so every read
+decodes a fresh copy. Indexes are real: each one is a hash of the values
+of its fields, used for equality on all of them, and a sorted list of
+the values of its first field, used for equality and ranges on it. All
+the operations take one lock, so a collection can be shared by threads.
+"""
+# python core
+import re
+import bisect
+import random
+import datetime
+import threading
+import itertools
+
+# 3rd party
+import bson
+from bson.objectid import ObjectId
+from pymongo.errors import (
+    BulkWriteError, DuplicateKeyError, OperationFailure,
+)
+from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo.results import (
+    InsertOneResult, InsertManyResult, UpdateResult, DeleteResult,
+    BulkWriteResult,
+)
+
+
+class _Missing(object):
+
+    def __repr__(self):
+        return '<missing>'
+
+
+MISSING = _Missing()
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+
+
+def _type_rank(value):
+    """
+    Where the type of value comes in BSON's comparison order
+    """
+    if value is None or value is MISSING:
+        return 1
+    elif isinstance(value, bool):
+        return 8
+    elif isinstance(value, (int, float)):
+        return 2
+    elif isinstance(value, str):
+        return 3
+    elif isinstance(value, dict):
+        return 4
+    elif isinstance(value, (list, tuple)):
+        return 5
+    elif isinstance(value, (bytes, bson.binary.Binary)):
+        return 6
+    elif isinstance(value, ObjectId):
+        return 7
+    elif isinstance(value, datetime.datetime):
+        return 9
+    return 10
+
+
+def _key(value):
+    """
+    A hashable key of value, ordered like BSON orders values (types
+    first, then values of the same type)
+    """
+    rank = _type_rank(value)
+    if rank == 1:
+        return (1, 0)
+    elif rank == 4:
+        return (4, tuple((k, _key(v)) for k, v in value.items()))
+    elif rank == 5:
+        return (5, tuple(_key(x) for x in value))
+    elif rank == 10:
+        return (10, repr(value))
+    return (rank, value)
+
+
+def _get_path(doc, path):
+    """
+    The value at a dotted path, going into the docs of arrays on the
+    way (so 'a.b' of {'a': [{'b': 1}, {'b': 2}]} is [1, 2])
+    """
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            if part.isdigit():
+                index = int(part)
+                value = value[index] if index < len(value) else MISSING
+            else:
+                values = [x.get(part, MISSING) for x in value
+                          if isinstance(x, dict)]
+                values = [x for x in values if x is not MISSING]
+                value = values if values else MISSING
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def _candidates(value):
+    """
+    The values a condition is tried against: value itself and, for
+    arrays, each of their elements
+    """
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _compare(value, operator, wanted):
+    if _type_rank(value) != _type_rank(wanted):
+        return False
+    value, wanted = _key(value), _key(wanted)
+    if operator == '$gt':
+        return value > wanted
+    elif operator == '$gte':
+        return value >= wanted
+    elif operator == '$lt':
+        return value < wanted
+    return value <= wanted
+
+
+def _equals(value, wanted):
+    if isinstance(wanted, (re.Pattern, bson.regex.Regex)):
+        return any(isinstance(x, str) and _regex(wanted).search(x)
+                   for x in _candidates(value))
+    wanted = _key(None if wanted is MISSING else wanted)
+    return any(_key(x) == wanted for x in _candidates(value))
+
+
+def _regex(pattern):
+    if isinstance(pattern, bson.regex.Regex):
+        return pattern.try_compile()
+    return pattern
+
+
+def _is_operators(condition):
+    return isinstance(condition, dict) and condition and \
+        all(key.startswith('$') for key in condition)
+
+
+def _matches_condition(value, condition):
+    if not _is_operators(condition):
+        return _equals(value, condition)
+    for operator, wanted in condition.items():
+        if operator == '$eq':
+            ok = _equals(value, wanted)
+        elif operator == '$ne':
+            ok = not _equals(value, wanted)
+        elif operator in RANGE_OPERATORS:
+            ok = value is not MISSING and any(
+                _compare(x, operator, wanted) for x in _candidates(value))
+        elif operator == '$in':
+            ok = any(_equals(value, x) for x in wanted)
+        elif operator == '$nin':
+            ok = not any(_equals(value, x) for x in wanted)
+        elif operator == '$exists':
+            ok = (value is not MISSING) == bool(wanted)
+        elif operator == '$not':
+            ok = not _matches_condition(value, wanted)
+        elif operator == '$regex':
+            pattern = re.compile(wanted, _regex_flags(condition))
+            ok = any(isinstance(x, str) and pattern.search(x)
+                     for x in _candidates(value))
+        elif operator == '$options':
+            continue
+        elif operator == '$size':
+            ok = isinstance(value, list) and len(value) == wanted
+        elif operator == '$all':
+            ok = all(_equals(value, x) for x in wanted)
+        elif operator == '$elemMatch':
+            ok = isinstance(value, list) and any(
+                _matches(x, wanted) if isinstance(x, dict)
+                else _matches_condition(x, wanted) for x in value)
+        else:
+            raise OperationFailure('unknown operator: %s' % operator)
+        if not ok:
+            return False
+    return True
+
+
+def _regex_flags(condition):
+    flags = 0
+    for option in condition.get('$options', ''):
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}[option]
+    return flags
+
+
+def _matches(doc, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(doc, x) for x in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(doc, x) for x in condition):
+                return False
+        elif key == '$nor':
+            if any(_matches(doc, x) for x in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: %s' % key)
+        elif not _matches_condition(_get_path(doc, key), condition):
+            return False
+    return True
+
+
+def _sort_docs(docs, sort):
+    # stable sorts, least significant key first
+    for key, direction in reversed(sort):
+        docs.sort(key=lambda doc: _sort_value(_get_path(doc, key), direction),
+                  reverse=direction < 0)
+    return docs
+
+
+def _sort_value(value, direction):
+    """
+    Arrays sort by their smallest element ascending, their largest
+    descending
+    """
+    if isinstance(value, list) and value:
+        keys = [_key(x) for x in value]
+        return min(keys) if direction > 0 else max(keys)
+    return _key(None if value is MISSING else value)
+
+
+def _sort_spec(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, direction or 1)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [tuple(x) for x in key_or_list]
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = dict.fromkeys(projection, True)
+    include = [k for k, v in projection.items() if v and k != '_id']
+    if include:
+        result = {}
+        if projection.get('_id', True) and '_id' in doc:
+            result['_id'] = doc['_id']
+        for path in include:
+            _copy_path(doc, result, path)
+        return result
+    result = dict(doc)
+    for path, keep in projection.items():
+        if not keep:
+            _unset_path(result, path)
+    return result
+
+
+def _copy_path(source, target, path):
+    first, _, rest = path.partition('.')
+    if first not in source:
+        return
+    if not rest:
+        target[first] = source[first]
+    elif isinstance(source[first], dict):
+        _copy_path(source[first], target.setdefault(first, {}), rest)
+
+
+def _parent(doc, path, create):
+    """
+    (the dict holding the last part of path, that part)
+    """
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if part not in doc and create:
+            doc[part] = {}
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            if create:
+                raise OperationFailure('cannot create field in %s' % path)
+            return None, parts[-1]
+    return doc, parts[-1]
+
+
+def _unset_path(doc, path):
+    parent, key = _parent(doc, path, False)
+    if parent is not None:
+        parent.pop(key, None)
+
+
+def _apply_update(doc, update):
+    for operator, fields in update.items():
+        if operator not in ('$set', '$unset', '$inc', '$push'):
+            raise OperationFailure('unsupported update operator %s' % operator)
+        for path, value in fields.items():
+            if operator == '$unset':
+                _unset_path(doc, path)
+                continue
+            parent, key = _parent(doc, path, True)
+            if operator == '$set':
+                parent[key] = value
+            elif operator == '$inc':
+                parent[key] = parent.get(key, 0) + value
+            else:
+                current = parent.setdefault(key, [])
+                if not isinstance(current, list):
+                    raise OperationFailure('%s is not an array' % path)
+                if isinstance(value, dict) and '$each' in value:
+                    current.extend(value['$each'])
+                else:
+                    current.append(value)
+
+
+class _Index(object):
+    """
+    One index of an InMemoryCollection: the _ids of the docs by the
+    values of the index's fields (hashed) and by the value of its first
+    field (sorted). Arrays are indexed by each of their elements as well.
+    """
+
+    def __init__(self, name, keys, unique=False, sparse=False):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, _ in keys]
+        self.unique = unique
+        self.sparse = sparse
+        self.hashed = {}
+        self.sorted_keys = []
+        self.sorted_ids = []
+
+    def info(self):
+        info = {'key': list(self.keys)}
+        if self.unique:
+            info['unique'] = True
+        if self.sparse:
+            info['sparse'] = True
+        return info
+
+    def _entries(self, doc):
+        """
+        The hash keys of doc, [] if a sparse index leaves it out
+        """
+        values = [_get_path(doc, field) for field in self.fields]
+        if self.sparse and all(x is MISSING for x in values):
+            return []
+        options = [set(_key(x) for x in _candidates(
+            None if value is MISSING else value)) for value in values]
+        return list(itertools.product(*options))
+
+    def check_unique(self, doc, _id):
+        if not self.unique:
+            return
+        for entry in self._entries(doc):
+            if self.hashed.get(entry, set()) - set([_id]):
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: %s dup key: %s' % (
+                        self.name, entry))
+
+    def add(self, doc, _id):
+        entries = self._entries(doc)
+        for entry in entries:
+            self.hashed.setdefault(entry, set()).add(_id)
+        for first in set(entry[0] for entry in entries):
+            position = bisect.bisect_right(self.sorted_keys, first)
+            self.sorted_keys.insert(position, first)
+            self.sorted_ids.insert(position, _id)
+
+    def remove(self, doc, _id):
+        entries = self._entries(doc)
+        for entry in entries:
+            ids = self.hashed.get(entry)
+            if ids is not None:
+                ids.discard(_id)
+                if not ids:
+                    del self.hashed[entry]
+        for first in set(entry[0] for entry in entries):
+            lo = bisect.bisect_left(self.sorted_keys, first)
+            hi = bisect.bisect_right(self.sorted_keys, first)
+            position = self.sorted_ids.index(_id, lo, hi)
+            del self.sorted_keys[position]
+            del self.sorted_ids[position]
+
+    def lookup(self, query):
+        """
+        The _ids of every doc that may match query, None if this index
+        can't narrow it down
+        """
+        equal = [_equality(query.get(field, MISSING)) for field in self.fields]
+        if all(x is not None for x in equal) and not self.sparse:
+            ids = []
+            for entry in itertools.product(*equal):
+                ids.extend(self.hashed.get(entry, ()))
+            return ids
+        condition = query.get(self.fields[0])
+        if self.sparse and self._matches_missing(equal[0], condition):
+            # the docs it leaves out (without the fields) match as well
+            return None
+        if equal[0] is not None:
+            ids = []
+            for first in equal[0]:
+                lo = bisect.bisect_left(self.sorted_keys, first)
+                hi = bisect.bisect_right(self.sorted_keys, first)
+                ids.extend(self.sorted_ids[lo:hi])
+            return ids
+        if _is_operators(condition) and \
+                any(x in RANGE_OPERATORS for x in condition):
+            return self._range(condition)
+        return None
+
+    @staticmethod
+    def _matches_missing(equal, condition):
+        """
+        Whether the condition on the first field is satisfied by docs
+        without the field
+        """
+        if equal is not None:
+            return _key(None) in equal
+        return _is_operators(condition) and any(
+            condition[x] is None for x in RANGE_OPERATORS if x in condition)
+
+    def _range(self, condition):
+        lo, hi = 0, len(self.sorted_keys)
+        for operator, wanted in condition.items():
+            if operator not in RANGE_OPERATORS:
+                continue
+            wanted = _key(wanted)
+            # ranges only match values of the same type
+            lo = max(lo, bisect.bisect_left(self.sorted_keys, wanted[:1]))
+            hi = min(hi, bisect.bisect_left(
+                self.sorted_keys, (wanted[0] + 1,)))
+            if operator == '$gt':
+                lo = max(lo, bisect.bisect_right(self.sorted_keys, wanted))
+            elif operator == '$gte':
+                lo = max(lo, bisect.bisect_left(self.sorted_keys, wanted))
+            elif operator == '$lt':
+                hi = min(hi, bisect.bisect_left(self.sorted_keys, wanted))
+            else:
+                hi = min(hi, bisect.bisect_right(self.sorted_keys, wanted))
+        return self.sorted_ids[lo:hi]
+
+
+def _equality(condition):
+    """
+    The keys a condition on one field is satisfied by when it is an
+    equality ($eq, $in or a plain value), None otherwise
+    """
+    if condition is MISSING:
+        return None
+    if _is_operators(condition):
+        if list(condition) == ['$eq']:
+            condition = condition['$eq']
+        elif list(condition) == ['$in']:
+            if any(isinstance(x, (re.Pattern, bson.regex.Regex))
+                   for x in condition['$in']):
+                return None
+            return set(_key(x) for x in condition['$in'])
+        else:
+            return None
+    if isinstance(condition, (re.Pattern, bson.regex.Regex, list)):
+        return None
+    return set([_key(condition)])
+
+
+class InMemoryCursor(object):
+    """
+    The part of a pymongo Cursor mongoschema uses. Docs are only looked
+    up when iterated.
+    """
+
+    def __init__(self, collection, query, projection=None, skip=0, limit=0,
+                 sort=None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._skip = skip
+        self._limit = limit
+        self._sort = _sort_spec(sort) if sort else None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_spec(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        docs = self.collection._find(self.query)
+        if self._sort:
+            docs = _sort_docs(list(docs), self._sort)
+        stop = self._skip + self._limit if self._limit else None
+        for doc in itertools.islice(docs, self._skip, stop):
+            yield _project(doc, self.projection)
+
+
+class InMemoryDatabase(object):
+    """
+    The InMemoryCollections of a database by name, the part of a pymongo
+    Database mongoschema uses
+    """
+
+    def __init__(self, name='memory'):
+        self.name = name
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = InMemoryCollection(name, self)
+            return collection
+
+    def list_collection_names(self, filter=None):
+        """
+        The collections with docs or indexes, the ones matching filter
+        (on their name) if one is given
+        """
+        with self._lock:
+            names = [name for name, collection in self._collections.items()
+                     if collection._docs or collection._indexes]
+        if filter:
+            names = [x for x in names if _matches({'name': x}, filter)]
+        return sorted(names)
+
+    def drop_collection(self, name):
+        with self._lock:
+            collection = self._collections.get(name)
+        if collection is not None:
+            collection.drop()
+
+
+# the databases InMemoryCollections made with a database name go to
+_DATABASES = {}
+_DATABASES_LOCK = threading.Lock()
+
+
+def _database(name):
+    with _DATABASES_LOCK:
+        if name not in _DATABASES:
+            _DATABASES[name] = InMemoryDatabase(name)
+        return _DATABASES[name]
+
+
+class InMemoryCollection(object):
+
+    def __init__(self, name='collection', database='memory'):
+        if isinstance(database, str):
+            database = _database(database)
+        self.name = name
+        self.database = database
+        self.full_name = '%s.%s' % (database.name, name)
+        self._docs = {}
+        self._indexes = {}
+        self._lock = threading.RLock()
+        # a new collection replaces the one of the same name
+        with database._lock:
+            database._collections[name] = self
+
+    def __getitem__(self, name):
+        return self.database['%s.%s' % (self.name, name)]
+
+    def _lookup(self, query):
+        """
+        The _ids of the docs that may match query: all of them unless
+        the _id or an index narrows it down
+        """
+        equal = _equality(query.get('_id', MISSING))
+        if equal is not None:
+            return [key[1] for key in equal if key[1] in self._docs]
+        best = None
+        for index in self._indexes.values():
+            ids = index.lookup(query)
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        if best is None:
+            return list(self._docs)
+        # arrays are indexed by each element, a doc can come up twice
+        return list(dict.fromkeys(best))
+
+    def _find(self, query):
+        """
+        The decoded docs matching query: in insertion order, or in index
+        order when an index narrowed the query down
+        """
+        with self._lock:
+            raws = [self._docs[x] for x in self._lookup(query)]
+        for raw in raws:
+            doc = bson.decode(raw)
+            if _matches(doc, query):
+                yield doc
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None,
+             **kwargs):
+        return InMemoryCursor(self, filter, projection, skip, limit, sort)
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for doc in self.find(filter, projection, limit=1, **kwargs):
+            return doc
+        return None
+
+    def count_documents(self, filter, skip=0, limit=0):
+        docs = itertools.islice(self._find(filter), skip,
+                                skip + limit if limit else None)
+        return sum(1 for _ in docs)
+
+    def _store(self, doc, old=None):
+        """
+        Write doc, checking and updating every index. old is the doc it
+        replaces.
+        """
+        _id = doc['_id']
+        for index in self._indexes.values():
+            index.check_unique(doc, _id)
+        raw = bson.encode(doc)
+        for index in self._indexes.values():
+            if old is not None:
+                index.remove(old, _id)
+            index.add(doc, _id)
+        self._docs[_id] = raw
+
+    def insert_one(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        with self._lock:
+            if document['_id'] in self._docs:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: _id_ dup key: %s' % (
+                        document['_id'],))
+            # what a server stores: the BSON types, not the python ones
+            self._store(bson.decode(bson.encode(document)))
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered=True):
+        ids, errors = [], []
+        for i, doc in enumerate(documents):
+            try:
+                ids.append(self.insert_one(doc).inserted_id)
+            except DuplicateKeyError as e:
+                errors.append({'index': i, 'code': 11000, 'errmsg': str(e),
+                               'op': doc})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({
+                'writeErrors': errors, 'writeConcernErrors': [],
+                'nInserted': len(ids), 'nUpserted': 0, 'nMatched': 0,
+                'nModified': 0, 'nRemoved': 0, 'upserted': []})
+        return InsertManyResult(ids, True)
+
+    def update_one(self, filter, update, upsert=False):
+        with self._lock:
+            old = next(self._find(filter), None)
+            if old is None:
+                if not upsert:
+                    return UpdateResult({'n': 0, 'nModified': 0}, True)
+                doc = {k: v for k, v in filter.items()
+                       if not k.startswith('$') and not _is_operators(v)}
+                _apply_update(doc, update)
+                _id = self.insert_one(doc).inserted_id
+                return UpdateResult({'n': 1, 'nModified': 0,
+                                     'upserted': _id}, True)
+            modified = self._update(old, update)
+        return UpdateResult({'n': 1, 'nModified': int(modified)}, True)
+
+    def _update(self, old, update):
+        """
+        Apply update to the stored doc old, if it changes anything
+        """
+        doc = bson.decode(bson.encode(old))
+        _apply_update(doc, update)
+        if doc.get('_id') != old['_id']:
+            raise OperationFailure('the _id field cannot be changed')
+        doc = bson.decode(bson.encode(doc))
+        if doc == old:
+            return False
+        self._store(doc, old)
+        return True
+
+    def update_many(self, filter, update, upsert=False):
+        with self._lock:
+            docs = list(self._find(filter))
+            if not docs and upsert:
+                return self.update_one(filter, update, upsert=True)
+            modified = sum(self._update(doc, update) for doc in docs)
+        return UpdateResult({'n': len(docs), 'nModified': modified}, True)
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        InsertOne, UpdateOne, UpdateMany, DeleteOne and DeleteMany
+        requests, one after the other under the lock
+        """
+        result = {'nInserted': 0, 'nMatched': 0, 'nModified': 0,
+                  'nUpserted': 0, 'nRemoved': 0, 'upserted': []}
+        with self._lock:
+            for i, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self.insert_one(request._doc)
+                    result['nInserted'] += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    update = self.update_one \
+                        if isinstance(request, UpdateOne) else self.update_many
+                    done = update(request._filter, request._doc,
+                                  upsert=request._upsert)
+                    if done.upserted_id is not None:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': i, '_id': done.upserted_id})
+                    else:
+                        result['nMatched'] += done.matched_count
+                        result['nModified'] += done.modified_count
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    delete = self.delete_one \
+                        if isinstance(request, DeleteOne) else self.delete_many
+                    result['nRemoved'] += delete(
+                        request._filter).deleted_count
+                else:
+                    raise TypeError('%r is not a valid request' % (request,))
+        return BulkWriteResult(result, True)
+
+    def _delete(self, doc):
+        for index in self._indexes.values():
+            index.remove(doc, doc['_id'])
+        del self._docs[doc['_id']]
+
+    def delete_one(self, filter):
+        with self._lock:
+            doc = next(self._find(filter), None)
+            if doc is None:
+                return DeleteResult({'n': 0}, True)
+            self._delete(doc)
+        return DeleteResult({'n': 1}, True)
+
+    def delete_many(self, filter):
+        with self._lock:
+            docs = list(self._find(filter))
+            for doc in docs:
+                self._delete(doc)
+        return DeleteResult({'n': len(docs)}, True)
+
+    def create_index(self, keys, **kwargs):
+        keys = _sort_spec(keys, 1)
+        name = kwargs.get('name') or '_'.join(
+            '%s_%s' % (field, direction) for field, direction in keys)
+        with self._lock:
+            if name in self._indexes:
+                return name
+            index = _Index(name, keys, kwargs.get('unique', False),
+                           kwargs.get('sparse', False))
+            docs = [bson.decode(raw) for raw in self._docs.values()]
+            for doc in docs:
+                index.check_unique(doc, doc['_id'])
+                index.add(doc, doc['_id'])
+            self._indexes[name] = index
+        return name
+
+    def create_indexes(self, indexes):
+        names = []
+        for model in indexes:
+            document = dict(model.document)
+            keys = list(document.pop('key').items())
+            names.append(self.create_index(keys, **document))
+        return names
+
+    def index_information(self):
+        with self._lock:
+            info = {'_id_': {'key': [('_id', 1)]}}
+            for name, index in self._indexes.items():
+                info[name] = index.info()
+        return info
+
+    def drop_index(self, name):
+        with self._lock:
+            del self._indexes[name]
+
+    def aggregate(self, pipeline):
+        docs = None
+        for stage in pipeline:
+            (operator, arg), = stage.items()
+            if operator == '$match':
+                docs = [x for x in docs if _matches(x, arg)] \
+                    if docs is not None else list(self._find(arg))
+                continue
+            if docs is None:
+                docs = list(self._find({}))
+            if operator == '$sample':
+                docs = random.sample(docs, min(arg['size'], len(docs)))
+            elif operator == '$project':
+                docs = [_project(x, arg) for x in docs]
+            elif operator == '$sort':
+                docs = _sort_docs(docs, _sort_spec(arg))
+            elif operator == '$limit':
+                docs = docs[:arg]
+            elif operator == '$skip':
+                docs = docs[arg:]
+            else:
+                raise OperationFailure('unsupported stage %s' % operator)
+        return iter(docs if docs is not None else self._find({}))
+
+    def drop(self):
+        with self._lock:
+            self._docs.clear()
+            self._indexes.clear()
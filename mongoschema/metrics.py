@@ -0,0 +1,243 @@
+# python core
+import time
+import bisect
+import threading
+
+# the phases of a generated route that are timed
+PHASES = ('load', 'auth', 'handler', 'encode', 'total')
+
+# seconds
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# database operations per request
+DB_OP_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    """
+    Prometheus style histogram: a count per upper bound plus the sum and
+    count of everything observed.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        [(upper bound, count of values <= it)] ending with +Inf
+        """
+        total, result = 0, []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class MemorySink(object):
+    """
+    Keeps the metrics of every generated route in memory: a latency
+    histogram per route and phase, a histogram of the database
+    operations issued per request and request counts by status.
+    prometheus() renders them in the Prometheus text format.
+
+    Any object with the same record() method can be used as a sink.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, db_op_buckets=DB_OP_BUCKETS):
+        self.buckets = buckets
+        self.db_op_buckets = db_op_buckets
+        self.latency = {}
+        self.db_ops = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, status, timings, db_ops):
+        """
+        timings is {phase: seconds} for the phases the request went
+        through
+        """
+        with self._lock:
+            for phase, seconds in timings.items():
+                key = (route, phase)
+                if key not in self.latency:
+                    self.latency[key] = Histogram(self.buckets)
+                self.latency[key].observe(seconds)
+            if route not in self.db_ops:
+                self.db_ops[route] = Histogram(self.db_op_buckets)
+            self.db_ops[route].observe(db_ops)
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def prometheus(self, prefix='mongoschema'):
+        with self._lock:
+            lines = [
+                '# HELP %s_route_seconds Time spent in each phase of a '
+                'generated route.' % prefix,
+                '# TYPE %s_route_seconds histogram' % prefix,
+            ]
+            for (route, phase), hist in sorted(self.latency.items()):
+                labels = 'route="%s",phase="%s"' % (route, phase)
+                _histogram_lines(lines, '%s_route_seconds' % prefix, labels,
+                                 hist)
+            lines += [
+                '# HELP %s_route_db_ops Database operations issued per '
+                'request.' % prefix,
+                '# TYPE %s_route_db_ops histogram' % prefix,
+            ]
+            for route, hist in sorted(self.db_ops.items()):
+                _histogram_lines(lines, '%s_route_db_ops' % prefix,
+                                 'route="%s"' % route, hist)
+            lines += [
+                '# HELP %s_route_requests_total Requests by route and '
+                'status.' % prefix,
+                '# TYPE %s_route_requests_total counter' % prefix,
+            ]
+            for (route, status), count in sorted(self.requests.items()):
+                lines.append('%s_route_requests_total{route="%s",status="%s"}'
+                             ' %s' % (prefix, route, status, count))
+        return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(lines, name, labels, hist):
+    for bound, count in hist.cumulative():
+        lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, bound, count))
+    lines.append('%s_sum{%s} %s' % (name, labels, hist.sum))
+    lines.append('%s_count{%s} %s' % (name, labels, hist.count))
+
+
+class RouteTimer(object):
+    """
+    Collects the timings and database operations of the request being
+    handled by this thread and hands them to the sink when it's done.
+    """
+
+    def __init__(self, route, sink):
+        self.route = route
+        self.sink = sink
+        self.timings = {}
+        self.db_ops = 0
+        self.status = 200
+        self._stream = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'timer', None)
+        _local.timer = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _local.timer = self._outer
+        if exc[0] is not None:
+            self.status = 500
+        if self._stream is None:
+            self.finish()
+        elif exc[0] is not None:
+            self._stream.close()
+
+    def finish(self):
+        self.timings['total'] = time.perf_counter() - self._start
+        self.sink.record(self.route, self.status, self.timings, self.db_ops)
+
+    def stream(self, chunks):
+        """
+        chunks (the body of a streamed response) timed as part of the
+        request, which is only recorded once they have all been sent
+        """
+        self._stream = TimedStream(self, chunks)
+        return self._stream
+
+
+class TimedStream(object):
+    """
+    Iterates the body of a streamed response for a RouteTimer: producing
+    each chunk counts as encoding (a streamed list is loaded from the db
+    as it's encoded) and the db operations it issues are counted. The
+    timer is recorded when the body is exhausted or closed.
+    """
+
+    def __init__(self, timer, chunks):
+        self.timer = timer
+        self.chunks = iter(chunks)
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        outer = getattr(_local, 'timer', None)
+        _local.timer = self.timer
+        try:
+            with _Phase(self.timer, 'encode'):
+                return next(self.chunks)
+        except Exception as e:
+            if not isinstance(e, StopIteration):
+                self.timer.status = 500
+            self.close()
+            raise
+        finally:
+            _local.timer = outer
+
+    def close(self):
+        if not self.done:
+            self.done = True
+            close = getattr(self.chunks, 'close', None)
+            if close is not None:
+                close()
+            self.timer.finish()
+
+
+class _Phase(object):
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.timer.timings[self.name] = \
+            self.timer.timings.get(self.name, 0) + elapsed
+
+
+class _NoPhase(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name):
+    """
+    Context manager timing one phase of the current request, doing
+    nothing when it isn't being timed.
+    """
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        return _NO_PHASE
+    return _Phase(timer, name)
+
+
+def count_db_op():
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.db_ops += 1
@@ -0,0 +1,133 @@
+"""
+Batched migrations of the docs already stored for a schema (see
+MongoSchema.migrate). Each collection is scanned in _id order, a batch
+at a time, and whatever _fromdb would patch up on every read (missing
+defaults, floats in int fields) plus renamed fields is written back with
+one bulk_write per batch. Every update is conditional on the fields it
+touches being as they were read, so a doc saved by the application in
+the meantime is left alone (it's saved whole, already up to date).
+"""
+# python core
+import os
+import copy
+import time
+
+# 3rd party
+import bson
+from pymongo import UpdateOne
+
+# from this project
+from . import base
+
+
+def _changes(ms, raw, renames):
+    """
+    The (filter, update) bringing raw, a doc as stored, up to date, or
+    None if it already is
+    """
+    doc = copy.deepcopy(raw)
+    query = {'_id': doc.pop('_id')}
+    sets, unsets = {}, {}
+    for old, new in renames.items():
+        if old in doc and new not in doc:
+            doc[new] = doc.pop(old)
+            query[old] = raw[old]
+            unsets[old] = ''
+    # id is filled in from _id on the way out of the db, not stored
+    doc['id'] = query['_id']
+    ms._fill_defaults(doc)
+    ms._fix_int_float(doc)
+    del doc['id']
+    for key, value in doc.items():
+        if key not in raw:
+            query[key] = {'$exists': False}
+        elif type(value) is not type(raw[key]) or value != raw[key]:
+            query[key] = raw[key]
+        else:
+            continue
+        sets[key] = ms._fix_dict_keys(copy.deepcopy(value))
+    if ms.schema_version is not None and \
+            raw.get(base.SCHEMA_VERSION_KEY) != ms.schema_version:
+        sets[base.SCHEMA_VERSION_KEY] = ms.schema_version
+    update = {}
+    if sets:
+        update['$set'] = sets
+    if unsets:
+        update['$unset'] = unsets
+    return (query, update) if update else None
+
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        return bson.decode(f.read())['collections']
+
+
+def _save_checkpoint(path, state):
+    if path is None:
+        return
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(bson.encode({'collections': state}))
+    os.replace(tmp, path)
+
+
+def _batches(ms, collection, last, batch_size):
+    while True:
+        query = {}
+        if last is not None:
+            query['_id'] = {'$gt': last}
+        if ms.schema_version is not None:
+            query[base.SCHEMA_VERSION_KEY] = {'$ne': ms.schema_version}
+        docs = list(collection.find(query, sort=[('_id', 1)],
+                                    limit=batch_size))
+        if not docs:
+            return
+        yield docs
+        last = docs[-1]['_id']
+
+
+def migrate(ms, batch_size, throttle, renames, checkpoint, progress):
+    state = _load_checkpoint(checkpoint)
+    stats = {'collection': None, 'scanned': 0, 'modified': 0,
+             'skipped': 0, 'batches': 0, 'seconds': 0.0,
+             'docs_per_sec': None}
+    started = time.monotonic()
+    for collection in ms._index_collections():
+        name = collection.full_name
+        entry = state.get(name, {})
+        if entry.get('done'):
+            continue
+        stats['collection'] = name
+        for docs in _batches(ms, collection, entry.get('last'), batch_size):
+            requests, ids = [], []
+            for raw in docs:
+                changes = _changes(ms, raw, renames)
+                if changes is not None:
+                    requests.append(UpdateOne(*changes))
+                    ids.append(raw['_id'])
+            if requests:
+                result = collection.bulk_write(requests, ordered=False)
+                stats['modified'] += result.modified_count
+                # saved by someone else since they were read
+                stats['skipped'] += len(requests) - result.matched_count
+                for _id in ids:
+                    ms._doc_changed(_id)
+            stats['scanned'] += len(docs)
+            stats['batches'] += 1
+            entry = state[name] = {'last': docs[-1]['_id'], 'done': False}
+            _save_checkpoint(checkpoint, state)
+            stats['seconds'] = time.monotonic() - started
+            stats['docs_per_sec'] = stats['scanned'] / stats['seconds'] \
+                if stats['seconds'] else None
+            if progress is not None:
+                progress(dict(stats))
+            if throttle:
+                time.sleep(throttle)
+        state[name] = {'last': entry.get('last'), 'done': True}
+        _save_checkpoint(checkpoint, state)
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    stats['seconds'] = time.monotonic() - started
+    return stats
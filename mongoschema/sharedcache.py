@@ -0,0 +1,238 @@
+# python core
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+import contextlib
+
+# 3rd party
+import bson
+
+MAGIC = b'MSSC'
+VERSION = 2
+
+# magic, version, slots, slot_size, generation
+HEADER = struct.Struct('<4sIIIQ')
+HEADER_SIZE = 64
+
+# the invalidation counter of each slot (of the keys whose first
+# candidate it is), between the header and the slots
+COUNTER = struct.Struct('<Q')
+
+# generation, key digest, stored at, payload length
+SLOT_HEADER = struct.Struct('<Q16sdI')
+
+# how many neighbouring slots a key may live in
+WAYS = 2
+
+
+class SharedCache(object):
+    """
+    A fixed size hash table of raw BSON docs kept in a memory-mapped file
+    so every (prefork) worker process on a host can share it. Meant to be
+    used as the second level below MongoSchema.cache:
+
+        shared = SharedCache('/dev/shm/myapp.cache')
+
+        class User(MongoSchema):
+            collection = db.user
+            shared_cache = shared
+
+    Entries are keyed by (collection, _id). A key can live in one of WAYS
+    neighbouring slots and the oldest of those is evicted to make room.
+    Every entry is stamped with the generation of the table when it was
+    written, so invalidate_all() (which bumps the generation) drops
+    everything at once for every process. Docs too big for a slot are
+    simply not cached.
+
+    invalidate() bumps a counter of the key as well. A doc read from the
+    db after taking fill_token() is only stored by set(token=...) if the
+    key wasn't invalidated in between, so a slow reader can't put back
+    the version a writer just replaced.
+    """
+
+    def __init__(self, path, slots=4096, slot_size=4096, max_age=None):
+        self.path = path
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._fd = fd
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, self._size(slots, slot_size))
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, slots, slot_size, 1),
+                          0)
+            magic, version, slots, slot_size, _ = HEADER.unpack(
+                os.pread(fd, HEADER.size, 0))
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a shared cache file' % path)
+        self.slots = slots
+        self.slot_size = slot_size
+        self._mmap = mmap.mmap(fd, self._size(slots, slot_size))
+
+    @staticmethod
+    def _slots_start(slots):
+        return HEADER_SIZE + slots * COUNTER.size
+
+    @classmethod
+    def _size(cls, slots, slot_size):
+        return cls._slots_start(slots) + slots * slot_size
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+    @staticmethod
+    def _digest(collection, _id):
+        raw = bson.encode({'c': collection, 'i': _id})
+        return hashlib.blake2b(raw, digest_size=16).digest()
+
+    def _slot_offset(self, index):
+        return self._slots_start(self.slots) + \
+            (index % self.slots) * self.slot_size
+
+    def _candidates(self, digest):
+        first = int.from_bytes(digest[:8], 'little')
+        return [self._slot_offset(first + i) for i in range(WAYS)]
+
+    def _counter_offset(self, digest):
+        first = int.from_bytes(digest[:8], 'little')
+        return HEADER_SIZE + (first % self.slots) * COUNTER.size
+
+    def _counter(self, digest):
+        offset = self._counter_offset(digest)
+        return COUNTER.unpack(self._mmap[offset:offset + COUNTER.size])[0]
+
+    @contextlib.contextmanager
+    def _locked(self, offsets, exclusive):
+        """
+        Lock slots of the file for this process (fcntl) and for this
+        thread (fcntl locks are only per process). Always in the same
+        order, so two processes can't each wait for the other's slot.
+        """
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        offsets = sorted(set(offsets))
+        with self._lock:
+            locked = []
+            try:
+                for offset in offsets:
+                    fcntl.lockf(self._fd, mode, self.slot_size, offset)
+                    locked.append(offset)
+                yield
+            finally:
+                for offset in locked:
+                    fcntl.lockf(
+                        self._fd, fcntl.LOCK_UN, self.slot_size, offset)
+
+    @property
+    def generation(self):
+        return HEADER.unpack(self._mmap[:HEADER.size])[4]
+
+    def _read_slot(self, offset):
+        return SLOT_HEADER.unpack(
+            self._mmap[offset:offset + SLOT_HEADER.size])
+
+    def _write_slot(self, offset, generation, digest, payload):
+        self._mmap[offset:offset + SLOT_HEADER.size] = SLOT_HEADER.pack(
+            generation, digest, time.time(), len(payload))
+        start = offset + SLOT_HEADER.size
+        self._mmap[start:start + len(payload)] = payload
+
+    def _is_live(self, generation, stored_at, current_generation):
+        if generation != current_generation:
+            return False
+        if self.max_age is not None and time.time() - stored_at > \
+                self.max_age:
+            return False
+        return True
+
+    def get(self, collection, _id):
+        """
+        Return the raw doc stored for _id or None.
+        """
+        digest = self._digest(collection, _id)
+        current = self.generation
+        for offset in self._candidates(digest):
+            with self._locked([offset], exclusive=False):
+                generation, slot_digest, stored_at, length = \
+                    self._read_slot(offset)
+                if slot_digest != digest or length == 0:
+                    continue
+                if not self._is_live(generation, stored_at, current):
+                    continue
+                start = offset + SLOT_HEADER.size
+                payload = self._mmap[start:start + length]
+            self.hits += 1
+            return bson.decode(payload)
+        self.misses += 1
+        return None
+
+    def fill_token(self, collection, _id):
+        """
+        To take before reading the doc for _id from the db, and give to
+        set() along with it
+        """
+        return self._counter(self._digest(collection, _id))
+
+    def set(self, collection, _id, doc, token=None):
+        """
+        Store a raw doc (as it is in the db). Returns False if the doc
+        doesn't fit in a slot, or if the key was invalidated since token
+        was taken with fill_token().
+        """
+        payload = bson.encode(doc)
+        if len(payload) > self.slot_size - SLOT_HEADER.size:
+            self.invalidate(collection, _id)
+            return False
+        digest = self._digest(collection, _id)
+        current = self.generation
+        candidates = self._candidates(digest)
+        with self._locked(candidates, exclusive=True):
+            if token is not None and self._counter(digest) != token:
+                return False
+            victim, victim_age = None, None
+            for offset in candidates:
+                generation, slot_digest, stored_at, length = \
+                    self._read_slot(offset)
+                if slot_digest == digest:
+                    victim = offset
+                    break
+                if length == 0 or not self._is_live(
+                        generation, stored_at, current):
+                    stored_at = 0
+                if victim is None or stored_at < victim_age:
+                    victim, victim_age = offset, stored_at
+            self._write_slot(victim, current, digest, payload)
+        return True
+
+    def invalidate(self, collection, _id):
+        digest = self._digest(collection, _id)
+        candidates = self._candidates(digest)
+        with self._locked(candidates, exclusive=True):
+            offset = self._counter_offset(digest)
+            self._mmap[offset:offset + COUNTER.size] = COUNTER.pack(
+                self._counter(digest) + 1)
+            for offset in candidates:
+                if self._read_slot(offset)[1] == digest:
+                    self._write_slot(offset, 0, bytes(16), b'')
+
+    def invalidate_all(self):
+        """
+        Drop every entry, for every process sharing the file.
+        """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+        try:
+            magic, version, slots, slot_size, generation = HEADER.unpack(
+                self._mmap[:HEADER.size])
+            self._mmap[:HEADER.size] = HEADER.pack(
+                magic, version, slots, slot_size, generation + 1)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
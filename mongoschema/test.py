@@ -1,16 +1,37 @@
 import unittest
 import os
+import sys
 import re
 import json
+import itertools
+import array
+import asyncio
+import datetime
+import operator
+import threading
+import tempfile
+import multiprocessing
 
 from bson.objectid import ObjectId
 import pymongo
 import requests
 
-from base import (
+# the tests run from inside the package (travis-tests.sh)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mongoschema.base import (
     MongoSchema, MongoDoc, MongoField as MF, ValidationError, flaskprep,
-    set_api_prefix,
+    set_api_prefix, monthly_partition, hash_partition, set_cache_budget,
 )
+from mongoschema.base import MongoEncoder, to_json
+from mongoschema.sharedcache import SharedCache
+from mongoschema.aio import AsyncMongoSchema, AsyncCollection
+from mongoschema.metrics import MemorySink, RouteTimer
+from mongoschema import hooks, cachestats, compression
+from mongoschema.advisor import IndexAdvisor, _plan_stages
+from mongoschema.memory import InMemoryCollection
+from mongoschema.arrays import ArrayField
+from mongoschema.blobs import LargeBlob, FileStore
 
 WITH_PROFILE = False
 
@@ -133,6 +154,62 @@ class UserAfterChanges(MongoSchema):
     ]
 
 
+class MigratedUser(MongoSchema):
+    collection = InMemoryCollection('migrated_user')
+    schema = {
+        'username': MF(str),
+        'lang': MF(str, default='en'),
+        'age': MF(int),
+        # was nick
+        'nickname': MF(str),
+    }
+    schema_version = 2
+
+
+class Reading(MongoSchema):
+    collection = InMemoryCollection('reading')
+    schema = {
+        'sensor': MF(str),
+        'value': MF(float, required=False),
+        'count': MF(int),
+        'ok': MF(bool, required=False),
+        'at': MF(datetime.datetime),
+        'place': {
+            'unit': MF(str, default='celsius'),
+            'floor': MF(int, required=False),
+        },
+    }
+
+
+class Embedding(MongoSchema):
+    collection = db.embedding
+    schema = {
+        'name': MF(str),
+        'vector': MF(ArrayField(dtype='float32', shape=4)),
+        'rows': MF(ArrayField(dtype='int16', shape=(None, 2)),
+                   required=False),
+    }
+
+
+class Article(MongoSchema):
+    collection = db.article
+    schema = {
+        'title': MF(str),
+        'body': MF(str, compress='zlib', min_size=100),
+        'data': MF(dict, compress='lzma', required=False),
+    }
+
+
+class Upload(MongoSchema):
+    collection = db.upload
+    schema = {
+        'name': MF(str),
+        'content': MF(LargeBlob),
+        'thumbnail': MF(LargeBlob, required=False),
+    }
+    blob_store = FileStore(tempfile.mkdtemp(), chunk_size=16)
+
+
 class Farmer(User):
     collection = db.farmer
     schema = {
@@ -212,6 +289,130 @@ class WithOptionalField(MongoSchema):
     }
 
 
+class Event(MongoSchema):
+    collection = db.event
+    schema = {
+        'created': MF(datetime.datetime),
+        'kind': MF(str),
+    }
+    indexes = ['kind']
+    partition_by = ['created', monthly_partition]
+
+
+class TenantDoc(MongoSchema):
+    collection = db.tenant_doc
+    schema = {
+        'tenant': MF(str),
+    }
+    partition_by = ['tenant', hash_partition(4)]
+
+
+class VersionedDoc(MongoSchema):
+    collection = db.versioned_doc
+    schema = {
+        'version': MF(int),
+    }
+    etag_field = 'version'
+
+
+class LazyIndexed(MongoSchema):
+    collection = db.lazy_indexed
+    schema = {
+        'name': MF(str),
+    }
+    indexes = ['name']
+    index_mode = 'lazy'
+
+
+class ManualIndexed(MongoSchema):
+    collection = db.manual_indexed
+    schema = {
+        'name': MF(str),
+    }
+    indexes = [['name', {'unique': True}]]
+    index_mode = 'manual'
+
+
+class CompactUserDoc(MongoDoc):
+    __slots__ = ()
+
+    def get_username(self):
+        return self.username
+
+
+class CompactUser(MongoSchema):
+    collection = db.compact_user
+    schema = {
+        'username': MF(str),
+        'nickname': MF(str, required=False),
+        'settings': {
+            'theme': MF(str, default='dark'),
+        },
+        'tags': [MF(str)],
+        'friend': MF('test.CompactUser', required=False),
+    }
+    doc_class = CompactUserDoc
+    compact = True
+
+
+class MemoryEvent(MongoSchema):
+    collection = InMemoryCollection('memory_event')
+    schema = {
+        'name': MF(str),
+        'count': MF(int),
+        'tags': [MF(str)],
+        'user': MF(User, required=False),
+    }
+    indexes = [
+        ['name', {'unique': True}],
+        [(('count', 1), ('name', 1)), {}],
+        'tags',
+    ]
+
+
+class MemoryLog(MongoSchema):
+    collection = InMemoryCollection('memory_log')
+    schema = {
+        'created': MF(datetime.datetime),
+        'n': MF(int),
+    }
+    indexes = ['n']
+    partition_by = ['created', monthly_partition]
+
+
+class AsyncUser(AsyncMongoSchema):
+    collection = AsyncCollection(db.async_user)
+    schema = {
+        'username': MF(str),
+    }
+    indexes = [
+        ['username', {'unique': True}],
+    ]
+
+
+class AsyncEmail(AsyncMongoSchema):
+    collection = AsyncCollection(db.async_email, threaded=True)
+    schema = {
+        'user': MF(AsyncUser),
+        'cc': [MF(AsyncUser)],
+        'subject': MF(str),
+    }
+
+
+def _get_username(doc):
+    return doc.username
+
+
+def _shared_cache_child(path, _id, queue):
+    """
+    Runs in another process to check the shared cache is really shared.
+    """
+    cache = SharedCache(path)
+    queue.put(cache.get('test.user', _id))
+    cache.set('test.user', _id, {'_id': _id, 'username': 'child'})
+    cache.close()
+
+
 # bullshit that I must call these directly, can't share the code between
 # the various test classes without all tests running any time one of
 # the classes are used
@@ -581,6 +782,434 @@ class MongoSchemaBaseTestCase(unittest.TestCase):
         referenced.save()
         self.assertEqual(referenced.referencer.id, referencer.id)
 
+    def test_compact_docs(self):
+        user = CompactUser.create(username='sam', tags=['a'])
+        self.assertTrue(isinstance(user, CompactUserDoc))
+        # no __dict__ per doc
+        self.assertEqual(type(user).__dictoffset__, 0)
+        self.assertEqual(user.get_username(), 'sam')
+        self.assertEqual(user['username'], 'sam')
+        self.assertEqual(user.settings, {'theme': 'dark'})
+        self.assertFalse(user.nickname)
+        self.assertFalse('nickname' in user.doc)
+        self.assertEqual(sorted(user.doc),
+                         ['id', 'settings', 'tags', 'username'])
+        friend = CompactUser.create(username='max')
+        user.friend = friend
+        user.nickname = 'sammy'
+        user.tags.append('b')
+        user.save()
+        CompactUser.clear_cache_and_init()
+        user = CompactUser.get(id=user.id)
+        self.assertEqual(user.nickname, 'sammy')
+        self.assertEqual(user.tags, ['a', 'b'])
+        self.assertEqual(user.friend.username, 'max')
+        self.assertEqual(user.to_dict()['friend'], friend.id)
+        self.assertEqual(json.loads(to_json(user))['username'], 'sam')
+        self.assertEqual(json.loads(str(user))['nickname'], 'sammy')
+        del user['nickname']
+        user.reload()
+        self.assertFalse(user.nickname)
+        # fields the schema doesn't know about any more are kept
+        CompactUser.collection.update_one(
+            {'_id': user.id}, {'$set': {'removed': 1}})
+        user.reload()
+        self.assertEqual(user.doc['removed'], 1)
+
+    def test_in_memory_collection(self):
+        collection = MemoryEvent.collection
+        collection.drop()
+        self.assertEqual(collection.index_information(),
+                         {'_id_': {'key': [('_id', 1)]}})
+        MemoryEvent.ensure_all_indexes()
+        user = _create_user()
+        events = [MemoryEvent.create(name='e%s' % i, count=i,
+                                     tags=['odd' if i % 2 else 'even'])
+                  for i in range(10)]
+        events[0].user = user
+        events[0].save()
+        MemoryEvent.clear_cache_and_init()
+        self.assertEqual(MemoryEvent.get(id=events[0].id).user.id, user.id)
+        self.assertEqual(MemoryEvent.get(name='e3').count, 3)
+        self.assertEqual(MemoryEvent.count(tags='odd'), 5)
+        self.assertEqual(MemoryEvent.count(count={'$gte': 3, '$lt': 6}), 3)
+        self.assertEqual(MemoryEvent.count(user={'$exists': True}), 1)
+        self.assertEqual(MemoryEvent.count(
+            **{'$or': [{'count': 1}, {'name': {'$in': ['e2', 'e3']}}]}), 3)
+        found = MemoryEvent.find(sort=('count', -1), limit=2,
+                                 count={'$ne': 9})
+        self.assertEqual([x.count for x in found], [8, 7])
+        self.assertEqual(
+            [x for x in MemoryEvent.get_many([events[2].id, events[1].id])],
+            [events[2], events[1]])
+        # the indexes narrow down the docs that are looked at
+        self.assertEqual(len(collection._lookup({'name': 'e1'})), 1)
+        self.assertEqual(
+            len(collection._lookup({'count': {'$gt': 7}})), 2)
+        self.assertEqual(len(collection._lookup({'tags': 'even'})), 5)
+        self.assertTrue('count_1_name_1' in collection.index_information())
+        with self.assertRaises(pymongo.errors.DuplicateKeyError):
+            MemoryEvent.create(name='e1', count=1, tags=[])
+        collection.update_one({'name': 'e1'},
+                              {'$inc': {'count': 10}, '$push': {'tags': 'x'}})
+        raw = collection.find_one({'count': 11}, projection={'tags': True})
+        self.assertEqual(raw, {'_id': events[1].id, 'tags': ['odd', 'x']})
+        self.assertEqual(MemoryEvent.count(count=1), 0)
+        MemoryEvent.remove(name='e2')
+        self.assertIsNone(MemoryEvent.get(name='e2'))
+        self.assertEqual(collection.delete_many({'count': {'$lt': 5}}
+                                                ).deleted_count, 3)
+        self.assertEqual(collection.count_documents({}), 6)
+
+        def insert(start):
+            for i in range(start, start + 50):
+                collection.insert_one({'name': 't%s' % i, 'count': i})
+        threads = [threading.Thread(target=insert, args=(i * 50,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(collection.count_documents(
+            {'name': {'$regex': '^t'}}), 200)
+        self.assertEqual(len(collection._lookup({'count': {'$gte': 190}})),
+                         10)
+
+    def test_in_memory_sparse_index(self):
+        collection = InMemoryCollection('sparse')
+        collection.drop()
+        collection.insert_many([
+            {'_id': 1, 'a': 1}, {'_id': 2, 'b': 1}, {'_id': 3, 'a': None}])
+        queries = [{'a': None}, {'a': {'$in': [1, None]}}, {'a': 1},
+                   {'a': {'$gte': None}}, {'a': {'$gt': 0}}]
+
+        def results():
+            return [sorted(x['_id'] for x in collection.find(query))
+                    for query in queries]
+        unindexed = results()
+        self.assertEqual(unindexed[0], [2, 3])
+        collection.create_index([('a', 1)], sparse=True)
+        # the docs a sparse index leaves out are still found
+        self.assertEqual(results(), unindexed)
+        self.assertEqual(collection._lookup({'a': 1}), [1])
+
+    def test_in_memory_partitions(self):
+        database = MemoryLog.collection.database
+        for name in database.list_collection_names():
+            if name.startswith('memory_log.'):
+                database.drop_collection(name)
+        for i in range(30):
+            MemoryLog.create(created=datetime.datetime(2024, 1 + i % 3, 1),
+                             n=i)
+        MongoSchema.clear_cache_and_init()
+        self.assertEqual(
+            database.list_collection_names(
+                filter={'name': {'$regex': '^memory_log'}}),
+            ['memory_log.202401', 'memory_log.202402', 'memory_log.202403'])
+        self.assertIn('n_1',
+                      database['memory_log.202402'].index_information())
+        self.assertEqual(MemoryLog.count(n={'$lt': 10}), 10)
+        self.assertEqual(
+            sorted(MemoryLog.parallel_scan(fn=lambda x: x.n)), list(range(30)))
+        Reading.collection.drop()
+        Reading.collection.insert_many([
+            {'sensor': 's', 'count': i, 'at': datetime.datetime(2024, 1, 1)}
+            for i in range(20)])
+        counts = Reading.parallel_scan(workers=2, fn=lambda x: x.count)
+        self.assertEqual(sorted(counts), list(range(20)))
+
+    def test_migrate(self):
+        collection = MigratedUser.collection
+        collection.drop()
+        collection.insert_many([
+            {'username': 'u%02d' % i, 'age': 3.0, 'nick': 'n%d' % i}
+            for i in range(25)])
+        collection.insert_one({'username': 'new', 'age': 1, 'lang': 'pt',
+                               'nickname': 'x'})
+        # not migrated yet, patched up on the way out of the db
+        self.assertEqual(MigratedUser.get(username='u00').lang, 'en')
+        self.assertEqual(MigratedUser.count(lang='en'), 0)
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(stats):
+            raise Interrupted()
+        with self.assertRaises(Interrupted):
+            MigratedUser.migrate(batch_size=10, checkpoint=path,
+                                 renames={'nick': 'nickname'},
+                                 progress=interrupt)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(collection.count_documents({'_sv': 2}), 10)
+        seen = []
+        stats = MigratedUser.migrate(batch_size=10, checkpoint=path,
+                                     renames={'nick': 'nickname'},
+                                     progress=seen.append)
+        # picked up after the first batch
+        self.assertEqual(stats['scanned'], 16)
+        self.assertEqual(stats['modified'], 16)
+        self.assertEqual([x['scanned'] for x in seen], [10, 16])
+        self.assertFalse(os.path.exists(path))
+        raw = collection.find_one({'username': 'u20'})
+        self.assertEqual(raw['lang'], 'en')
+        self.assertTrue(type(raw['age']) is int)
+        self.assertEqual(raw['nickname'], 'n20')
+        self.assertTrue('nick' not in raw)
+        self.assertEqual(collection.find_one({'username': 'new'})['lang'],
+                         'pt')
+        self.assertEqual(MigratedUser.count(lang='en'), 25)
+        self.assertEqual(MigratedUser.migrate()['scanned'], 0)
+        created = MigratedUser.create(username='c', age=1, nickname='c')
+        self.assertEqual(self._get_field_from_db(created, '_sv'), 2)
+        # migrated docs skip the read time fix ups
+        collection.update_one({'username': 'u01'}, {'$unset': {'lang': ''}})
+        MigratedUser.clear_cache_and_init()
+        user = MigratedUser.get(username='u01')
+        self.assertTrue('lang' not in user.doc)
+        self.assertTrue('_sv' not in user.doc)
+        self.assertEqual(user.nickname, 'n1')
+
+    def test_export_import(self):
+        tmpdir = tempfile.mkdtemp()
+        for i in range(30):
+            created = datetime.datetime(2020, 1 + i % 2, 1 + i % 28)
+            Event.create(created=created, kind='k%d' % i)
+
+        def stored():
+            return sorted((x for c in Event._all_partitions()
+                           for x in c.find()), key=lambda x: x['_id'])
+        before = stored()
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupt(stats):
+            if stats['docs'] >= 14:
+                raise Interrupted()
+        for format in ('bson', 'ndjson'):
+            path = os.path.join(tmpdir, 'events.' + format)
+            seen = []
+            stats = Event.export(path, format=format, compress='gzip',
+                                 batch_size=7, progress=seen.append)
+            self.assertEqual(stats['docs'], 30)
+            # 15 docs a month
+            self.assertEqual([x['docs'] for x in seen],
+                             [7, 14, 15, 22, 29, 30])
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(2), b'\x1f\x8b')
+            for c in Event._all_partitions():
+                c.delete_many({})
+            stats = Event.import_(path, batch_size=7)
+            self.assertEqual(stats['inserted'], 30)
+            self.assertEqual(stored(), before)
+        path = os.path.join(tmpdir, 'events.ndjson')
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+        with self.assertRaises(Interrupted):
+            Event.export(path, format='ndjson', batch_size=7,
+                         checkpoint=checkpoint, progress=interrupt)
+        # half a batch written when it stopped
+        with open(path, 'ab') as f:
+            f.write(b'{"_id": ')
+        stats = Event.export(path, format='ndjson', batch_size=7,
+                             checkpoint=checkpoint)
+        self.assertEqual(stats['docs'], 16)
+        self.assertFalse(os.path.exists(checkpoint))
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), 30)
+        for c in Event._all_partitions():
+            c.delete_many({})
+        with self.assertRaises(Interrupted):
+            Event.import_(path, batch_size=7, checkpoint=checkpoint,
+                          progress=interrupt)
+        stats = Event.import_(path, batch_size=7, checkpoint=checkpoint)
+        self.assertEqual((stats['docs'], stats['inserted']), (16, 16))
+        self.assertEqual(stored(), before)
+        # validated in worker processes, everything is already there
+        stats = Event.import_(path, workers=2)
+        self.assertEqual((stats['inserted'], stats['existing']), (0, 30))
+        bad = os.path.join(tmpdir, 'bad.ndjson')
+        with open(bad, 'w') as f:
+            f.write('{"_id": {"$oid": "%s"}, "kind": 5, '
+                    '"created": {"$date": "2020-01-01T00:00:00Z"}}\n'
+                    % ObjectId())
+        with self.assertRaises(ValidationError):
+            Event.import_(bad, workers=2)
+
+    def test_to_columns(self):
+        Reading.collection.drop()
+        at = datetime.datetime(2020, 1, 1)
+        for i in range(10):
+            Reading.create(sensor='s%d' % (i % 2), value=i / 2.0, count=i,
+                           ok=i % 3 == 0, at=at, place={'floor': i})
+        Reading.collection.insert_one({'sensor': 's9', 'count': 10.0,
+                                       'at': at})
+        columns = Reading.to_columns(
+            fields=['sensor', 'value', 'count', 'ok', 'place.unit',
+                    'place.floor'], query={'count': {'$gte': 8}},
+            use_numpy=False)
+        self.assertEqual(columns['sensor'], ['s0', 's1', 's9'])
+        self.assertEqual(columns['value'].typecode, 'd')
+        self.assertEqual(columns['value'][:2].tolist(), [4.0, 4.5])
+        self.assertTrue(columns['value'][2] != columns['value'][2])
+        self.assertEqual(columns['count'], array.array('q', [8, 9, 10]))
+        self.assertEqual(columns['ok'], [False, True, None])
+        self.assertEqual(columns['place.unit'], ['celsius'] * 3)
+        self.assertEqual(columns['place.floor'], [8, 9, None])
+        everything = Reading.to_columns(use_numpy=False)
+        self.assertEqual(sorted(everything),
+                         ['at', 'count', 'id', 'ok', 'place', 'sensor',
+                          'value'])
+        self.assertEqual(len(everything['id']), 11)
+        self.assertEqual(everything['at'], [at] * 11)
+        with self.assertRaises(ValidationError):
+            Reading.to_columns(fields=['nope'])
+
+    def test_array_field(self):
+        item = Embedding.create(name='a', vector=[0.5, 1, 2, 3])
+        self.assertEqual(len(self._get_field_from_db(item, 'vector')), 16)
+        Embedding.clear_cache_and_init()
+        item = Embedding.get(id=item.id)
+        self.assertEqual(item.vector.tolist(), [0.5, 1.0, 2.0, 3.0])
+        # a view over the stored bytes, not a copy
+        self.assertTrue(memoryview(item.vector).readonly)
+        item.rows = array.array('h', range(6))
+        item.vector = item.vector
+        item.save()
+        item.reload()
+        self.assertEqual(item.rows.tolist(), [[0, 1], [2, 3], [4, 5]])
+        self.assertEqual(json.loads(to_json(item))['vector'],
+                         [0.5, 1.0, 2.0, 3.0])
+        self.assertEqual(
+            [x.tolist() for x in Embedding.to_columns(
+                fields=['rows'], use_numpy=False)['rows']],
+            [[[0, 1], [2, 3], [4, 5]]])
+        with self.assertRaises(ValidationError):
+            item.vector = [1, 2, 3]
+        item.update(vector=[1, 2, 3, 4])
+        item.reload()
+        self.assertEqual(item.vector.tolist(), [1, 2, 3, 4])
+        with self.assertRaises(ValidationError):
+            Embedding.create(name='b', vector=[1] * 4, rows=[1, 2, 3])
+        with self.assertRaises(ValidationError):
+            item.rows = [[1, 2, 3], [4, 5, 6]]
+        with self.assertRaises(ValidationError):
+            item.rows = [[1, 2], [3]]
+        item.rows = [[1, 2], [3, 4], [5, 6]]
+        item.doc['vector'] = item.doc['rows']
+        with self.assertRaises(ValidationError):
+            item.save()
+
+    def test_compressed_fields(self):
+        body = 'lorem ipsum dolor ' * 500
+        data = {'a.b': [1, 2.5], 'when': datetime.datetime(2020, 1, 1)}
+        article = Article.create(title='t', body=body, data=data)
+        stored = self._get_field_from_db(article, 'body')
+        self.assertTrue(compression.is_compressed(stored))
+        self.assertTrue(len(stored) < len(body) / 10)
+        short = Article.create(title='s', body='short')
+        self.assertEqual(self._get_field_from_db(short, 'body'), 'short')
+        Article.clear_cache_and_init()
+        article = Article.get(id=article.id)
+        self.assertEqual(article.title, 't')
+        # only decompressed once it's read
+        self.assertTrue(compression.is_compressed(article.doc['body']))
+        etag = Article._doc_etag(article)
+        self.assertEqual(json.loads(to_json(article))['body'], body)
+        self.assertTrue(compression.is_compressed(article.doc['body']))
+        self.assertEqual(article.body, body)
+        article._etag = None
+        self.assertEqual(Article._doc_etag(article), etag)
+        article.save()
+        self.assertEqual(article.body, body)
+        self.assertEqual(article.doc['body'], body)
+        self.assertEqual(article.data, data)
+        self.assertEqual(article.to_dict()['data'], data)
+        article.update_single_field('body', body * 2)
+        self.assertTrue(compression.is_compressed(
+            self._get_field_from_db(article, 'body')))
+        article.reload()
+        self.assertEqual(article.body, body * 2)
+        article.body = 5
+        with self.assertRaises(ValidationError):
+            article.save()
+        # a value given already compressed is still checked
+        article.body = compression.compress(['lorem'] * 500, 'zlib')
+        with self.assertRaises(ValidationError):
+            article.save()
+        article.body = compression.compress(body, 'zlib')
+        article.save()
+        self.assertEqual(self._get_field_from_db(article, 'body'),
+                         article.doc['body'])
+        with self.assertRaises(ValueError):
+            MF(str, compress='snappy')
+
+    def test_large_blob(self):
+        content = b'0123456789' * 100
+        with tempfile.TemporaryFile() as f:
+            f.write(content)
+            f.seek(0)
+            upload = Upload.create(name='a', content=f)
+        # the doc (and the cache) only hold the id of the blob
+        blob_id = self._get_field_from_db(upload, 'content')
+        self.assertIsInstance(blob_id, ObjectId)
+        self.assertEqual(Upload.cache[upload.id].doc['content'], blob_id)
+        Upload.clear_cache_and_init()
+        upload = Upload.get(id=upload.id)
+        with upload.content as reader:
+            self.assertEqual(reader.read(10), content[:10])
+            self.assertEqual(reader.read(), content[10:])
+        self.assertEqual(json.loads(to_json(upload))['content'],
+                         str(blob_id))
+        upload.thumbnail = b'thumb'
+        upload.save()
+        upload.reload()
+        with upload.thumbnail as reader:
+            self.assertEqual(reader.read(), b'thumb')
+        other = Upload.create(name='b', content=str(blob_id))
+        with other.content as reader:
+            self.assertEqual(reader.read(), content)
+        with self.assertRaises(ValidationError):
+            upload.content = 5
+        store = Upload.blob_store
+        self.assertEqual(len(os.listdir(store.path)), 2)
+        # nothing is uploaded for an invalid doc, nor kept when the
+        # insert fails
+        with self.assertRaises(ValidationError):
+            Upload.create(name=5, content=b'orphan')
+        with self.assertRaises(Exception):
+            Upload.create(id=upload.id, name='c', content=b'orphan')
+        self.assertEqual(len(os.listdir(store.path)), 2)
+        # clients can't point a doc at another blob by id
+        with self.assertRaises(ValidationError):
+            other.update(thumbnail=str(upload.doc['thumbnail']))
+        with self.assertRaises(ValidationError):
+            Upload._call_static_func(
+                'create', {'name': 'c', 'content': str(blob_id)}, {}, None)
+        other.update(content=str(blob_id), name='b')
+
+        class Failing(object):
+            def read(self, size):
+                raise IOError('gone')
+        with self.assertRaises(IOError):
+            upload.thumbnail = Failing()
+        self.assertEqual(len(os.listdir(store.path)), 2)
+        # a replaced blob goes once the doc is saved
+        thumb_id = upload.doc['thumbnail']
+        upload.thumbnail = b'new thumb'
+        self.assertEqual(len(os.listdir(store.path)), 3)
+        upload.save()
+        self.assertNotIn(str(thumb_id), os.listdir(store.path))
+        del upload['thumbnail']
+        self.assertEqual(len(os.listdir(store.path)), 1)
+        # and a shared one once no doc holds it
+        Upload.remove(name='a')
+        with other.content as reader:
+            self.assertEqual(reader.read(), content)
+        Upload.remove(name='b')
+        self.assertEqual(os.listdir(store.path), [])
+        self.assertEqual(Upload.count(), 0)
+
     def test_count(self):
         self.assertEqual(User.count(), 0)
         username = 'aname'
@@ -593,6 +1222,521 @@ class MongoSchemaBaseTestCase(unittest.TestCase):
         user = _create_user()
         user['username']
 
+    def test_get_many(self):
+        users = [_create_user(username='%s' % i) for i in range(0, 3)]
+        User.clear_cache_and_init()
+        cached = User.get(id=users[2].id)
+        many = User.get_many([users[2].id, ObjectId(), str(users[0].id)])
+        self.assertTrue(many[0] is cached)
+        self.assertIsNone(many[1])
+        self.assertEqual(many[2].username, users[0].username)
+
+    def test_parallel_scan(self):
+        usernames = ['%03d' % i for i in range(0, 100)]
+        for username in usernames:
+            _create_user(username=username)
+        progress = {}
+
+        def on_progress(partition, count, done):
+            progress[partition] = (count, done)
+
+        scanned = User.parallel_scan(
+            workers=4, fn=_get_username, progress=on_progress,
+            progress_every=10, max_inflight=5)
+        self.assertEqual(sorted(scanned), usernames)
+        self.assertEqual(sum(x[0] for x in progress.values()), 100)
+        self.assertTrue(all(x[1] for x in progress.values()))
+        ordered = User.parallel_scan(
+            {'username': {'$gte': '050'}}, workers=3, fn=_get_username,
+            field='username', ordered=True)
+        self.assertEqual(list(ordered), usernames[50:])
+        count = User.parallel_scan(
+            workers=4, reduce=lambda acc, doc: acc + 1, initial=0,
+            combine=operator.add)
+        self.assertEqual(count, 100)
+        processed = User.parallel_scan(
+            workers=2, fn=_get_username, executor='process')
+        self.assertEqual(sorted(processed), usernames)
+
+    def test_partitioning(self):
+        jan = datetime.datetime(2024, 1, 10)
+        feb = datetime.datetime(2024, 2, 10)
+        events = [
+            Event.create(created=jan, kind='c'),
+            Event.create(created=feb, kind='a'),
+            Event.create(created=jan, kind='b'),
+        ]
+        self.assertEqual(db.event.count_documents({}), 0)
+        self.assertEqual(db['event.202401'].count_documents({}), 2)
+        self.assertEqual(db['event.202402'].count_documents({}), 1)
+        self.assertTrue('kind_1' in db['event.202402'].index_information())
+        self.assertEqual(len(Event._collections_for({'created': jan})), 1)
+        self.assertEqual(Event.count(), 3)
+        self.assertEqual(Event.count(created=jan), 2)
+        MongoSchema.clear_cache_and_init()
+        event = Event.get(id=events[1].id)
+        self.assertEqual(event.kind, 'a')
+        event.kind = 'd'
+        event.save()
+        self.assertEqual(db['event.202402'].find_one()['kind'], 'd')
+        kinds = [x.kind for x in Event.find(sort=('kind', 1))]
+        self.assertEqual(kinds, ['b', 'c', 'd'])
+        self.assertEqual(len(Event.list(sort=('kind', -1), limit=2)), 2)
+        Event.remove(kind='b')
+        self.assertEqual(Event.count(), 2)
+        tenants = ['t%s' % i for i in range(0, 10)]
+        for tenant in tenants:
+            TenantDoc.create(tenant=tenant)
+        self.assertEqual(TenantDoc.get(tenant='t3').tenant, 't3')
+        self.assertEqual(
+            sorted(x.tenant for x in TenantDoc.find()), sorted(tenants))
+
+    def test_partition_move(self):
+        jan = datetime.datetime(2024, 1, 10)
+        feb = datetime.datetime(2024, 2, 10)
+        event = Event.create(created=jan, kind='a')
+        other = Event.create(created=jan, kind='b')
+        # not partitions of Event
+        db['event.archive'].insert_one({'kind': 'archived'})
+        db['event.files'].insert_one({'kind': 'blob'})
+        event.created = feb
+        event.save()
+        self.assertEqual(db['event.202401'].count_documents({}), 1)
+        self.assertEqual(db['event.202402'].find_one()['kind'], 'a')
+        MongoSchema.clear_cache_and_init()
+        self.assertEqual(Event.get(id=event.id).created, feb)
+        self.assertEqual(sorted(x.kind for x in Event.find()), ['a', 'b'])
+        self.assertEqual(Event.count(kind='archived'), 0)
+        other.update_single_field('created', feb)
+        self.assertEqual(Event.count(created=feb), 2)
+        self.assertEqual(db['event.202401'].count_documents({}), 0)
+        # unsaved moves are undone by reload, other writes go to the
+        # partition the doc is stored in
+        other.created = jan
+        del other['kind']
+        other.reload()
+        self.assertEqual(other.created, feb)
+        self.assertEqual(db['event.202402'].count_documents(
+            {'kind': {'$exists': True}}), 1)
+        with self.assertRaises(ValidationError):
+            del other['created']
+
+    def test_to_json(self):
+        def assert_same(obj):
+            self.assertEqual(to_json(obj), json.dumps(obj, cls=MongoEncoder))
+
+        user = _create_user()
+        email = self._create_email(user)
+        with_list = SchemaWithList.create(users=[user], numbers=[1, 2])
+        with_dict = SchemaWithDict.create(
+            data={'when': datetime.datetime(2016, 1, 1), 'who': user.id,
+                  'nested': [{'ab': 1.5}, None, True]},
+            list_data=[{'x': 'y'}])
+        event = Event.create(created=datetime.datetime(2024, 1, 1), kind='a')
+        for obj in (user, email, with_list, with_dict, event):
+            assert_same(obj)
+        assert_same([user, {'email': email, 'ids': (user.id, email.id)}])
+        Email.todict_follow_references = True
+        try:
+            assert_same(email)
+        finally:
+            Email.todict_follow_references = False
+        with self.assertRaises(TypeError):
+            to_json(set())
+
+    def test_get_fields(self):
+        user = _create_user()
+        ms = UserWithCacheDisabled
+        self.assertEqual(ms._get_fields(user.id, ['id'], None),
+                         {'id': str(user.id)})
+        self.assertEqual(ms._get_fields(str(user.id), ['username'], None),
+                         {'id': str(user.id), 'username': user.username})
+        self.assertIsNone(ms._get_fields(ObjectId(), ['id'], None))
+        seen = []
+        ms._get_fields(user.id, ['id'], seen.append)
+        self.assertEqual(seen[0].username, user.username)
+        with self.assertRaises(ValidationError):
+            ms._route_fields({'fields': 'username,password'})
+
+    def test_route_metrics(self):
+        user = _create_user()
+        User.clear_cache_and_init()
+        sink = MemorySink()
+        with RouteTimer('User.doc.get', sink):
+            User.get(id=user.id)
+            User.count()
+        with RouteTimer('User.doc.get', sink) as timer:
+            User.get(id=user.id)
+            timer.status = 304
+        self.assertEqual(sink.latency[('User.doc.get', 'total')].count, 2)
+        self.assertEqual(sink.db_ops['User.doc.get'].sum, 2)
+        self.assertEqual(sink.requests[('User.doc.get', 304)], 1)
+        text = sink.prometheus()
+        self.assertIn('mongoschema_route_seconds_bucket{route="User.doc.get",'
+                      'phase="total",le="+Inf"} 2', text)
+        self.assertIn('mongoschema_route_db_ops_sum{route="User.doc.get"} 2',
+                      text)
+
+    def test_hooks(self):
+        events = []
+        counters = hooks.SchemaCounters().listen()
+        hooks.on_query(events.append)
+        hooks.on_write(events.append)
+        try:
+            user = _create_user()
+            User.clear_cache_and_init()
+            User.get(id=user.id)
+            User.get(id=user.id)
+            list(User.find(username=user.username))
+            user.update_single_field('username', 'other')
+            User.remove(id=user.id)
+        finally:
+            hooks.remove_listener(events.append)
+            hooks.remove_listener(counters)
+        self.assertEqual(
+            [(x.kind, x.operation) for x in events],
+            [('write', 'insert'), ('query', 'get'), ('query', 'find'),
+             ('write', 'update_single_field'), ('write', 'remove')])
+        find = events[2]
+        self.assertEqual(find.schema, 'User')
+        self.assertEqual(find.shape, {'username': '?'})
+        self.assertEqual(find.count, 1)
+        self.assertTrue(find.bytes > 0)
+        self.assertEqual(events[-1].count, 1)
+        get = counters.counts[('User', 'get')]
+        self.assertEqual(get['query']['ops'], 1)
+        self.assertEqual(get['cache_miss']['ops'], 1)
+        self.assertEqual(get['cache_hit']['ops'], 1)
+        self.assertFalse(any(hooks._listeners.values()))
+
+    def test_hooks_partial_reads(self):
+        for i in range(3):
+            _create_user(username='%s' % i)
+        events = []
+        hooks.on_query(events.append)
+        try:
+            for user in User.find():
+                break
+            list(itertools.islice(User.find(), 2))
+        finally:
+            hooks.remove_listener(events.append)
+        # reported with what was fetched, even though never exhausted
+        self.assertEqual([(x.operation, x.count) for x in events],
+                         [('find', 1), ('find', 2)])
+
+    def test_slow_op_log(self):
+        log = hooks.SlowOpLog(threshold=0)
+        hooks.on_query(log)
+        try:
+            with self.assertLogs('mongoschema', 'WARNING') as logs:
+                User.count(username={'$in': ['a', 'b']})
+        finally:
+            hooks.remove_listener(log)
+        self.assertIn("User.count {'username': {'$in': '?'}}", logs.output[0])
+
+    def test_index_advisor(self):
+        user = _create_user()
+        email = self._create_email(user)
+        advisor = IndexAdvisor().listen()
+        try:
+            list(User.find(username=user.username))
+            list(Email.find(subject='subject', body={'$ne': 'x'}))
+            Email.count(body='body')
+            Email.count(body='other')
+            list(Email.find(user=user, sort=('created', -1)))
+            email.update_single_field('body', 'changed')
+        finally:
+            advisor.stop()
+        self.assertEqual(advisor.suggestions(), {
+            Email: ['body', [(('user', 1), ('created', -1)), {}]]})
+        shapes = advisor.shapes[Email]
+        self.assertEqual(shapes[(('body',), (), ())].seen, 2)
+        self.assertIn((('subject',), (), ('body',)), shapes)
+        report = advisor.report()
+        self.assertIn('no index: equality on body x2 (count)', report)
+        self.assertIn("    'body',", report)
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'COLLSCAN'}}
+        self.assertEqual(set(_plan_stages(plan)), {'FETCH', 'COLLSCAN'})
+
+    def test_index_modes(self):
+        self.assertNotIn('name_1', db.lazy_indexed.index_information())
+        LazyIndexed.create(name='a')
+        self.assertIn('name_1', db.lazy_indexed.index_information())
+        ManualIndexed.create(name='a')
+        self.assertNotIn('name_1', db.manual_indexed.index_information())
+        created = MongoSchema.ensure_all_indexes()
+        self.assertEqual(created[db.manual_indexed.full_name], ['name_1'])
+        self.assertEqual(created[db.lazy_indexed.full_name], [])
+        info = db.manual_indexed.index_information()
+        self.assertTrue(info['name_1']['unique'])
+        MongoSchema.ensure_all_indexes(background=True).join()
+        self.assertFalse(any(MongoSchema.ensure_all_indexes().values()))
+
+    def test_schema_prepared_on_first_use(self):
+        class Unused(User):
+            collection = db.unused
+            schema = {
+                'bio': MF(str, compress='zlib'),
+            }
+            index_mode = 'manual'
+
+        MongoSchema.clear_cache_and_init()
+        self.assertNotIn('_schema', Unused.__dict__)
+        self.assertEqual(Unused.create(username='a', bio='b').bio, 'b')
+        self.assertIn('id', Unused.__dict__['_schema'])
+        self.assertIn('username', Unused.schema)
+
+    def test_doc_etag(self):
+        user = _create_user()
+        etag = User._doc_etag(user)
+        self.assertEqual(User._doc_etag(User.get(id=user.id)), etag)
+        user.username = 'changed'
+        self.assertNotEqual(User._doc_etag(user), etag)
+        doc = VersionedDoc.create(version=1)
+        self.assertEqual(VersionedDoc._doc_etag(doc), '1')
+        doc.version = 2
+        doc.save()
+        self.assertEqual(VersionedDoc._doc_etag(doc), '2')
+        # the hash without the field
+        VersionedDoc.collection.update_one(
+            {'_id': doc.id}, {'$unset': {'version': True}})
+        doc.reload()
+        self.assertEqual(len(VersionedDoc._doc_etag(doc)), 32)
+        # only the cached doc remembers its ETag, an uncached one is
+        # always the one of what was just loaded
+        User.disable_cache()
+        try:
+            etag = User._doc_etag(User.get(id=user.id))
+            User.collection.update_one(
+                {'_id': user.id}, {'$set': {'username': 'elsewhere'}})
+            self.assertNotEqual(User._doc_etag(User.get(id=user.id)), etag)
+        finally:
+            User.enable_cache()
+
+    def test_warm_cache(self):
+        users = [_create_user(username='%s' % i) for i in range(0, 5)]
+        MongoSchema.clear_cache_and_init()
+        self.assertEqual(User.warm_cache(limit=3), 3)
+        self.assertEqual(len(User.cache), 3)
+        self.assertEqual(User.warm_cache(), 2)
+        for user in users:
+            self.assertTrue(user.id in User.cache)
+
+    def test_cache_snapshot(self):
+        users = [_create_user(username='%s' % i) for i in range(0, 5)]
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(User.snapshot_cache(f.name), 5)
+            MongoSchema.clear_cache_and_init()
+            # stale snapshots are ignored
+            self.assertEqual(User.load_cache_snapshot(f.name, max_age=-1), 0)
+            self.assertEqual(User.load_cache_snapshot(f.name), 5)
+            # nothing is decoded until it is asked for
+            self.assertEqual(len(User.cache), 0)
+            db.user.drop()
+            user = User.get(id=users[0].id)
+            self.assertEqual(user.username, users[0].username)
+            self.assertTrue(User.get(id=users[0].id) is user)
+            with self.assertRaises(ValidationError):
+                Farmer.load_cache_snapshot(f.name)
+        # a snapshotted doc that no longer validates is a miss
+        db.user.insert_one({'_id': users[1].id, 'username': 'from db'})
+        users[1].doc['username'] = 5
+        User.add_to_cache(users[1])
+        with tempfile.NamedTemporaryFile() as f:
+            User.snapshot_cache(f.name)
+            MongoSchema.clear_cache_and_init()
+            User.load_cache_snapshot(f.name)
+            self.assertEqual(User.get(id=users[1].id).username, 'from db')
+            stats = User.cache_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (0, 1))
+
+    def test_cache_stats(self):
+        users = [_create_user('%s' % i) for i in range(3)]
+        User.get(id=users[0].id)
+        User.get(id=ObjectId())
+        stats = User.cache_stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertTrue(stats['bytes_estimated'])
+        self.assertIsNone(stats['ages'])
+        self.assertEqual(
+            stats['bytes'], 3 * cachestats.doc_size(users[0]))
+        totals = MongoSchema.cache_stats()
+        self.assertEqual(totals['schemas']['User'], stats)
+        self.assertEqual(totals['hits'], 1)
+
+    def test_cache_budget(self):
+        set_cache_budget(10 ** 9)
+        try:
+            smarter = [Smarter.create(simple='a', smart='%s' % i)
+                       for i in range(2)]
+            users = [_create_user('%s' % i) for i in range(2)]
+            User.get(id=users[0].id)
+            stats = User.cache_stats()
+            self.assertFalse(stats['bytes_estimated'])
+            self.assertEqual(stats['ages']['<60s'], 2)
+            self.assertEqual(
+                stats['bytes'], sum(cachestats.doc_size(x) for x in users))
+            # Smarter is the coldest, its oldest doc goes first
+            set_cache_budget(cachestats.total_bytes() - 1)
+            self.assertEqual(list(Smarter.cache), [smarter[1].id])
+            self.assertEqual(len(User.cache), 2)
+            self.assertEqual(Smarter.cache_stats()['evictions'], 1)
+            self.assertEqual(MongoSchema.cache_stats()['evictions'], 1)
+            # an evicted doc is simply fetched again
+            self.assertEqual(Smarter.get(id=smarter[0].id).smart, '0')
+            self.assertTrue(cachestats.total_bytes() <= cachestats.BUDGET)
+        finally:
+            set_cache_budget(None)
+
+    def test_shared_cache_between_processes(self):
+        _id = ObjectId()
+        with tempfile.NamedTemporaryFile() as f:
+            cache = SharedCache(f.name, slots=16, slot_size=512)
+            cache.set('test.user', _id, {'_id': _id, 'username': 'parent'})
+            ctx = multiprocessing.get_context('fork')
+            queue = ctx.Queue()
+            child = ctx.Process(
+                target=_shared_cache_child, args=(f.name, _id, queue))
+            child.start()
+            self.assertEqual(queue.get()['username'], 'parent')
+            child.join()
+            self.assertEqual(cache.get('test.user', _id)['username'], 'child')
+            cache.invalidate_all()
+            self.assertIsNone(cache.get('test.user', _id))
+            # too big for a slot so it is not cached
+            self.assertFalse(cache.set('test.user', _id, {'x': 'y' * 1024}))
+            # a doc read before the key was invalidated isn't stored
+            token = cache.fill_token('test.user', _id)
+            cache.invalidate('test.user', _id)
+            self.assertFalse(cache.set(
+                'test.user', _id, {'_id': _id, 'username': 'stale'},
+                token=token))
+            self.assertIsNone(cache.get('test.user', _id))
+            token = cache.fill_token('test.user', _id)
+            self.assertTrue(cache.set(
+                'test.user', _id, {'_id': _id, 'username': 'fresh'},
+                token=token))
+            cache.close()
+
+    def test_shared_cache_tier(self):
+        with tempfile.NamedTemporaryFile() as f:
+            User.shared_cache = SharedCache(f.name, slots=16, slot_size=512)
+            try:
+                user = _create_user()
+                User.clear_cache_and_init()
+                User.get(id=user.id)
+                # a new process would find it without going to the db
+                User.clear_cache_and_init()
+                db.user.update_one(
+                    {'_id': user.id}, {'$set': {'username': 'changed'}})
+                self.assertEqual(User.get(id=user.id).username, user.username)
+                User.remove(id=user.id)
+                User.clear_cache_and_init()
+                self.assertIsNone(User.get(id=user.id))
+            finally:
+                User.shared_cache.close()
+                User.shared_cache = None
+
+
+class AsyncMongoSchemaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _setUp()
+
+    def tearDown(self):
+        _tearDown()
+
+    def _run(self, coro):
+        return asyncio.run(coro)
+
+    def test_create_get_save(self):
+        async def run():
+            await AsyncUser.ensure_indexes()
+            user = await AsyncUser.create(username='async')
+            self.assertTrue(await AsyncUser.get(id=user.id) is user)
+            user.username = 'renamed'
+            await user.save()
+            AsyncUser.clear_cache_and_init()
+            fetched = await AsyncUser.get(username='renamed')
+            self.assertEqual(fetched.id, user.id)
+            self.assertEqual(await AsyncUser.count(), 1)
+            await fetched.remove()
+            self.assertIsNone(await AsyncUser.get(id=user.id))
+        self._run(run())
+        self.assertTrue('username_1' in db.async_user.index_information())
+
+    def test_find_and_get_many(self):
+        async def run():
+            users = [await AsyncUser.create(username='%s' % i)
+                     for i in range(0, 5)]
+            found = [x async for x in AsyncUser.find(sort=('username', -1))]
+            self.assertEqual([x.id for x in found],
+                             [x.id for x in reversed(users)])
+            AsyncUser.clear_cache_and_init()
+            ids = [users[3].id, ObjectId(), users[1].id]
+            many = await AsyncUser.get_many(ids)
+            self.assertEqual(many[0].id, users[3].id)
+            self.assertIsNone(many[1])
+            self.assertEqual(many[2].username, '1')
+        self._run(run())
+
+    def test_resolve_references(self):
+        async def run():
+            user = await AsyncUser.create(username='to')
+            cc = await AsyncUser.create(username='cc')
+            email = await AsyncEmail.create(
+                user=user, cc=[cc, user], subject='hi')
+            MongoSchema.clear_cache_and_init()
+            email = await AsyncEmail.get(id=email.id)
+            with self.assertRaises(ValueError):
+                email.user
+            await email.resolve()
+            self.assertEqual(email.user.username, 'to')
+            self.assertEqual([x.username for x in email.cc], ['cc', 'to'])
+        self._run(run())
+
+    def test_hooks_and_blocking_only(self):
+        events = []
+
+        async def run():
+            user = await AsyncUser.create(username='hooked')
+            await user.update_single_field('username', 'renamed')
+            AsyncUser.clear_cache_and_init()
+            await AsyncUser.get(id=user.id)
+            await AsyncUser.list()
+            await AsyncUser.count()
+            await AsyncUser.remove(id=user.id)
+
+        hooks.on_query(events.append)
+        hooks.on_write(events.append)
+        try:
+            self._run(run())
+        finally:
+            hooks.remove_listener(events.append)
+        self.assertEqual(
+            [(x.kind, x.operation, x.count) for x in events],
+            [('write', 'insert', 1), ('write', 'update_single_field', 1),
+             ('query', 'get', 1), ('query', 'find', 1), ('query', 'count', 1),
+             ('write', 'remove', 1)])
+        for name in ('warm_cache', 'parallel_scan', 'to_columns', 'migrate',
+                     'export'):
+            with self.assertRaisesRegex(TypeError, 'AsyncMongoSchema'):
+                getattr(AsyncUser, name)()
+
+    def test_no_large_blobs(self):
+        class AsyncUpload(AsyncMongoSchema):
+            collection = AsyncCollection(db.async_upload)
+            schema = {'content': MF(LargeBlob, required=False)}
+
+        async def run():
+            with self.assertRaisesRegex(TypeError, 'LargeBlob'):
+                await AsyncUpload.create(content=b'data')
+            with self.assertRaisesRegex(TypeError, 'LargeBlob'):
+                await AsyncUpload.remove()
+        self._run(run())
+        self.assertEqual(db.async_upload.count_documents({}), 0)
+
 
 class MongoSchemaFlaskTest(unittest.TestCase):
 
@@ -648,6 +1792,138 @@ class MongoSchemaFlaskTest(unittest.TestCase):
         self._test_get_single_field(user)
         self._test_vanilla_list(user)
 
+    def test_array_field_round_trip(self):
+        item = Embedding.create(name='a', vector=[1, 2, 3, 4], rows=[[1, 2]])
+        doc = self._execute_request(Embedding.doc_path_for(oid=item.id))
+        self.assertEqual(doc['rows'], [[1, 2]])
+        doc['vector'] = [x * 2 for x in doc['vector']]
+        self._execute_request(Embedding.doc_path_for(oid=item.id), data=doc,
+                              method='put')
+        item.reload()
+        self.assertEqual(item.vector.tolist(), [2, 4, 6, 8])
+        self.assertEqual(item.rows.tolist(), [[1, 2]])
+
+    def test_list_paging(self):
+        users = [_create_user(username='%s' % i) for i in range(0, 5)]
+        ids = [str(x.id) for x in users]
+        path = User.path_for()
+        page = self._execute_request(path, params={'limit': 2})
+        self.assertEqual([x['id'] for x in page], ids[:2])
+        page = self._execute_request(
+            path, params={'limit': 2, 'after': page[-1]['id']})
+        self.assertEqual([x['id'] for x in page], ids[2:4])
+        page = self._execute_request(path, params={'after': ids[3]})
+        self.assertEqual([x['id'] for x in page], ids[4:])
+        resp = self._execute_request(
+            path, params={'after': 'asdf'}, return_resp=True)
+        self.assertEqual(resp.status_code, 400)
+        for limit in ('abc', '-1', '1.5'):
+            resp = self._execute_request(
+                path, params={'limit': limit}, return_resp=True)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_fields(self):
+        user = _create_user()
+        reply = self._execute_request(
+            user.path_for, params={'fields': 'username'})
+        self.assertEqual(
+            reply, {'id': str(user.id), 'username': user.username})
+        reply = self._execute_request(user.path_for, params={'fields': 'id'})
+        self.assertEqual(reply, {'id': str(user.id)})
+        reply = self._execute_request(
+            User.path_for(), params={'fields': 'id', 'limit': 1})
+        self.assertEqual(reply, [{'id': str(user.id)}])
+        resp = self._execute_request(
+            user.path_for, params={'fields': 'nope'}, return_resp=True)
+        self.assertEqual(resp.status_code, 400)
+
+    def test_metrics(self):
+        user = _create_user()
+        self._execute_request(user.path_for)
+        text = requests.get('http://localhost:9002/metrics').text
+        for phase in ('load', 'encode', 'total'):
+            self.assertIn('route="User.doc.get",phase="%s"' % phase, text)
+        self.assertIn(
+            'mongoschema_route_requests_total{route="User.doc.get",'
+            'status="200"}', text)
+        # a streamed list is timed until it's all sent
+        self._execute_request(User.path_for())
+        text = requests.get('http://localhost:9002/metrics').text
+        db_ops = re.search(
+            r'mongoschema_route_db_ops_sum\{route="User.list"\} (\d+)', text)
+        self.assertTrue(int(db_ops.group(1)) >= 1)
+        self.assertIn('route="User.list",phase="encode"', text)
+
+    def test_etag(self):
+        user = _create_user()
+        url = 'http://localhost:9002' + user.path_for
+        first = requests.get(url)
+        etag = first.headers['ETag']
+        self.assertEqual(first.headers['Cache-Control'], 'no-cache')
+        again = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.content, b'')
+        self._execute_request(
+            user.path_for, data={'username': 'changed'}, method='patch')
+        changed = requests.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertEqual(changed.json()['username'], 'changed')
+
+    def test_batch(self):
+        user, user2 = _create_user(), _create_user(username='u2')
+        ops = [
+            {'schema': 'user', 'oid': str(user.id)},
+            {'schema': 'user', 'oid': str(user2.id),
+             'method': 'get-username'},
+            {'schema': 'user', 'oid': str(user.id), 'method': 'update',
+             'params': {'username': 'renamed'}},
+            {'schema': 'user', 'oid': str(user.id),
+             'method': 'useless-function'},
+            {'schema': 'user', 'oid': str(ObjectId())},
+            {'schema': 'user', 'oid': str(user.id), 'method': 'reload'},
+            {'schema': 'user', 'args': {'limit': 1}},
+            {'schema': 'emailentry', 'method': 'custom_static'},
+        ]
+        path = '/api/v0/batch'
+        results = self._execute_request(path, data=ops, method='post')
+        self.assertEqual(
+            [x['status'] for x in results],
+            [200, 200, 200, 200, 404, 404, 200, 401])
+        self.assertEqual(results[0]['body']['id'], str(user.id))
+        self.assertEqual(results[1]['body'], 'u2')
+        self.assertEqual(results[2]['body']['username'], 'renamed')
+        self.assertEqual(results[3]['body'], {'1': 1})
+        self.assertEqual(
+            [x['id'] for x in results[6]['body']], [str(user.id)])
+        self.assertEqual(User.get(id=user.id).username, 'renamed')
+        resp = self._execute_request(
+            path, data={'schema': 'user'}, method='post', return_resp=True)
+        self.assertEqual(resp.status_code, 400)
+        # auth functions see the args of each operation, not the ones of
+        # the batch request
+        ops = [
+            {'schema': 'emailentry', 'method': 'custom_static'},
+            {'schema': 'emailentry', 'method': 'custom_static',
+             'args': {'authparam': 'admin_for_real'}},
+        ]
+        results = self._execute_request(
+            path, data=ops, method='post',
+            params={'authparam': 'admin_for_real'})
+        self.assertEqual([x['status'] for x in results], [401, 201])
+        # later operations see what earlier ones did
+        ops = [
+            {'schema': 'user', 'oid': str(user2.id), 'method': 'update',
+             'params': {'username': 'later'}},
+            {'schema': 'user', 'oid': str(user2.id)},
+            {'schema': 'user', 'oid': str(user2.id), 'method': 'remove'},
+            {'schema': 'user', 'oid': str(user2.id)},
+        ]
+        results = self._execute_request(path, data=ops, method='post')
+        self.assertEqual([x['status'] for x in results],
+                         [200, 200, 200, 404])
+        self.assertEqual(results[1]['body']['username'], 'later')
+
     def test_create(self):
         data = {'username': 'great_user'}
         path = User.path_for()